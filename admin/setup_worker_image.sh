@@ -2,7 +2,11 @@
 
 set -e
 
-NUM_BOTS=4
+## Bots get a core each, in groups of four (one group per concurrent game).
+NUM_BOTS=$(( $(nproc) / 4 * 4 ))
+if [ ${NUM_BOTS} -lt 4 ]; then
+    NUM_BOTS=4
+fi
 
 ## Create a user to be used by the worker exclusively.
 sudo groupadd bots
@@ -104,7 +108,7 @@ sudo tar -C /usr/local -xzf swift.tar.gz
 echo 'export PATH="$PATH:/usr/local/swift-4.0.2-RELEASE-ubuntu16.10/usr/bin"' | sudo -iu bot_compilation tee -a /home/bot_compilation/.profile
 sudo chmod -R o+r /usr/local/swift-4.0.2-RELEASE-ubuntu16.10/usr/lib/swift/CoreFoundation/
 
-## Create four cgroups to isolate bots.
+## Create cgroups to isolate bots.
 sudo touch /etc/cgconfig.conf
 for i in $(seq 0 $((NUM_BOTS-1))); do
     CGROUP="bot_${i}"
@@ -141,25 +145,16 @@ EOF
 done
 
 ## cgconfig doesn't let us set multiple denied devices, so we need a
-## sudo-executable script that fixes this for us
-cat <<EOF | sudo tee -a /home/worker/fix_cgroups.sh
-#!/bin/sh
-echo "c 195:1 rwm" > /sys/fs/cgroup/devices/bot_0/devices.deny
-echo "c 195:2 rwm" > /sys/fs/cgroup/devices/bot_0/devices.deny
-echo "c 195:3 rwm" > /sys/fs/cgroup/devices/bot_0/devices.deny
-
-echo "c 195:0 rwm" > /sys/fs/cgroup/devices/bot_1/devices.deny
-echo "c 195:2 rwm" > /sys/fs/cgroup/devices/bot_1/devices.deny
-echo "c 195:3 rwm" > /sys/fs/cgroup/devices/bot_1/devices.deny
-
-echo "c 195:0 rwm" > /sys/fs/cgroup/devices/bot_2/devices.deny
-echo "c 195:1 rwm" > /sys/fs/cgroup/devices/bot_2/devices.deny
-echo "c 195:3 rwm" > /sys/fs/cgroup/devices/bot_2/devices.deny
-
-echo "c 195:0 rwm" > /sys/fs/cgroup/devices/bot_3/devices.deny
-echo "c 195:1 rwm" > /sys/fs/cgroup/devices/bot_3/devices.deny
-echo "c 195:2 rwm" > /sys/fs/cgroup/devices/bot_3/devices.deny
-EOF
+## sudo-executable script that fixes this for us. Each bot may only use the
+## GPU of its seat in the game.
+echo "#!/bin/sh" | sudo tee /home/worker/fix_cgroups.sh
+for i in $(seq 0 $((NUM_BOTS-1))); do
+    for j in 0 1 2 3; do
+        if [ ${j} -ne $((i % 4)) ]; then
+            echo "echo \"c 195:${j} rwm\" > /sys/fs/cgroup/devices/bot_${i}/devices.deny" | sudo tee -a /home/worker/fix_cgroups.sh
+        fi
+    done
+done
 sudo chmod 544 /home/worker/fix_cgroups.sh
 
 ## Create a user to be used by compilation. This user will have limited Internet access.
@@ -173,7 +168,24 @@ sudo sh -c "echo \"worker ALL=(bot_compilation) NOPASSWD: ALL\" > /etc/sudoers.d
 sudo sh -c "echo \"worker ALL=(root) NOPASSWD: /home/worker/fix_cgroups.sh\" >> /etc/sudoers.d/worker_bot_compilation"
 sudo chmod 0400 /etc/sudoers.d/worker_bot_compilation
 
-## Create four users to isolate bots.
+## Create users for compile workers, which compile a bot per core at once,
+## each as its own user. They share bot_compilation's home (and the
+## toolchains installed there), so make it writable by its group, and have
+## files created there stay that way.
+NUM_COMPILATION_USERS=$(nproc)
+sudo chmod -R g+rwX /home/bot_compilation
+sudo find /home/bot_compilation -type d -exec chmod g+s {} +
+## (At the top: SDKMAN's lines must stay at the end.)
+sudo sed -i '1i umask 002' /home/bot_compilation/.profile
+for i in $(seq 0 $((NUM_COMPILATION_USERS-1))); do
+    USERNAME="bot_compilation_${i}"
+    sudo useradd -M -d /home/bot_compilation -g bot_compilation -G bots ${USERNAME}
+    sudo iptables -A OUTPUT -d 10.0.0.0/8 -m owner --uid-owner ${USERNAME} -j DROP
+    sudo sh -c "echo \"worker ALL=(${USERNAME}) NOPASSWD: ALL\" > /etc/sudoers.d/worker_${USERNAME}"
+    sudo chmod 0400 /etc/sudoers.d/worker_${USERNAME}
+done
+
+## Create users to isolate bots.
 for i in $(seq 0 $((NUM_BOTS-1))); do
     USERNAME="bot_${i}"
     sudo useradd -m -g bots ${USERNAME}
@@ -0,0 +1,29 @@
+"""Add artifacts_uploaded field to game table.
+
+Revision ID: 5b0e7f1a2c3d
+Revises: 451d4bb125cb
+Create Date: 2017-11-14 09:30:12.418254+00:00
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import mysql
+
+
+# revision identifiers, used by Alembic.
+revision = '5b0e7f1a2c3d'
+down_revision = '451d4bb125cb'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Existing games were uploaded synchronously
+    op.add_column('game', sa.Column('artifacts_uploaded',
+                                    mysql.TINYINT(display_width=1),
+                                    nullable=False,
+                                    server_default=sa.text("'1'")))
+
+
+def downgrade():
+    op.drop_column('game', 'artifacts_uploaded')
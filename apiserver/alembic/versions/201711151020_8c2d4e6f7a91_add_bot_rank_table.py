@@ -0,0 +1,58 @@
+"""Add bot_rank table.
+
+Revision ID: 8c2d4e6f7a91
+Revises: 5b0e7f1a2c3d
+Create Date: 2017-11-15 10:20:47.203118+00:00
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import mysql
+
+
+# revision identifiers, used by Alembic.
+revision = '8c2d4e6f7a91'
+down_revision = '5b0e7f1a2c3d'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        "bot_rank",
+        sa.Column("user_id",
+                  mysql.MEDIUMINT(display_width=8, unsigned=True),
+                  primary_key=True, autoincrement=False),
+        sa.Column("bot_id",
+                  mysql.MEDIUMINT(display_width=8, unsigned=True),
+                  primary_key=True, autoincrement=False),
+        sa.Column("score", mysql.DOUBLE(), nullable=False),
+        sa.Column("rank",
+                  mysql.MEDIUMINT(display_width=8, unsigned=True),
+                  nullable=False),
+        # Filled in on the first rank change, or by the rebuild script
+        sa.Column("tier", mysql.VARCHAR(length=16), nullable=True),
+        sa.ForeignKeyConstraint(['user_id', 'bot_id'],
+                                ['bot.user_id', 'bot.id'],
+                                name='bot_rank_bot_fk',
+                                ondelete='CASCADE'),
+        sa.Index("bot_rank_score", "score", "user_id", "bot_id"),
+        sa.Index("bot_rank_rank", "rank"),
+        mysql_default_charset='utf8',
+        mysql_engine='InnoDB'
+    )
+
+    # Ranked by score, ties broken by user ID and then bot ID
+    op.execute("SET @rank = 0")
+    op.execute("""
+        INSERT INTO bot_rank (user_id, bot_id, score, `rank`)
+        SELECT ranked.user_id, ranked.id, ranked.score, @rank := @rank + 1
+        FROM (
+            SELECT user_id, id, score FROM bot
+            ORDER BY score DESC, user_id, id
+        ) ranked
+    """)
+
+
+def downgrade():
+    op.drop_table('bot_rank')
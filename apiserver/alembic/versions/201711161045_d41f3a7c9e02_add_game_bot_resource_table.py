@@ -0,0 +1,63 @@
+"""Add game_bot_resource table.
+
+Revision ID: d41f3a7c9e02
+Revises: 8c2d4e6f7a91
+Create Date: 2017-11-16 10:45:12.530861+00:00
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import mysql
+
+
+# revision identifiers, used by Alembic.
+revision = 'd41f3a7c9e02'
+down_revision = '8c2d4e6f7a91'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        "game_bot_resource",
+        sa.Column("game_id",
+                  mysql.MEDIUMINT(display_width=8, unsigned=True),
+                  primary_key=True, autoincrement=False),
+        sa.Column("user_id",
+                  mysql.MEDIUMINT(display_width=8, unsigned=True),
+                  primary_key=True, autoincrement=False),
+        sa.Column("bot_id",
+                  mysql.MEDIUMINT(display_width=8, unsigned=True),
+                  primary_key=True, autoincrement=False),
+        # The host of the worker that ran the game
+        sa.Column("worker", mysql.VARCHAR(length=64), nullable=False),
+        # Seconds of CPU time
+        sa.Column("cpu_time", mysql.DOUBLE(), nullable=False),
+        # Bytes
+        sa.Column("peak_memory",
+                  mysql.BIGINT(display_width=20, unsigned=True),
+                  nullable=False),
+        sa.Column("memory_failures",
+                  mysql.INTEGER(display_width=10, unsigned=True),
+                  nullable=False),
+        sa.Column("throttled_periods",
+                  mysql.INTEGER(display_width=10, unsigned=True),
+                  nullable=False),
+        # Seconds
+        sa.Column("throttled_time", mysql.DOUBLE(), nullable=False),
+        sa.ForeignKeyConstraint(['game_id'], ['game.id'],
+                                name='game_bot_resource_game_fk',
+                                ondelete='CASCADE'),
+        sa.ForeignKeyConstraint(['user_id', 'bot_id'],
+                                ['bot.user_id', 'bot.id'],
+                                name='game_bot_resource_bot_fk',
+                                ondelete='CASCADE'),
+        sa.Index("game_bot_resource_bot", "user_id", "bot_id"),
+        sa.Index("game_bot_resource_worker", "worker"),
+        mysql_default_charset='utf8',
+        mysql_engine='InnoDB'
+    )
+
+
+def downgrade():
+    op.drop_table('game_bot_resource')
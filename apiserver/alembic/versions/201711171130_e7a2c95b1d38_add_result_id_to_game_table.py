@@ -0,0 +1,28 @@
+"""Add result_id field to game table.
+
+Revision ID: e7a2c95b1d38
+Revises: d41f3a7c9e02
+Create Date: 2017-11-17 11:30:41.207316+00:00
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e7a2c95b1d38'
+down_revision = 'd41f3a7c9e02'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Set by workers so that a result posted twice is only stored once
+    op.add_column('game', sa.Column('result_id', sa.String(32),
+                                    nullable=True))
+    op.create_index('game_result_id', 'game', ['result_id'], unique=True)
+
+
+def downgrade():
+    op.drop_index('game_result_id', table_name='game')
+    op.drop_column('game', 'result_id')
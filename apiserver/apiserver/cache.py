@@ -0,0 +1,130 @@
+"""
+Shared cache backend, with tag-based invalidation.
+
+The backend is any werkzeug cache. By default it is an in-memory LRU cache,
+which is private to each process; set CACHE_BACKEND to the name of a
+werkzeug.contrib.cache class (e.g. "RedisCache") to share cached data
+between processes.
+
+Cached entries that depend on some data are keyed with the current
+generation of one or more tags. Invalidating a tag gives it a new random
+generation, so entries made under the old one are simply never read again.
+
+Tag generations must be shared by every process that caches or invalidates
+(the coordinator invalidates what the API server caches, e.g. as games are
+stored). With a shared backend they are kept there; with the LRU cache they
+are kept on local disk, in CACHE_TAG_DIR, which only works for processes on
+the same machine. If the coordinator and the API server run on different
+machines, use a shared backend.
+"""
+import threading
+import time
+import uuid
+
+import cachetools
+import werkzeug.contrib.cache
+
+from . import config
+
+
+class LRUCache(werkzeug.contrib.cache.BaseCache):
+    """An in-memory werkzeug cache that evicts least recently used keys."""
+    def __init__(self, maxsize, default_timeout=300):
+        super(LRUCache, self).__init__(default_timeout)
+        self._cache = cachetools.LRUCache(maxsize)
+        self._lock = threading.Lock()
+
+    def _expires(self, timeout):
+        if timeout is None:
+            timeout = self.default_timeout
+        # Like other werkzeug caches, a timeout of 0 never expires
+        return time.time() + timeout if timeout > 0 else None
+
+    def get(self, key):
+        with self._lock:
+            expires, value = self._cache.get(key, (None, None))
+            if expires is not None and expires < time.time():
+                del self._cache[key]
+                return None
+            return value
+
+    def set(self, key, value, timeout=None):
+        with self._lock:
+            self._cache[key] = (self._expires(timeout), value)
+        return True
+
+    def add(self, key, value, timeout=None):
+        with self._lock:
+            if key in self._cache:
+                return False
+            self._cache[key] = (self._expires(timeout), value)
+        return True
+
+    def delete(self, key):
+        with self._lock:
+            return self._cache.pop(key, None) is not None
+
+    def has(self, key):
+        return self.get(key) is not None
+
+    def clear(self):
+        with self._lock:
+            self._cache.clear()
+        return True
+
+
+def _make_backend():
+    if config.CACHE_BACKEND == "lru":
+        return LRUCache(config.CACHE_LRU_SIZE)
+    backend_class = getattr(werkzeug.contrib.cache, config.CACHE_BACKEND)
+    return backend_class(**config.CACHE_BACKEND_OPTIONS)
+
+
+def _make_tag_backend():
+    if config.CACHE_BACKEND == "lru":
+        return werkzeug.contrib.cache.FileSystemCache(
+            config.CACHE_TAG_DIR, threshold=config.CACHE_TAG_THRESHOLD,
+            default_timeout=0)
+    return backend
+
+
+backend = _make_backend()
+# Where tag generations are kept
+tag_backend = _make_tag_backend()
+
+
+def user_tag(user_id):
+    """The tag for data about a particular user."""
+    return "user:{}".format(user_id)
+
+
+def login_tag(user_id):
+    """
+    The tag for a user's cached logins (see web.util). Kept apart from
+    user_tag, which games and compiles invalidate all the time, so that only
+    changes to the user's credentials or account log them out.
+    """
+    return "login:{}".format(user_id)
+
+
+def _tag_key(tag):
+    return "tag:" + tag
+
+
+def generations(*tags):
+    """Get the current generation of each tag, as a list."""
+    keys = [_tag_key(tag) for tag in tags]
+    result = []
+    for key, generation in zip(keys, tag_backend.get_many(*keys)):
+        if generation is None:
+            # Never used, or evicted; start a new generation
+            tag_backend.add(key, uuid.uuid4().hex, timeout=0)
+            generation = tag_backend.get(key)
+        result.append(generation)
+    return result
+
+
+def invalidate(*tags):
+    """Invalidate everything cached under any of the given tags."""
+    for tag in tags:
+        tag_backend.set(_tag_key(tag), uuid.uuid4().hex, timeout=0)
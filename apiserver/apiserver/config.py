@@ -21,6 +21,13 @@ FINALS_CUTOFF_SCHEDULE = [ # For 6000 bots
     (469000, 125), # 2000 games
 ]
 
+# TrueSkill parameters: the dynamics factor (tau) in the open stage and in
+# the finals, and the draw probability. These are more reasonable for
+# Halite than the TrueSkill defaults.
+RATING_TAU = 0.008
+FINALS_RATING_TAU = 0.0
+RATING_DRAW_PROBABILITY = 0.001
+
 # Max number of games a bot version can error out in before being
 # stopped from playing
 MAX_ERRORS_PER_BOT = 50
@@ -28,6 +35,89 @@ MAX_ERROR_PERCENTAGE = 0.1
 
 # How many minutes old a compilation job must be to be considered stuck.
 COMPILATION_STUCK_THRESHOLD = 30
+# The most compilation tasks a compile worker may take in one /task request.
+COMPILE_TASK_BATCH_MAX = 16
+# Whether to claim compilation tasks with SELECT ... FOR UPDATE SKIP LOCKED,
+# so that concurrent claims don't wait for each other. Needs MySQL 8.0.
+COMPILE_TASK_SKIP_LOCKED = False
+
+# How many seconds the coordinator's in-memory ranking snapshot (used for
+# matchmaking) may be reused before being reloaded from the database.
+RANKING_CACHE_REFRESH_INTERVAL = 15
+
+# Whether game tasks are prepared by a background matchmaking thread, rather
+# than inside each /task request.
+TASK_QUEUE_ENABLED = True
+# How many prepared game tasks to keep, per worker capability (CPU/GPU).
+TASK_QUEUE_SIZE = 50
+# How many seconds a prepared game task may wait before it is discarded.
+TASK_QUEUE_MAX_AGE = 60
+# How many seconds since the last request for a capability the queue for it
+# is still refilled.
+TASK_QUEUE_DEMAND_WINDOW = 60
+# How many seconds the matchmaking thread sleeps when it has nothing to do.
+TASK_QUEUE_IDLE_WAIT = 1
+# The longest a worker may ask /task to wait for a game task to be ready.
+TASK_LONG_POLL_MAX_WAIT = 30
+
+# How many seconds apart the coordinator checks leaderboard ranks and tiers
+# against the scores, repairing any that drifted (ranks are otherwise kept
+# up to date as scores change; see ranking.py).
+RANK_REFRESH_INTERVAL = 3600
+# How many bot_rank rows a rank refresh writes per transaction.
+RANK_REFRESH_BATCH_SIZE = 500
+
+# How many seconds the in-process rank index may be reused before being
+# reloaded from the database (it is also updated as scores change).
+RANK_INDEX_REFRESH_INTERVAL = 300
+# Width of the score buckets of the rank index.
+RANK_INDEX_BUCKET_WIDTH = 0.05
+# How far beyond the current lowest and highest score the rank index has
+# buckets for.
+RANK_INDEX_SCORE_MARGIN = 10
+
+# Backend for cached data such as web responses: "lru" for a per-process
+# in-memory cache, or the name of a werkzeug.contrib.cache class (e.g.
+# "RedisCache") to share the cache between processes. Use a shared one if
+# the coordinator and the API server run on different machines, or pages
+# invalidated by the coordinator stay cached (see cache.py).
+CACHE_BACKEND = "lru"
+# Keyword arguments for the werkzeug cache class.
+CACHE_BACKEND_OPTIONS = {}
+# How many entries the in-memory cache holds.
+CACHE_LRU_SIZE = 4096
+# With the in-memory cache, where cache invalidations are kept on local
+# disk, so that the processes on this machine all see them.
+CACHE_TAG_DIR = "/tmp/halite_cache_tags"
+# How many invalidations may be kept on disk before some are dropped (which
+# invalidates what was cached under them).
+CACHE_TAG_THRESHOLD = 100000
+
+# How often match view counts are written to the database, in seconds.
+VIEW_COUNT_FLUSH_INTERVAL = 10
+
+# Where recently requested replays (and, on the coordinator, bots) are
+# cached on local disk.
+REPLAY_CACHE_DIR = "/tmp/halite_replay_cache"
+# How many bytes of files the disk cache holds.
+REPLAY_CACHE_SIZE = 2 * 1024 * 1024 * 1024
+# How long clients may keep a downloaded replay, in seconds.
+REPLAY_MAX_AGE = 24 * 60 * 60
+
+# Where uploaded replays and error logs are kept until they have been
+# uploaded to object storage in the background. This must survive reboots
+# (so not a tmpfs), or games whose artifacts were not uploaded yet lose them.
+ARTIFACT_SPOOL_DIR = "/var/spool/halite_artifacts"
+# How many threads upload spooled artifacts.
+ARTIFACT_UPLOAD_THREADS = 4
+# Maximum wait between attempts to upload spooled artifacts, in seconds.
+ARTIFACT_UPLOAD_MAX_BACKOFF = 300
+# How often the spool directory is checked for leftover artifacts, in
+# seconds.
+ARTIFACT_SPOOL_RESCAN_INTERVAL = 300
+# How many seconds old spooled artifacts without a game must be before they
+# are considered abandoned.
+ARTIFACT_SPOOL_ORPHAN_AGE = 3600
 
 # Flask settings
 # Max size of an upload, in bytes
@@ -38,6 +128,15 @@ MAX_COMPILED_BOT_UPLOAD_SIZE = 100 * 1024 * 1024
 FLASK_SECRET_KEY = "1"
 # Where to look for API keys
 API_KEY_HEADER = "X-Api-Key"
+# How many logged-in users, by API key or session, are cached.
+LOGIN_CACHE_SIZE = 10000
+# How long a login is cached, in seconds. Changes to a user made outside the
+# API (e.g. deactivating them in the database) take up to this long to apply,
+# as do API key resets and account changes in processes on other machines
+# unless CACHE_BACKEND is shared between them.
+LOGIN_CACHE_TTL = 60
+# Response header with the cursor for the next page of a listing
+NEXT_CURSOR_HEADER = "X-Next-Cursor"
 # What session cookie to use
 SESSION_COOKIE = "user_id"
 
@@ -60,6 +159,8 @@ GCLOUD_DEPLOYED_ARTIFACTS_BUCKET = 'TODO'
 
 # The name of the worker source blob in the object storage bucket.
 WORKER_ARTIFACT_KEY = ""
+# The prefix of compiled bots cached by source hash, in the bot bucket.
+COMPILE_CACHE_PREFIX = "compile_cache/"
 
 DATABASE_PROJECT_ID = ""
 DATABASE_REGION = ""
@@ -0,0 +1,288 @@
+"""
+Background upload of game artifacts (replays and error logs).
+
+Uploaded artifacts are first written to a local spool directory along with
+a JSON manifest listing where each file should go in object storage. Once
+the game has been stored in the database, the manifest is handed to a pool
+of uploader threads, which retry failed uploads with exponential backoff
+and mark the game's artifacts as uploaded when done. Until then, the game
+is left out of match listings and its replay is not served.
+
+Spooled files and manifests are fsynced, along with the spool directory,
+before the game is stored, so that they survive a crash of the host.
+
+Manifests are only deleted once everything in them has been uploaded, so
+anything left in the spool directory (e.g. after a restart) is picked up
+again by a periodic rescan, which the uploader threads start with. A
+manifest is locked while it is being uploaded, so several coordinator
+processes can share one spool directory. Uploads are idempotent, so a
+retry simply uploads every file in the manifest again.
+"""
+import fcntl
+import itertools
+import json
+import logging
+import os
+import queue
+import threading
+import time
+import uuid
+
+import google.cloud.storage as gcloud_storage
+
+from .. import cache, config, model
+
+
+MANIFEST_SUFFIX = ".json"
+
+# Buckets that artifacts can be uploaded to, by the name stored in manifests
+BUCKETS = {
+    "replay": model.get_replay_bucket,
+    "error_log": lambda _: model.get_error_log_bucket(),
+}
+
+# (not before, sequence number, manifest path, attempt)
+_pending = queue.PriorityQueue()
+_sequence = itertools.count()
+# Manifests this process has in _pending, so a rescan doesn't add them twice
+_queued = set()
+_queued_lock = threading.Lock()
+
+_uploaders = []
+_uploaders_lock = threading.Lock()
+
+
+def _spool_path(name):
+    return os.path.join(config.ARTIFACT_SPOOL_DIR, name)
+
+
+def _fsync_path(path):
+    """Make sure a file or directory, and its contents, is on disk."""
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def _write_manifest(path, manifest):
+    """Atomically (re)write a manifest, making sure it is on disk."""
+    temp_path = path + ".tmp"
+    with open(temp_path, "w") as manifest_file:
+        json.dump(manifest, manifest_file)
+        manifest_file.flush()
+        os.fsync(manifest_file.fileno())
+    os.rename(temp_path, path)
+    # Persist the rename, and the entries of the files it lists
+    _fsync_path(os.path.dirname(path))
+
+
+def spool(replay_key, uploads):
+    """
+    Save a game's artifacts to the spool directory.
+
+    :param replay_key: The key of the game's replay in object storage.
+    :param uploads: A list of (file storage, bucket name, bucket argument,
+    key) tuples, where the bucket name is a key of BUCKETS.
+    :return: The path of the manifest, to pass to enqueue or discard.
+    """
+    os.makedirs(config.ARTIFACT_SPOOL_DIR, exist_ok=True)
+    spool_id = uuid.uuid4().hex
+
+    files = []
+    for index, (file_storage, bucket, bucket_arg, key) in enumerate(uploads):
+        path = _spool_path("{}_{}".format(spool_id, index))
+        file_storage.seek(0)
+        file_storage.save(path)
+        _fsync_path(path)
+        files.append({
+            "path": path,
+            "bucket": bucket,
+            "bucket_arg": bucket_arg,
+            "key": key,
+        })
+
+    manifest_path = _spool_path(spool_id + MANIFEST_SUFFIX)
+    _write_manifest(manifest_path, {
+        "replay_key": replay_key,
+        "game_id": None,
+        "created": time.time(),
+        "files": files,
+    })
+    return manifest_path
+
+
+def enqueue(manifest_path, game_id):
+    """
+    Schedule the artifacts in a manifest for upload, now that the game they
+    belong to has been stored.
+    """
+    with open(manifest_path) as manifest_file:
+        manifest = json.load(manifest_file)
+    manifest["game_id"] = game_id
+    _write_manifest(manifest_path, manifest)
+
+    _ensure_uploaders()
+    _schedule(manifest_path)
+
+
+def _schedule(manifest_path):
+    with _queued_lock:
+        if manifest_path in _queued:
+            return
+        _queued.add(manifest_path)
+    _pending.put((time.time(), next(_sequence), manifest_path, 0))
+
+
+def discard(manifest_path):
+    """Delete spooled artifacts for a game that was not stored."""
+    try:
+        with open(manifest_path) as manifest_file:
+            manifest = json.load(manifest_file)
+    except FileNotFoundError:
+        return
+
+    _remove_spooled(manifest_path, manifest)
+
+
+def _remove_spooled(manifest_path, manifest):
+    for spooled_file in manifest["files"]:
+        try:
+            os.remove(spooled_file["path"])
+        except FileNotFoundError:
+            pass
+    os.remove(manifest_path)
+
+
+def _upload(manifest_path):
+    """
+    Upload everything in a manifest, then mark the game as uploaded and
+    remove the manifest. Does nothing if another process holds the
+    manifest.
+    """
+    with open(manifest_path) as lock_file:
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return
+
+        # Another process may have finished it before we got the lock
+        if not os.path.exists(manifest_path):
+            return
+
+        manifest = json.load(lock_file)
+        for spooled_file in manifest["files"]:
+            bucket = BUCKETS[spooled_file["bucket"]](spooled_file["bucket_arg"])
+            blob = gcloud_storage.Blob(spooled_file["key"], bucket,
+                                       chunk_size=262144)
+            blob.upload_from_filename(spooled_file["path"])
+
+        with model.engine.connect() as conn:
+            conn.execute(model.games.update().where(
+                model.games.c.id == manifest["game_id"]
+            ).values(
+                artifacts_uploaded=True,
+            ))
+        # The game can now be listed
+        cache.invalidate("matches")
+
+        _remove_spooled(manifest_path, manifest)
+
+
+def _upload_forever():
+    while True:
+        not_before, sequence, manifest_path, attempt = _pending.get()
+        delay = not_before - time.time()
+        if delay > 0:
+            # Not due yet; put it back in case something more urgent arrives
+            _pending.put((not_before, sequence, manifest_path, attempt))
+            time.sleep(min(delay, 1))
+            continue
+
+        try:
+            _upload(manifest_path)
+        except Exception:
+            # If the manifest is gone, another process uploaded it
+            if os.path.exists(manifest_path):
+                backoff = min(2 ** attempt, config.ARTIFACT_UPLOAD_MAX_BACKOFF)
+                logging.exception(
+                    "Could not upload artifacts in {}, retrying in {}s".format(
+                        manifest_path, backoff))
+                _pending.put((time.time() + backoff, next(_sequence),
+                              manifest_path, attempt + 1))
+                continue
+
+        with _queued_lock:
+            _queued.discard(manifest_path)
+
+
+def rescan():
+    """
+    Re-queue manifests left in the spool directory, e.g. by a previous run.
+
+    Manifests that were never assigned a game are dropped once they are old
+    enough that the request that spooled them must have finished, unless a
+    game with their replay was stored after all.
+    """
+    try:
+        names = os.listdir(config.ARTIFACT_SPOOL_DIR)
+    except FileNotFoundError:
+        return
+
+    for name in names:
+        if not name.endswith(MANIFEST_SUFFIX):
+            continue
+
+        manifest_path = _spool_path(name)
+        try:
+            with open(manifest_path) as manifest_file:
+                manifest = json.load(manifest_file)
+        except (FileNotFoundError, ValueError):
+            continue
+
+        if manifest["game_id"] is not None:
+            _schedule(manifest_path)
+            continue
+
+        if time.time() - manifest["created"] < config.ARTIFACT_SPOOL_ORPHAN_AGE:
+            continue
+
+        with model.engine.connect() as conn:
+            game = conn.execute(model.games.select().where(
+                model.games.c.replay_name == manifest["replay_key"]
+            )).first()
+
+        if game:
+            enqueue(manifest_path, game["id"])
+        else:
+            logging.warning(
+                "Dropping artifacts of unknown game {}".format(
+                    manifest["replay_key"]))
+            discard(manifest_path)
+
+
+def _rescan_forever():
+    while True:
+        try:
+            rescan()
+        except Exception:
+            logging.exception("Could not rescan artifact spool directory")
+        time.sleep(config.ARTIFACT_SPOOL_RESCAN_INTERVAL)
+
+
+def _ensure_uploaders():
+    with _uploaders_lock:
+        if _uploaders:
+            return
+
+        _uploaders.append(threading.Thread(target=_rescan_forever,
+                                           name="artifact-rescan",
+                                           daemon=True))
+        for index in range(config.ARTIFACT_UPLOAD_THREADS):
+            _uploaders.append(threading.Thread(
+                target=_upload_forever,
+                name="artifact-uploader-{}".format(index),
+                daemon=True))
+
+        for thread in _uploaders:
+            thread.start()
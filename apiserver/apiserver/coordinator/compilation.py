@@ -3,8 +3,9 @@ import datetime
 import flask
 import sqlalchemy
 
-from .. import config, model, notify, util
+from .. import cache, config, model, notify, util
 
+from . import ranking_cache
 from .blueprint import coordinator_api
 
 
@@ -22,32 +23,50 @@ def reset_compilation_tasks(conn):
     conn.execute(reset_stuck_tasks)
 
 
-def serve_compilation_task(conn):
-    """Try to find and return a compilation task."""
+def serve_compilation_task(conn, count=1):
+    """
+    Try to find and return compilation tasks.
+
+    :param count: How many tasks to claim at most. With more than one, the
+    tasks are returned together as a "compile_batch" task.
+    """
     with conn.begin() as transaction:
-        # Try to assign a compilation task.
-        find_compilation_task = model.bots.select() \
-            .where(model.bots.c.compile_status ==
-                   model.CompileStatus.UPLOADED.value) \
+        # Try to assign compilation tasks. With SKIP LOCKED, workers
+        # claiming tasks at the same time get different bots instead of
+        # waiting for each other.
+        find_compilation_tasks = sqlalchemy.sql.select([
+            model.bots.c.user_id,
+            model.bots.c.id,
+        ]).where(model.bots.c.compile_status ==
+                 model.CompileStatus.UPLOADED.value) \
             .with_for_update() \
             .order_by(model.bots.c.user_id.asc()) \
-            .limit(1)
-        bot = conn.execute(find_compilation_task).first()
-        if bot:
-            user_id = bot["user_id"]
-            bot_id = bot["id"]
+            .limit(count)
+        if config.COMPILE_TASK_SKIP_LOCKED:
+            find_compilation_tasks = \
+                find_compilation_tasks.suffix_with("SKIP LOCKED")
+        bots = conn.execute(find_compilation_tasks).fetchall()
+        if bots:
             # Keep track of when compilation started, so that we can
             # restart it if it gets stuck
             update = model.bots.update() \
-                .where((model.bots.c.user_id == user_id) &
-                       (model.bots.c.id == bot_id)) \
+                .where(sqlalchemy.sql.tuple_(
+                    model.bots.c.user_id, model.bots.c.id
+                ).in_([(bot["user_id"], bot["id"]) for bot in bots])) \
                 .values(compile_status=model.CompileStatus.IN_PROGRESS.value,
                         compile_start=sqlalchemy.sql.func.now())
             conn.execute(update)
-            return util.response_success({
+
+            tasks = [{
                 "type": "compile",
-                "user": user_id,
-                "bot": bot_id,
+                "user": bot["user_id"],
+                "bot": bot["id"],
+            } for bot in bots]
+            if count == 1:
+                return util.response_success(tasks[0])
+            return util.response_success({
+                "type": "compile_batch",
+                "tasks": tasks,
             })
     return None
 
@@ -171,6 +190,10 @@ def update_compilation_status():
                 (model.bots.c.id == bot_id)
             )).first()
 
+            # Matchmaking must not hand out the old version number
+            ranking_cache.invalidate()
+            cache.invalidate("leaderboard", cache.user_tag(user_id))
+
             notify.send_templated_notification(
                 notify.Recipient(user["id"], user["username"], user["email"],
                                  user["organization_name"], user["player_level"],
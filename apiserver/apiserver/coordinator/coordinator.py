@@ -1,49 +1,102 @@
+import collections
+import contextlib
 import json
 import os
 
 import flask
 import sqlalchemy
-import sqlalchemy.exc
-import trueskill
 import zstd
 
-import google.cloud.storage as gcloud_storage
+from ijson.common import JSONError
+try:
+    # Prefer a compiled parser backend where one is available
+    import ijson.backends.yajl2_cffi as ijson
+except ImportError:
+    import ijson
 
-from .. import config, model, notify, util
+from .. import cache, config, model, notify, rank_index, ranking, rating, util
 
+from . import artifacts, ranking_cache, task_queue
 from .blueprint import coordinator_api
 from .compilation import serve_compilation_task, reset_compilation_tasks
 from .matchmaking import serve_game_task
 from .stat import GameStat
 
 
+# Fields that ingesting a game relies on, in its game output and in each of
+# its users
+GAME_OUTPUT_FIELDS = ("replay", "map_width", "map_height", "map_seed",
+                      "map_generator")
+GAME_USER_FIELDS = ("user_id", "bot_id", "version_number", "rank",
+                    "player_tag", "timed_out", "log_name", "tier")
+
+
 @coordinator_api.route("/task")
 def task():
-    """Serve compilation and game tasks to worker instances."""
+    """
+    Serve compilation and game tasks to worker instances.
+
+    With `wait`, if no task is ready, wait up to that many seconds (at most
+    TASK_LONG_POLL_MAX_WAIT) for a game task before answering.
+
+    Compile workers pass `compile_only` to only get compilation tasks, and
+    `compile_count` to get up to that many (at most COMPILE_TASK_BATCH_MAX)
+    at once.
+    """
+
+    # Leaderboard ranks follow the scores that game uploads change
+    ranking.ensure_refresher()
 
     capabilities = flask.request.args.getlist("capability")
     has_gpu = "gpu" in capabilities
+    try:
+        wait = float(flask.request.args.get("wait", 0))
+    except ValueError:
+        raise util.APIError(400, message="Wait must be a number.")
+    wait = min(max(wait, 0), config.TASK_LONG_POLL_MAX_WAIT)
+    try:
+        compile_count = int(flask.request.args.get("compile_count", 1))
+    except ValueError:
+        raise util.APIError(400, message="Compile count must be a number.")
+    compile_count = min(max(compile_count, 1), config.COMPILE_TASK_BATCH_MAX)
+    compile_only = bool(int(flask.request.args.get("compile_only", "0")))
 
     with model.engine.connect() as conn:
         # Prioritize compiling new bots; don't use a GPU instance on this
         # task, though
         if not has_gpu:
             reset_compilation_tasks(conn)
-            response = serve_compilation_task(conn)
+            response = serve_compilation_task(conn, count=compile_count)
             if response:
                 return response
 
-        if config.COMPETITION_FINALS_PAIRING or config.COMPETITION_OPEN:
-            # Otherwise, play a game
-            # If the worker has a GPU, try really hard to give it some work to do
+        if compile_only:
+            return util.response_success({
+                "type": "notask",
+            })
+
+        if ((config.COMPETITION_FINALS_PAIRING or config.COMPETITION_OPEN)
+                and not config.TASK_QUEUE_ENABLED):
+            # If the worker has a GPU, try really hard to give it some
+            # work to do
             tries = 0
-            while tries == 0 or ((has_gpu or config.COMPETITION_FINALS_PAIRING)
+            while tries == 0 or ((has_gpu or
+                                  config.COMPETITION_FINALS_PAIRING)
                                  and tries < 10):
-                response = serve_game_task(conn, has_gpu=has_gpu)
-                if response:
-                    return response
+                game_task = serve_game_task(conn, has_gpu=has_gpu)
+                if game_task:
+                    return util.response_success(game_task)
                 tries += 1
 
+    if ((config.COMPETITION_FINALS_PAIRING or config.COMPETITION_OPEN)
+            and config.TASK_QUEUE_ENABLED):
+        # Otherwise, play a game. Matchmaking happens in the background;
+        # just take (or wait for) a prepared task, without holding on to a
+        # database connection.
+        game_task = task_queue.pop_task(has_gpu=has_gpu, wait=wait)
+        if game_task:
+            return util.response_success(game_task)
+
     return util.response_success({
         "type": "notask",
     })
@@ -57,106 +110,382 @@ def upload_game():
         raise util.APIError(
             400, message="Please provide both the game output and users.")
 
-    game_output = json.loads(flask.request.values["game_output"])
-    users = json.loads(flask.request.values["users"])
-    challenge = json.loads(flask.request.values.get("challenge", "null"))
+    game = {
+        "game_output": json.loads(flask.request.values["game_output"]),
+        "users": json.loads(flask.request.values["users"]),
+        "challenge": json.loads(flask.request.values.get("challenge",
+                                                         "null")),
+        "result_id": flask.request.values.get("result_id"),
+    }
+    validate_game(game)
+    if find_stored_results([game["result_id"]]):
+        # Posted again after the first attempt was stored
+        return util.response_success()
+
+    game = prepare_game(game["game_output"], game["users"],
+                        game["challenge"], game["result_id"])
+
+    with artifacts_handed_off([game]), ranking.index_updates_on_commit():
+        with model.engine.begin() as conn:
+            result, = ingest_games(conn, [game])
+    invalidate_cached_responses([game])
+
+    if "error" in result:
+        raise util.APIError(400, message=result["error"])
+
+    if "message" in result:
+        return util.response_success({
+            "message": result["message"],
+        })
 
-    replay_name = os.path.basename(game_output["replay"])
-    if replay_name not in flask.request.files:
+    return util.response_success()
+
+
+@coordinator_api.route("/games", methods=["POST"])
+def upload_games():
+    """
+    Save the results of several games at once.
+
+    Expects a JSON list `games` of objects with the same `game_output`,
+    `users` and `challenge` fields as a single upload, with all replays and
+    error logs attached as files. Each game is accepted or rejected
+    individually; the response lists a result per game, in order.
+
+    Games may carry a `result_id` that is unique to their result. A game
+    whose result ID was already stored is not stored again, and its result
+    refers to the stored game, so posting the same results twice is safe.
+    """
+    if "games" not in flask.request.values:
+        raise util.APIError(400, message="Please provide the games.")
+
+    games = json.loads(flask.request.values["games"])
+    if not isinstance(games, list):
+        raise util.APIError(400, message="Games must be a list.")
+
+    results = [None] * len(games)
+    valid = []
+    for index, game in enumerate(games):
+        try:
+            validate_game(game)
+            valid.append((index, game))
+        except util.APIError as e:
+            results[index] = {"error": e.message}
+
+    stored = find_stored_results([game.get("result_id")
+                                  for _, game in valid])
+    prepared = []
+    try:
+        for index, game in valid:
+            if game.get("result_id") in stored:
+                results[index] = {"game_id": stored[game["result_id"]]}
+                continue
+
+            try:
+                prepared.append((index, prepare_game(game["game_output"],
+                                                     game["users"],
+                                                     game.get("challenge"),
+                                                     game.get("result_id"))))
+            except util.APIError as e:
+                results[index] = {"error": e.message}
+    except:
+        # Don't leave the artifacts of games prepared so far in the spool
+        for _, game in prepared:
+            artifacts.discard(game["artifacts"])
+        raise
+
+    with artifacts_handed_off([game for _, game in prepared]), \
+            ranking.index_updates_on_commit():
+        with model.engine.begin() as conn:
+            ingested = ingest_games(conn, [game for _, game in prepared])
+            for (index, _), result in zip(prepared, ingested):
+                results[index] = result
+    invalidate_cached_responses([game for _, game in prepared])
+
+    return util.response_success({
+        "games": results,
+    })
+
+
+@contextlib.contextmanager
+def artifacts_handed_off(games):
+    """
+    Hand the spooled artifacts of games off for upload once they have been
+    stored, or discard them if they were not.
+
+    Wrap the transaction storing the games; ingest_games records each
+    stored game's ID in the game dictionary.
+    """
+    try:
+        yield
+    except:
+        for game in games:
+            artifacts.discard(game["artifacts"])
+        raise
+
+    for game in games:
+        if game.get("game_id") is not None:
+            artifacts.enqueue(game["artifacts"], game["game_id"])
+        else:
+            artifacts.discard(game["artifacts"])
+
+
+def invalidate_cached_responses(games):
+    """Invalidate cached web responses that stored games affect."""
+    stored = [game for game in games if game.get("game_id") is not None]
+    if stored:
+        cache.invalidate("leaderboard", "matches", *{
+            cache.user_tag(user["user_id"])
+            for game in stored for user in game["users"]
+        })
+
+
+def validate_game(game):
+    """
+    Check that an uploaded game has the fields that ingesting it relies on.
+
+    :raises: util.APIError if it does not.
+    """
+    if not isinstance(game, dict):
+        raise util.APIError(400, message="Game must be an object.")
+
+    game_output = game.get("game_output")
+    if (not isinstance(game_output, dict) or
+            any(field not in game_output for field in GAME_OUTPUT_FIELDS) or
+            not isinstance(game_output["replay"], str)):
+        raise util.APIError(
+            400, message="Game output must have the fields {}.".format(
+                ", ".join(GAME_OUTPUT_FIELDS)))
+
+    users = game.get("users")
+    if (not isinstance(users, list) or not users or
+            any(not isinstance(user, dict) or
+                any(field not in user for field in GAME_USER_FIELDS) or
+                not all(isinstance(user[field], int) for field in
+                        ("user_id", "bot_id", "version_number", "rank",
+                         "player_tag")) or
+                not isinstance(user["log_name"], (str, type(None)))
+                for user in users)):
         raise util.APIError(
-            400, message="Replay file not found in uploaded files.")
+            400, message="Users must be a list of objects with the fields "
+                         "{}.".format(", ".join(GAME_USER_FIELDS)))
+
+    if not isinstance(game.get("challenge"), (int, type(None))):
+        raise util.APIError(400, message="Challenge must be an ID.")
+
+    if not isinstance(game.get("result_id"), (str, type(None))):
+        raise util.APIError(400, message="Result ID must be a string.")
 
-    stats = parse_replay(decode_replay(flask.request.files[replay_name]))
+
+def find_stored_results(result_ids):
+    """
+    Find games that were already stored with any of the given result IDs.
+
+    :param result_ids: Result IDs sent by workers; None is ignored.
+    :return: A dictionary mapping the result IDs found to their game's ID.
+    """
+    result_ids = {result_id for result_id in result_ids
+                  if result_id is not None}
+    if not result_ids:
+        return {}
+
+    with model.engine.connect() as conn:
+        return {
+            row["result_id"]: row["id"]
+            for row in conn.execute(sqlalchemy.sql.select([
+                model.games.c.id,
+                model.games.c.result_id,
+            ]).where(model.games.c.result_id.in_(result_ids)))
+        }
+
+
+def prepare_game(game_output, users, challenge, result_id=None):
+    """
+    Parse a game's replay and store its artifacts, from the current request.
+
+    :return: A game dictionary suitable for ingest_games.
+    :raises: util.APIError if the replay is missing or cannot be parsed.
+    """
+    replay_name = os.path.basename(game_output["replay"])
+    stats = parse_replay(uploaded_file(
+        replay_name, "Replay file not found in uploaded files."))
     if stats is None:
         raise util.APIError(
             400, message="Replay file cannot be parsed.")
 
     # Store the replay and any error logs
-    replay_key, bucket_class = store_game_artifacts(replay_name, users)
-
-    with model.engine.begin() as conn:
-        total_users = conn.execute(model.total_ranked_users).first()[0]
-        # Sort the users to prevent deadlock in the stored_bot for update lock
-        for user in sorted(users, key=lambda x: x['user_id']):
-            stored_user = conn.execute(
-                sqlalchemy.sql.select([
-                    model.users.c.id.label("user_id"),
-                    model.users.c.on_email_list,
-                    model.users.c.github_email.label("email"),
-                    model.users.c.player_level,
-                    model.users.c.creation_time,
-                    model.users.c.username,
-                    model.organizations.c.organization_name,
-                ]).select_from(model.users.join(
-                    model.organizations,
-                    model.organizations.c.id == model.users.c.organization_id,
-                    isouter=True
-                )).where(model.users.c.id == user["user_id"])
-            ).first()
-
-            stored_bot = conn.execute(
-                sqlalchemy.sql.select([
-                    model.bots.c.version_number,
-                    model.bots.c.language,
-                    model.bots.c.mu,
-                    model.bots.c.sigma,
-                ], for_update=True).where(
-                    (model.bots.c.id == user["bot_id"]) &
-                    (model.bots.c.user_id == user["user_id"])
-                )
-            ).first()
-
-            stored_rank = conn.execute(
-                sqlalchemy.sql.select([
-                    model.ranked_bots_users.c.rank,
-                ]).where(
-                    (model.ranked_bots_users.c.bot_id == user["bot_id"]) &
-                    (model.ranked_bots_users.c.user_id == user["user_id"])
-                )
-            ).first()
-
-            if not stored_user or not stored_bot:
-                raise util.APIError(400, message="User or bot doesn't exist")
-
-            # If the user has submitted a new bot in the meanwhile,
-            # ignore the game
-            if stored_bot["version_number"] != user["version_number"]:
-                return util.response_success({
-                    "message": "User {} has uploaded a new bot, discarding "
-                               "match.".format(user["user_id"])
+    replay_key, bucket_class, manifest = \
+        store_game_artifacts(replay_name, users)
+
+    return {
+        "game_output": game_output,
+        "users": users,
+        "challenge": challenge,
+        "result_id": result_id,
+        "stats": stats,
+        "replay_key": replay_key,
+        "bucket_class": bucket_class,
+        "artifacts": manifest,
+    }
+
+
+def ingest_games(conn, games):
+    """
+    Store the results of a list of games in the database.
+
+    Users and bots for all participants are fetched in bulk, and game rows
+    are written with multi-row inserts. Games are rated in the order
+    given, so a bot appearing in several games is rated starting from its
+    rating after the previous one; the new ratings are stored at the end.
+
+    :param games: A list of games, as returned by prepare_game.
+    :return: A list with a result dictionary per game: with `game_id` if
+    the game was stored, `message` if it was discarded because a bot was
+    replaced in the meantime, or `error` if it was rejected.
+    """
+    if not games:
+        return []
+
+    index = rank_index.get_index(conn)
+    env = rating.competition_environment()
+
+    user_ids = {user["user_id"] for game in games for user in game["users"]}
+    bot_keys = {(user["user_id"], user["bot_id"])
+                for game in games for user in game["users"]}
+
+    stored_users = {
+        row["user_id"]: dict(row)
+        for row in conn.execute(sqlalchemy.sql.select([
+            model.users.c.id.label("user_id"),
+            model.users.c.on_email_list,
+            model.users.c.github_email.label("email"),
+            model.users.c.player_level,
+            model.users.c.creation_time,
+            model.users.c.username,
+            model.organizations.c.organization_name,
+        ]).select_from(model.users.join(
+            model.organizations,
+            model.organizations.c.id == model.users.c.organization_id,
+            isouter=True
+        )).where(model.users.c.id.in_(user_ids)))
+    }
+
+    # Lock the bots in a consistent order to prevent deadlocks between
+    # concurrent uploads
+    stored_bots = {
+        (row["user_id"], row["bot_id"]): dict(row)
+        for row in conn.execute(sqlalchemy.sql.select([
+            model.bots.c.user_id,
+            model.bots.c.id.label("bot_id"),
+            model.bots.c.version_number,
+            model.bots.c.language,
+            model.bots.c.mu,
+            model.bots.c.sigma,
+        ], for_update=True).where(
+            sqlalchemy.tuple_(model.bots.c.user_id, model.bots.c.id)
+            .in_(bot_keys)
+        ).order_by(model.bots.c.user_id, model.bots.c.id))
+    }
+
+    results = []
+    accepted = []
+    rated_bots = {}
+    for game in games:
+        users = game["users"]
+        result = {}
+        results.append(result)
+
+        if any(user["user_id"] not in stored_users or
+               (user["user_id"], user["bot_id"]) not in stored_bots
+               for user in users):
+            result["error"] = "User or bot doesn't exist"
+            continue
+
+        # If the user has submitted a new bot in the meanwhile,
+        # ignore the game
+        outdated = [user for user in users
+                    if stored_bots[(user["user_id"], user["bot_id"])]
+                    ["version_number"] != user["version_number"]]
+        if outdated:
+            result["message"] = "User {} has uploaded a new bot, " \
+                                "discarding match.".format(
+                                    outdated[0]["user_id"])
+            continue
+
+        for user in users:
+            user.update(stored_users[user["user_id"]])
+            user.update(stored_bots[(user["user_id"], user["bot_id"])])
+            rank = index.rank(user["user_id"], user["bot_id"])
+            if rank is None:
+                rank = index.total_ranked_users
+            user["leaderboard_rank"] = rank
+            user["tier"] = index.tier(rank)
+
+        # Update rankings
+        if not game["challenge"]:
+            users.sort(key=lambda user: user["rank"])
+            players = [(user["user_id"], user["bot_id"]) for user in users]
+            ratings = {
+                key: env.create_rating(mu=stored_bots[key]["mu"],
+                                       sigma=stored_bots[key]["sigma"])
+                for key in players
+            }
+            rating.rate_games(env, [players], ratings)
+            for key, new_rating in ratings.items():
+                stored_bots[key]["mu"] = new_rating.mu
+                stored_bots[key]["sigma"] = new_rating.sigma
+                rated_bot = rated_bots.setdefault(key, {
+                    "version_number": stored_bots[key]["version_number"],
+                    "language": stored_bots[key]["language"],
+                    "games_rated": 0,
                 })
+                rated_bot["rating"] = new_rating
+                rated_bot["games_rated"] += 1
+
+        accepted.append((game, result))
 
-            user.update(dict(stored_user))
-            user.update(dict(stored_bot))
-            if stored_rank:
-                user["leaderboard_rank"] = stored_rank["rank"]
-                user["tier"] = util.tier(stored_rank["rank"], total_users)
-            else:
-                user["leaderboard_rank"] = total_users
-                user["tier"] = util.tier(total_users, total_users)
+    store_ratings(conn, rated_bots)
 
+    if accepted:
         # Store game results in database
-        game_id = store_game_results(conn, game_output, stats,
-                                     replay_key, bucket_class,
-                                     users, challenge)
+        game_ids = store_game_results(conn, [game for game, _ in accepted])
         # Store game stats in database
-        store_game_stats(conn, game_output, stats, game_id, users)
-        # Update rankings
-        if not challenge:
-            update_rankings(conn, users)
+        store_game_stats(conn, [game for game, _ in accepted], game_ids)
+        store_game_resources(conn, [game for game, _ in accepted], game_ids)
+        for (game, result), game_id in zip(accepted, game_ids):
+            game["game_id"] = result["game_id"] = game_id
 
-    return util.response_success()
+    return results
+
+
+def uploaded_file(name, missing_message=None):
+    """
+    Get a file uploaded with the current request.
+
+    :param missing_message: The error message if there is no such file.
+    :raises: util.APIError if there is no such file, or several files were
+    uploaded under the name, since they can't be told apart.
+    """
+    files = flask.request.files.getlist(name)
+    if not files:
+        raise util.APIError(
+            400, message=missing_message or
+            "File {} not found in uploaded files.".format(name))
+    if len(files) > 1:
+        raise util.APIError(
+            400, message="Several files were uploaded as {}.".format(name))
+    return files[0]
 
 
 def store_game_artifacts(replay_name, users):
     """
-    Upload the replay and any error logs to object storage.
+    Spool the replay and any error logs for upload to object storage.
 
     `users` should be a list of user objects with the user ID, a flag to
     indicate timeout, and the filename of the error log.
 
-    Returns the key of the replay in object storage and the bucket the replays
-    were saved in.
+    Returns the key of the replay in object storage, the bucket the replays
+    will be saved in, and the manifest of the spooled artifacts. The caller
+    is responsible for enqueueing or discarding the manifest.
     """
     replay_key, _ = os.path.splitext(replay_name)
 
@@ -168,96 +497,96 @@ def store_game_artifacts(replay_name, users):
             bucket_class = 1
             break
 
-    bucket = model.get_replay_bucket(bucket_class)
-    blob = gcloud_storage.Blob(replay_key, bucket, chunk_size=262144)
-    blob.upload_from_file(flask.request.files[replay_name])
+    uploads = [(uploaded_file(replay_name), "replay", bucket_class,
+                replay_key)]
 
     # Store error logs
     for user in users:
         if user["timed_out"]:
-            error_log_name = user["log_name"]
-            if error_log_name not in flask.request.files:
-                raise util.APIError(
-                    400,
-                    message="Error log {} not found in uploaded files."
-                        .format(error_log_name))
+            error_log = uploaded_file(
+                user["log_name"],
+                "Error log {} not found in uploaded files.".format(
+                    user["log_name"]))
 
             error_log_key = user["log_name"] = \
                 replay_key + "_error_log_" + str(user["user_id"])
-            blob = gcloud_storage.Blob(error_log_key,
-                                       model.get_error_log_bucket(),
-                                       chunk_size=262144)
-            blob.upload_from_file(flask.request.files[error_log_name])
+            uploads.append((error_log, "error_log", None, error_log_key))
 
-    return replay_key, bucket_class
+    return replay_key, bucket_class, artifacts.spool(replay_key, uploads)
 
 
-def store_game_results(conn, game_output, stats, replay_key, bucket_class,
-                       users, challenge):
-    """
-    Store the outcome of a game in the database.
-
-    :param game_output: The JSON output of the Halite game environment.
-    :param replay_key: The key of the replay file in object storage.
-    :param bucket_class: Which bucket the replay was stored in.
-    :param users: The list of user objects for this game.
-    :param challenge: The challenge ID for this game, or None.
-    :return game_id: ID of the record in game table
+def store_game_results(conn, games):
     """
+    Store the outcome of a list of games in the database.
 
-    # Store game results in database
-    game_id = conn.execute(model.games.insert().values(
-        replay_name=replay_key,
-        map_width=game_output["map_width"],
-        map_height=game_output["map_height"],
-        map_seed=game_output["map_seed"],
-        map_generator=game_output["map_generator"],
-        time_played=sqlalchemy.sql.func.NOW(),
-        replay_bucket=bucket_class,
-        challenge_id=challenge,
-    )).inserted_primary_key[0]
+    :param games: A list of game dictionaries (see prepare_game), where
+    each user object has been filled in with its stored user and bot data.
+    :return game_ids: IDs of the records in the game table, in order
+    """
+    game_ids = []
+    for game in games:
+        game_output = game["game_output"]
+        # Inserted one at a time, so that we reliably know each ID
+        game_ids.append(conn.execute(model.games.insert().values(
+            replay_name=game["replay_key"],
+            map_width=game_output["map_width"],
+            map_height=game_output["map_height"],
+            map_seed=game_output["map_seed"],
+            map_generator=game_output["map_generator"],
+            time_played=sqlalchemy.sql.func.NOW(),
+            replay_bucket=game["bucket_class"],
+            challenge_id=game["challenge"],
+            artifacts_uploaded=False,
+            result_id=game["result_id"],
+        )).inserted_primary_key[0])
 
     # Initialize the game view stats
-    conn.execute(model.game_view_stats.insert().values(
-        game_id=game_id,
-        views_total=0,
-    ))
-
-    # Update the participants' stats
-    for user in users:
-        conn.execute(model.game_participants.insert().values(
-            game_id=game_id,
-            user_id=user["user_id"],
-            bot_id=user["bot_id"],
-            version_number=user["version_number"],
-            log_name=user["log_name"],
-            rank=user["rank"],
-            # Which player in the game (numbered starting from 0) was
-            # this user?
-            player_index=user["player_tag"],
-            timed_out=user["timed_out"],
-            leaderboard_rank=user["leaderboard_rank"],
-            mu=user["mu"],
-            sigma=user["sigma"]
+    conn.execute(model.game_view_stats.insert(), [{
+        "game_id": game_id,
+        "views_total": 0,
+    } for game_id in game_ids])
+
+    # Store the participants' stats
+    conn.execute(model.game_participants.insert(), [{
+        "game_id": game_id,
+        "user_id": user["user_id"],
+        "bot_id": user["bot_id"],
+        "version_number": user["version_number"],
+        "log_name": user["log_name"],
+        "rank": user["rank"],
+        # Which player in the game (numbered starting from 0) was
+        # this user?
+        "player_index": user["player_tag"],
+        "timed_out": user["timed_out"],
+        "leaderboard_rank": user["leaderboard_rank"],
+        "mu": user["mu"],
+        "sigma": user["sigma"],
+    } for game, game_id in zip(games, game_ids) for user in game["users"]])
+
+    # Increment number of games played
+    games_played = collections.Counter(
+        (user["user_id"], user["bot_id"])
+        for game in games if not game["challenge"]
+        for user in game["users"])
+    for (user_id, bot_id), count in sorted(games_played.items()):
+        conn.execute(model.bots.update().where(
+            (model.bots.c.user_id == user_id) &
+            (model.bots.c.id == bot_id)
+        ).values(
+            games_played=model.bots.c.games_played + count,
         ))
 
-        if not challenge:
-            # Increment number of games played
-            conn.execute(model.bots.update().where(
-                (model.bots.c.user_id == user["user_id"]) &
-                (model.bots.c.id == user["bot_id"])
-            ).values(
-                games_played=model.bots.c.games_played + 1,
-            ))
-
+    for game, game_id in zip(games, game_ids):
         # If this is the user's first timeout, let them know
-        if user["timed_out"]:
-            update_user_timeout(conn, game_id, user)
+        for user in game["users"]:
+            if user["timed_out"]:
+                update_user_timeout(conn, game_id, user)
 
-    if challenge is not None:
-        store_challenge_results(conn, users, challenge, stats)
+        if game["challenge"] is not None:
+            store_challenge_results(conn, game["users"], game["challenge"],
+                                    game["stats"])
 
-    return game_id
+    return game_ids
 
 
 def store_challenge_results(conn, users, challenge, stats):
@@ -310,190 +639,297 @@ def store_challenge_results(conn, users, challenge, stats):
         ).where(model.challenges.c.id == challenge))
 
 
-def store_game_stats(conn, game_output, stats, game_id, users):
+def store_game_stats(conn, games, game_ids):
     """
     Store additional game stats into database.
 
-    :param game_output: The JSON output of the Halite game environment.
-    :param game_id: ID of the current match in game table
-    :param users: The list of user objects for this game.
+    :param games: A list of game dictionaries (see prepare_game).
+    :param game_ids: IDs of the games in the game table, in the same order.
     :return:
     """
     # Store game stats in database
-    conn.execute(model.game_stats.insert().values(
-        game_id=game_id,
-        turns_total=stats.turns_total,
-        planets_destroyed=stats.planets_destroyed,
-        ships_produced=stats.ships_produced,
-        ships_destroyed=stats.ships_destroyed
-    ))
+    conn.execute(model.game_stats.insert(), [{
+        "game_id": game_id,
+        "turns_total": game["stats"].turns_total,
+        "planets_destroyed": game["stats"].planets_destroyed,
+        "ships_produced": game["stats"].ships_produced,
+        "ships_destroyed": game["stats"].ships_destroyed,
+    } for game, game_id in zip(games, game_ids)])
 
     # Use player_tag to get the correct user_id from replay
-    for user in users:
-        player_tag = user["player_tag"]
-        if player_tag in stats.players:
-            conn.execute(model.game_bot_stats.insert().values(
-                game_id=game_id,
-                user_id=user["user_id"],
-                bot_id=user["bot_id"],
-                planets_controlled=stats.players[player_tag].planets_controlled,
-                ships_produced=stats.players[player_tag].ships_produced,
-                ships_alive=stats.players[player_tag].ships_alive,
-                ships_alive_ratio=stats.players[player_tag].ships_alive_ratio,
-                ships_relative_ratio=stats.players[player_tag].ships_relative_ratio,
-                planets_destroyed=stats.players[player_tag].planets_destroyed,
-                attacks_total=stats.players[player_tag].attacks_total
-            ))
-
-
-def decode_replay(replay_file_obj):
+    bot_stats = []
+    for game, game_id in zip(games, game_ids):
+        players = game["stats"].players
+        for user in game["users"]:
+            player_tag = user["player_tag"]
+            if player_tag in players:
+                bot_stats.append({
+                    "game_id": game_id,
+                    "user_id": user["user_id"],
+                    "bot_id": user["bot_id"],
+                    "planets_controlled": players[player_tag].planets_controlled,
+                    "ships_produced": players[player_tag].ships_produced,
+                    "ships_alive": players[player_tag].ships_alive,
+                    "ships_alive_ratio": players[player_tag].ships_alive_ratio,
+                    "ships_relative_ratio": players[player_tag].ships_relative_ratio,
+                    "planets_destroyed": players[player_tag].planets_destroyed,
+                    "attacks_total": players[player_tag].attacks_total,
+                })
+
+    if bot_stats:
+        conn.execute(model.game_bot_stats.insert(), bot_stats)
+
+
+def store_game_resources(conn, games, game_ids):
     """
-    Parse replay file into JSON format.
-    Current replay file format is Zstandard
+    Store the resources bots used in games, as measured by the workers.
+
+    Workers attach a summary (see worker/resource_monitor.py) as `resources`
+    to each user whose bot they could measure. Users without one, or with a
+    malformed one, are skipped rather than rejecting the game.
+
+    :param games: A list of game dictionaries (see prepare_game).
+    :param game_ids: IDs of the games in the game table, in the same order.
+    """
+    bot_resources = []
+    for game, game_id in zip(games, game_ids):
+        for user in game["users"]:
+            resources = user.get("resources")
+            if not isinstance(resources, dict):
+                continue
+            try:
+                bot_resources.append({
+                    "game_id": game_id,
+                    "user_id": user["user_id"],
+                    "bot_id": user["bot_id"],
+                    "worker": str(resources["worker"])[:64],
+                    "cpu_time": max(0.0, float(resources["cpu_time"])),
+                    "peak_memory": max(0, int(resources["peak_memory"])),
+                    "memory_failures": max(
+                        0, int(resources["memory_failures"])),
+                    "throttled_periods": max(
+                        0, int(resources["throttled_periods"])),
+                    "throttled_time": max(
+                        0.0, float(resources["throttled_time"])),
+                })
+            except (KeyError, TypeError, ValueError):
+                continue
+
+    if bot_resources:
+        conn.execute(model.game_bot_resources.insert(), bot_resources)
+
+
+class _ChunkReader(object):
+    """Adapt an iterator of byte chunks to a minimal file-like object."""
+    def __init__(self, chunks):
+        self._chunks = chunks
+        self._buffer = b""
+
+    def read(self, size=-1):
+        while size < 0 or len(self._buffer) < size:
+            chunk = next(self._chunks, None)
+            if chunk is None:
+                break
+            self._buffer += chunk
+
+        if size < 0:
+            size = len(self._buffer)
+        data, self._buffer = self._buffer[:size], self._buffer[size:]
+        return data
+
+
+def parse_replay(replay_file_obj):
+    """
+    Read replay (turn by turn) and compute stats for a match.
+    Current replay file format is Zstandard-compressed JSON.
+
+    The replay is decompressed and parsed as a stream, so that only the
+    final frame's ship counts and planet owners are ever held in memory.
 
     :param replay_file_obj: The replay file (flask.FileStorage).
-    :return: JSON output
+    :return: Interesting stats to put into database, or None if the replay
+    can't be decoded.
     """
-    decoder = zstd.ZstdDecompressor()
+    num_players = 0
+    num_frames = 0
+    ships_produced = collections.Counter()
+    planets_destroyed = collections.Counter()
+    attacks_total = collections.Counter()
+    total_ships_produced = 0
+    total_ships_destroyed = 0
+    total_planets_destroyed = 0
+    # Ship counts and planet owners of the current and the last full frame
+    frame_ships = frame_planets = None
+    last_ships = {}
+    last_planets = {}
+    event = None
+
     # Rewind to the beginning of the file obj, because
     # gcloud might have read it first
     replay_file_obj.seek(0)
-    replay_data = replay_file_obj.read()
+    decoder = zstd.ZstdDecompressor()
+    reader = _ChunkReader(decoder.read_from(replay_file_obj))
     try:
-        decoded_data = decoder.decompress(replay_data)
-        json_data = json.loads(decoded_data.decode('utf-8').strip())
-        return json_data
-    except zstd.ZstdError:
+        for prefix, kind, value in ijson.parse(reader):
+            if prefix == "num_players":
+                num_players = int(value)
+            elif prefix == "frames.item":
+                if kind == "start_map":
+                    num_frames += 1
+                    frame_ships = collections.Counter()
+                    frame_planets = {}
+                elif kind == "end_map":
+                    last_ships = frame_ships
+                    last_planets = frame_planets
+            elif not prefix.startswith("frames.item."):
+                continue
+            elif prefix == "frames.item.events.item":
+                if kind == "start_map":
+                    event = {}
+                elif kind == "end_map":
+                    player_tag = event.get("owner")
+                    if event.get("event") == "spawned":
+                        total_ships_produced += 1
+                        ships_produced[player_tag] += 1
+                    elif event.get("event") == "destroyed":
+                        if event.get("type") == "ship":
+                            total_ships_destroyed += 1
+                        elif event.get("type") == "planet":
+                            total_planets_destroyed += 1
+                            if player_tag:
+                                planets_destroyed[player_tag] += 1
+                    elif event.get("event") == "attack":
+                        attacks_total[player_tag] += 1
+            elif prefix == "frames.item.events.item.event":
+                event["event"] = value
+            elif prefix == "frames.item.events.item.entity.owner":
+                event["owner"] = value
+            elif prefix == "frames.item.events.item.entity.type":
+                event["type"] = value
+            elif prefix.startswith("frames.item.ships."):
+                # Ships are keyed by player, then by ship ID
+                player_key = prefix[len("frames.item.ships."):]
+                if kind == "map_key" and "." not in player_key:
+                    frame_ships[player_key] += 1
+            elif (prefix.startswith("frames.item.planets.") and
+                    prefix.endswith(".owner")):
+                if value is not None:
+                    frame_planets[prefix] = int(value)
+    except (zstd.ZstdError, JSONError):
         # The replay file can't be decoded.
         return None
     finally:
         # Seek the replay file back to start so we can upload it.
         replay_file_obj.seek(0)
 
-
-def parse_replay(replay):
-    """
-    Read replay (turn by turn) and compute stats for a match.
-
-    :param replay: Decoded replay data
-    :return: Interesting stats to put into database
-    """
-    if replay is None:
+    if num_frames == 0:
         return None
 
-    stats = GameStat(replay["num_players"])
-    stats.turns_total = len(replay['frames']) - 1
-    for frame in replay["frames"]:
-        for event in frame.get("events", []):
-            player_tag = event["entity"].get("owner")
-            if event["event"] == "spawned":
-                stats.ships_produced += 1
-                stats.players[player_tag].ships_produced += 1
-            elif event["event"] == "destroyed":
-                if event["entity"]["type"] == "ship":
-                    stats.ships_destroyed += 1
-                elif event["entity"]["type"] == "planet":
-                    stats.planets_destroyed += 1
-                    if player_tag:
-                        stats.players[player_tag].planets_destroyed += 1
-            elif event["event"] == "attack":
-                stats.players[player_tag].attacks_total += 1
-
-    ships_alive_total = sum([len(ships) for ships in replay["frames"][-1]["ships"].values()])
-    for player_tag in stats.players.keys():
-        stats.players[player_tag].ships_alive = len(replay["frames"][-1]["ships"][str(player_tag)])
+    stats = GameStat(num_players)
+    stats.turns_total = num_frames - 1
+    stats.ships_produced = total_ships_produced
+    stats.ships_destroyed = total_ships_destroyed
+    stats.planets_destroyed = total_planets_destroyed
+
+    ships_alive_total = sum(last_ships.values())
+    for player_tag, player in stats.players.items():
+        player.ships_produced = ships_produced[player_tag]
+        player.planets_destroyed = planets_destroyed[player_tag]
+        player.attacks_total = attacks_total[player_tag]
+        player.ships_alive = last_ships[str(player_tag)]
         # use max(1.0, ...) to avoid ZeroDivisionError
-        stats.players[player_tag].ships_alive_ratio = 1.0 * stats.players[player_tag].ships_alive / max(1.0, stats.players[player_tag].ships_produced)
-        stats.players[player_tag].ships_relative_ratio = 1.0 * stats.players[player_tag].ships_alive / max(1.0, ships_alive_total)
+        player.ships_alive_ratio = 1.0 * player.ships_alive / max(1.0, player.ships_produced)
+        player.ships_relative_ratio = 1.0 * player.ships_alive / max(1.0, ships_alive_total)
 
-    for planet in replay["frames"][-1]["planets"].values():
-        if planet["owner"] is not None:
-            stats.players[planet["owner"]].planets_controlled += 1
+    for owner in last_planets.values():
+        if owner in stats.players:
+            stats.players[owner].planets_controlled += 1
 
     return stats
 
 
-def update_rankings(conn, users):
+# Hackathon snapshots are written with a multi-row upsert
+_UPSERT_HACKATHON_SNAPSHOTS = sqlalchemy.sql.text(
+    "INSERT INTO hackathon_snapshot "
+    "(hackathon_id, user_id, bot_id, score, mu, sigma, version_number, "
+    "language, games_played) "
+    "VALUES (:hackathon_id, :user_id, :bot_id, :score, :mu, :sigma, "
+    ":version_number, :language, :games_played) "
+    "ON DUPLICATE KEY UPDATE "
+    "score = VALUES(score), mu = VALUES(mu), sigma = VALUES(sigma), "
+    "version_number = VALUES(version_number), "
+    "language = VALUES(language), "
+    "games_played = games_played + VALUES(games_played)")
+
+
+def store_ratings(conn, bots):
     """
-    Update the rankings via TrueSkill and store in the database.
+    Store new TrueSkill ratings, updating the leaderboard and the
+    snapshots of any running hackathons the bots' users take part in.
 
-    `users` should be a list of user objects with the game rank (which place
-    the user got in the game), the bot's mu and sigma, the user and bot IDs,
-    and the bot version number.
+    :param bots: A dictionary, keyed by (user ID, bot ID), of bot objects
+    with the bot's new rating, its version number and language, and the
+    number of games (`games_rated`) it was rated in.
     """
-    users.sort(key=lambda user: user["rank"])
-    # Set tau and draw_probability to more reasonable values than the defaults
-    if config.COMPETITION_FINALS_PAIRING:
-        trueskill.setup(tau=0.0, draw_probability=0.001)
-    else:
-        trueskill.setup(tau=0.008, draw_probability=0.001)
-    teams = [[trueskill.Rating(mu=user["mu"], sigma=user["sigma"])]
-             for user in users]
-    new_ratings = trueskill.rate(teams)
-    for user, rating in zip(users, new_ratings):
-        new_score = rating[0].mu - 3*rating[0].sigma
-        conn.execute(model.bots.update().where(
-            (model.bots.c.user_id == user["user_id"]) &
-            (model.bots.c.id == user["bot_id"]) &
-            # Filter on version so we don't update the score for an old
-            # version of the bot
-            (model.bots.c.version_number == user["version_number"])
-        ).values(
-            mu=rating[0].mu,
-            sigma=rating[0].sigma,
-            score=new_score,
-        ))
+    if not bots:
+        return
 
-        # Update the hackathon scoring tables
-        hackathons = conn.execute(sqlalchemy.sql.select([
-            model.hackathons.c.id.label("hackathon_id"),
-        ]).select_from(
-            model.hackathon_participants.join(
-                model.hackathons,
-                (model.hackathon_participants.c.hackathon_id == model.hackathons.c.id) &
-                (model.hackathon_participants.c.user_id == user["user_id"])
-            )
-        ).where(
-            (model.hackathons.c.start_date <= sqlalchemy.sql.func.now()) &
-            (model.hackathons.c.end_date > sqlalchemy.sql.func.now())
-        ))
+    rating.store_bot_ratings(conn, {
+        key: (bot["rating"].mu, bot["rating"].sigma)
+        for key, bot in bots.items()
+    })
 
-        for hackathon in hackathons.fetchall():
-            hackathon_id = hackathon["hackathon_id"]
-            try:
-                # Try and insert
-                insert_values = {
-                    "hackathon_id": hackathon_id,
-                    "user_id": user["user_id"],
-                    "bot_id": user["bot_id"],
-                    "score": new_score,
-                    "mu": rating[0].mu,
-                    "sigma": rating[0].sigma,
-                    "version_number": user["version_number"],
-                    "language": user["language"],
-                    "games_played": 1,
-                }
-
-                conn.execute(
-                    model.hackathon_snapshot.insert().values(
-                        **insert_values))
-            except sqlalchemy.exc.IntegrityError:
-                # Row exists, update
-                condition = ((model.hackathon_snapshot.c.hackathon_id ==
-                              hackathon_id) &
-                             (model.hackathon_snapshot.c.user_id ==
-                              user["user_id"]) &
-                             (model.hackathon_snapshot.c.bot_id ==
-                              user["bot_id"]))
-                conn.execute(
-                    model.hackathon_snapshot.update().values(
-                        score=new_score,
-                        mu=rating[0].mu,
-                        sigma=rating[0].sigma,
-                        version_number=user["version_number"],
-                        language=user["language"],
-                        games_played=model.hackathon_snapshot.c.games_played + 1,
-                    ).where(condition))
+    keys = sorted(bots)
+
+    for user_id, bot_id in keys:
+        bot = bots[user_id, bot_id]
+        new_score = rating.score(bot["rating"])
+        ranking.update_score(conn, user_id, bot_id, new_score)
+        ranking_cache.update_rating(user_id, bot_id, bot["version_number"],
+                                    bot["rating"].mu, bot["rating"].sigma,
+                                    new_score)
+
+    # Update the hackathon scoring tables
+    hackathons = conn.execute(sqlalchemy.sql.select([
+        model.hackathon_participants.c.hackathon_id,
+        model.hackathon_participants.c.user_id,
+    ]).select_from(
+        model.hackathon_participants.join(
+            model.hackathons,
+            model.hackathon_participants.c.hackathon_id ==
+            model.hackathons.c.id
+        )
+    ).where(
+        model.hackathon_participants.c.user_id.in_(
+            {user_id for user_id, _ in keys}) &
+        (model.hackathons.c.start_date <= sqlalchemy.sql.func.now()) &
+        (model.hackathons.c.end_date > sqlalchemy.sql.func.now())
+    )).fetchall()
+    hackathons_by_user = collections.defaultdict(list)
+    for hackathon in hackathons:
+        hackathons_by_user[hackathon["user_id"]].append(
+            hackathon["hackathon_id"])
+
+    snapshots = []
+    for user_id, bot_id in keys:
+        bot = bots[user_id, bot_id]
+        for hackathon_id in sorted(hackathons_by_user[user_id]):
+            snapshots.append({
+                "hackathon_id": hackathon_id,
+                "user_id": user_id,
+                "bot_id": bot_id,
+                "score": rating.score(bot["rating"]),
+                "mu": bot["rating"].mu,
+                "sigma": bot["rating"].sigma,
+                "version_number": bot["version_number"],
+                "language": bot["language"],
+                "games_played": bot["games_rated"],
+            })
+    if snapshots:
+        snapshots.sort(key=lambda snapshot: (snapshot["hackathon_id"],
+                                             snapshot["user_id"],
+                                             snapshot["bot_id"]))
+        conn.execute(_UPSERT_HACKATHON_SNAPSHOTS, snapshots)
 
 
 def update_user_timeout(conn, game_id, user):
@@ -1,5 +1,6 @@
 import collections
 import datetime
+import heapq
 import logging
 import random
 
@@ -7,6 +8,8 @@ import sqlalchemy
 
 from .. import config, model, util
 
+from . import ranking_cache
+
 
 def rand_map_size():
     # Pick map size. Duplicate entries are used to weight the
@@ -22,10 +25,22 @@ def rand_map_size():
     return max(map_width, map_height), min(map_width, map_height)
 
 
-def serve_game_task(conn, has_gpu=False):
-    """Try to find a set of players to play a game together."""
+def serve_game_task(conn, has_gpu=False, busy_seeds=(),
+                    busy_challenges=(), start_challenge=True):
+    """
+    Try to find a set of players to play a game together.
+
+    :param busy_seeds: (user ID, bot ID) pairs of bots not to seed a game
+    with, e.g. because they seed a game that is already prepared.
+    :param busy_challenges: IDs of challenges not to play a game for.
+    :param start_challenge: Whether to mark a challenge as playing right
+    away. If False, the caller must call start_challenge_game before
+    handing out the task.
+    :return: The game task (a dictionary as sent to workers), or None.
+    """
     if not config.COMPETITION_FINALS_PAIRING and random.random() < 0.1:
-        result = find_challenge(conn, has_gpu)
+        result = find_challenge(conn, has_gpu, exclude=busy_challenges,
+                                start=start_challenge)
         if result:
             return result
 
@@ -34,13 +49,11 @@ def serve_game_task(conn, has_gpu=False):
 
     # If there is a GPU, only take bots from players who qualify for the GPU.
     # Else, do not run games for players who qualify for one.
-    total_players = conn.execute(model.total_ranked_users).first()[0]
-    thresholds = util.tier_thresholds(total_players)
-    sqlfunc = sqlalchemy.sql.func
-    ranked_users = model.ranked_users_query()
+    snapshot = ranking_cache.get_snapshot(conn)
+    total_players = snapshot.total_ranked_users
     if config.COMPETITION_FINALS_PAIRING:
         last_game_id = conn.execute(sqlalchemy.sql.select([
-                sqlfunc.max(model.games.c.id)
+                sqlalchemy.sql.func.max(model.games.c.id)
             ]).select_from(model.games)).first()[0]
         try:
             cur_final_games = last_game_id - config.LAST_OPEN_GAME
@@ -51,77 +64,51 @@ def serve_game_task(conn, has_gpu=False):
             if start > cur_final_games:
                 break
             finals_rank_limit = cutoff
-        rank_limit = (ranked_users.c.rank <= finals_rank_limit)
+        rank_limit = finals_rank_limit
     else:
-        rank_limit = sqlalchemy.sql.expression.true()
+        rank_limit = None
 
-    seed_filter = rank_limit
+    seed_gpu_enabled = None
     if config.ENFORCE_GPU_SEEDING:
-        if has_gpu:
-            seed_filter = (rank_limit
-                          & (model.ranked_bots_users.c.is_gpu_enabled == True))
-        else:
-            seed_filter = (rank_limit
-                          & (model.ranked_bots_users.c.is_gpu_enabled == False))
+        seed_gpu_enabled = has_gpu
     elif not has_gpu:
         # Even if we don't require that GPU workers only receive games
         # seeded with GPU bots, we still don't want GPU bots to get
         # seeded on a non-GPU worker.
-        seed_filter = (rank_limit
-                       & (model.ranked_bots_users.c.is_gpu_enabled == False))
+        seed_gpu_enabled = False
 
-    seed_player = find_seed_player(conn, ranked_users, seed_filter)
+    seed_player = find_seed_player(conn, snapshot,
+                                   gpu_enabled=seed_gpu_enabled,
+                                   rank_limit=rank_limit,
+                                   exclude=busy_seeds)
     if not seed_player and has_gpu:
         # If there isn't a gpu enabled seed, check for any seed to keep the
         # gpu worker busy
-        seed_player = find_seed_player(conn, ranked_users, rank_limit)
+        seed_player = find_seed_player(conn, snapshot, rank_limit=rank_limit,
+                                       exclude=busy_seeds)
     if not seed_player:
         return
 
-    print(seed_player)
     # Select the rest of the players
     mu_rank_limit = int(5.0 / (0.01 + random.random()) ** 0.65)
 
     logging.info(
         "Matchmaking: seed player: ID {}, mu {}, "
         "maximum rank distance {}".format(
-            seed_player.user_id, seed_player.mu, mu_rank_limit))
+            seed_player["user_id"], seed_player["mu"], mu_rank_limit))
 
     # Find closely matched players
-    player_filter = sqlalchemy.sql.expression.true()
-    if not has_gpu:
-        # if this isn't a gpu enabled worker filter out gpu only bots
-        player_filter = (model.ranked_bots_users.c.is_gpu_enabled == False)
-    close_players = sqlalchemy.sql.select([
-        model.ranked_bots_users.c.user_id,
-        model.ranked_bots_users.c.bot_id,
-        ranked_users.c.username,
-        model.ranked_bots_users.c.rank,
-        ranked_users.c.rank.label("player_rank"),
-        model.ranked_bots_users.c.num_submissions.label("version_number"),
-        model.ranked_bots_users.c.mu,
-    ]).select_from(
-        model.ranked_bots_users.join(
-            model.bots,
-            (model.ranked_bots_users.c.user_id == model.bots.c.user_id) &
-            (model.ranked_bots_users.c.bot_id == model.bots.c.id)
-        ).join(
-            ranked_users,
-            (ranked_users.c.user_id == model.ranked_bots_users.c.user_id)
-        )
-    ).where(
-        (model.bots.c.compile_status == model.CompileStatus.SUCCESSFUL.value) &
-        (~((model.bots.c.user_id == seed_player["user_id"]) &
-           (model.bots.c.id == seed_player["bot_id"]))) &
-        player_filter
-    ).order_by(
-        sqlalchemy.func.abs(model.bots.c.mu - seed_player["mu"])
-    ).limit(mu_rank_limit).alias("muranktable")
+    # if this isn't a gpu enabled worker filter out gpu only bots
+    player_filter = bot_filter(gpu_enabled=None if has_gpu else False)
+    close_players = snapshot.closest_by_mu(
+        seed_player["mu"], mu_rank_limit,
+        lambda bot: player_filter(bot) and not (
+            bot["user_id"] == seed_player["user_id"] and
+            bot["bot_id"] == seed_player["bot_id"]))
 
     # Select more bots than needed, discard ones from same player
-    query = close_players.select().order_by(sqlfunc.rand()) \
-        .limit(player_count * 2)
-    potential_players = conn.execute(query).fetchall()
+    potential_players = random.sample(
+        close_players, min(len(close_players), player_count * 2))
     players = [seed_player]
     player_ids = {seed_player["user_id"]}
     for player in potential_players:
@@ -147,13 +134,66 @@ def serve_game_task(conn, has_gpu=False):
     } for player in players]
 
     if len(players) == player_count:
-        return util.response_success({
+        return {
             "type": "game",
             "width": map_width,
             "height": map_height,
             "users": players,
             "challenge": None,
-        })
+        }
+
+
+def bot_filter(*, gpu_enabled=None, rank_limit=None, exclude=()):
+    """
+    Build a predicate over ranking snapshot bots for matchmaking.
+
+    :param gpu_enabled: If not None, only accept bots whose user's GPU flag
+    matches.
+    :param rank_limit: If not None, only accept bots whose user is ranked
+    at or above this rank.
+    :param exclude: (user ID, bot ID) pairs of bots not to accept.
+    :return: A function taking a snapshot bot and returning a bool.
+    """
+    def _filter(bot):
+        if bot["compile_status"] != model.CompileStatus.SUCCESSFUL.value:
+            return False
+        if (bot["user_id"], bot["bot_id"]) in exclude:
+            return False
+        if gpu_enabled is not None and bot["is_gpu_enabled"] != gpu_enabled:
+            return False
+        if rank_limit is not None and bot["player_rank"] > rank_limit:
+            return False
+        return True
+
+    return _filter
+
+
+def _challenge_available():
+    """A clause matching challenges that a game can be started for."""
+    return (
+        (model.challenges.c.status == model.ChallengeStatus.CREATED.value) |
+        # Also pick up any stuck challenges
+        (
+            (model.challenges.c.status == model.ChallengeStatus.PLAYING_GAME.value) &
+            (model.challenges.c.most_recent_game_task <
+             datetime.datetime.now() - datetime.timedelta(minutes=30))
+        )
+    )
+
+
+def start_challenge_game(conn, challenge_id):
+    """
+    Mark a challenge as playing a game, if it is still available.
+
+    :return: Whether the challenge was available; if not, its game should
+    not be played.
+    """
+    return conn.execute(model.challenges.update().values(
+        status=model.ChallengeStatus.PLAYING_GAME.value,
+        most_recent_game_task=sqlalchemy.sql.func.now(),
+    ).where(
+        (model.challenges.c.id == challenge_id) & _challenge_available()
+    )).rowcount > 0
 
 
 def reset_challenges(conn):
@@ -169,23 +209,24 @@ def reset_challenges(conn):
     conn.execute(reset_stuck_challenges)
 
 
-def find_challenge(conn, has_gpu=False):
+def find_challenge(conn, has_gpu=False, exclude=(), start=True):
     """
     Find a set of players in a challenge.
+
+    :param exclude: IDs of challenges not to consider.
+    :param start: Whether to mark the challenge as playing (see
+    start_challenge_game); otherwise the caller must do so before handing
+    out the task.
     """
     # Reset any stuck challenges
     reset_challenges(conn)
 
+    available = _challenge_available()
+    if exclude:
+        available &= model.challenges.c.id.notin_(list(exclude))
+
     challenge = conn.execute(
-        model.challenges.select(
-            (model.challenges.c.status == model.ChallengeStatus.CREATED.value) |
-            # Also pick up any stuck challenges
-            (
-                (model.challenges.c.status == model.ChallengeStatus.PLAYING_GAME.value) &
-                (model.challenges.c.most_recent_game_task <
-                 datetime.datetime.now() - datetime.timedelta(minutes=30))
-            )
-        ).order_by(
+        model.challenges.select(available).order_by(
             model.challenges.c.most_recent_game_task.asc()
         )
     ).first()
@@ -193,37 +234,18 @@ def find_challenge(conn, has_gpu=False):
     if not challenge:
         return None
 
-    player_filter = sqlalchemy.sql.expression.true()
-    if not has_gpu:
-        player_filter = (model.ranked_bots_users.c.is_gpu_enabled == False)
-
-    total_players = conn.execute(model.total_ranked_users).first()[0]
-    thresholds = util.tier_thresholds(total_players)
-    ranked_users = model.ranked_users_query()
-    bots_query = sqlalchemy.sql.select([
-        model.ranked_bots_users.c.user_id,
-        model.ranked_bots_users.c.bot_id,
-        model.ranked_bots_users.c.username,
-        model.ranked_bots_users.c.rank,
-        model.ranked_bots_users.c.num_submissions.label("version_number"),
-    ]).select_from(
-        model.ranked_bots_users.join(
-            model.bots,
-            (model.ranked_bots_users.c.user_id == model.bots.c.user_id) &
-            (model.ranked_bots_users.c.bot_id == model.bots.c.id)
-        )
-    ).where(
-        (model.bots.c.compile_status == model.CompileStatus.SUCCESSFUL.value) &
-        sqlalchemy.sql.exists(
-            model.challenge_participants.select(
-                (model.ranked_bots.c.user_id == model.challenge_participants.c.user_id) &
-                (model.challenge_participants.c.challenge_id == challenge["id"]) &
-                (model.challenge_participants.c.user_id == model.ranked_bots_users.c.user_id)
-            )
-        ) &
-        player_filter
-    )
-    bots = conn.execute(bots_query).fetchall()
+    snapshot = ranking_cache.get_snapshot(conn)
+    total_players = snapshot.total_ranked_users
+    player_filter = bot_filter(gpu_enabled=None if has_gpu else False)
+    participants = conn.execute(sqlalchemy.sql.select([
+        model.challenge_participants.c.user_id,
+    ]).where(
+        model.challenge_participants.c.challenge_id == challenge["id"]
+    )).fetchall()
+    bots = [bot
+            for participant in participants
+            for bot in snapshot.get_user_bots(participant["user_id"])
+            if player_filter(bot)]
 
     user_bots = collections.defaultdict(list)
     for bot in bots:
@@ -260,27 +282,31 @@ def find_challenge(conn, has_gpu=False):
         "tier": util.tier(player["rank"], total_players),
     } for player in selected_bots]
 
-    conn.execute(model.challenges.update().values(
-        status=model.ChallengeStatus.PLAYING_GAME.value,
-        most_recent_game_task=sqlalchemy.sql.func.now(),
-    ).where(model.challenges.c.id == challenge["id"]))
+    if start and not start_challenge_game(conn, challenge["id"]):
+        # Another coordinator started it in the meantime
+        return None
 
-    return util.response_success({
+    return {
         "type": "game",
         "width": map_width,
         "height": map_height,
         "users": players,
         "challenge": challenge["id"],
-    })
+    }
 
 
-def find_idle_seed_player(conn, ranked_users, seed_filter, restrictions=False):
+def find_idle_seed_player(conn, snapshot, seed_filter, gpu_enabled=None,
+                          restrictions=False, excluded=0):
     """
     Find a seed player that hasn't played recently.
     :param conn:
-    :param seed_filter: SQL expression to limit which players can be used.
+    :param snapshot: The ranking snapshot to take players from.
+    :param seed_filter: Predicate to limit which players can be used.
+    :param gpu_enabled: If not None, only consider users with this GPU flag.
     :param restrictions: If True, additionally restrict number of games
     played by the bot, and sort randomly.
+    :param excluded: How many bots seed_filter excludes by name, so that
+    enough candidates are considered to find others.
     :return:
     """
     # Get all users last time to play a game, and pick a seed player
@@ -291,122 +317,93 @@ def find_idle_seed_player(conn, ranked_users, seed_filter, restrictions=False):
     sqlfunc = sqlalchemy.sql.func
 
     max_time = sqlfunc.max(model.games.c.time_played).label("max_time")
-    user_id = model.game_participants.c.user_id
-    bot_id = model.game_participants.c.bot_id
 
-    gamers_last_play = sqlalchemy.sql.select([
+    # Of those users, select ones with under 400 games, preferring
+    # ones in older games
+    bot_restrictions = (model.bots.c.compile_status ==
+                        model.CompileStatus.SUCCESSFUL.value)
+    if restrictions:
+        bot_restrictions &= model.bots.c.games_played < 400
+    if gpu_enabled is not None:
+        bot_restrictions &= model.users.c.is_gpu_enabled == gpu_enabled
+
+    potential_players = conn.execute(sqlalchemy.sql.select([
         max_time,
-        ranked_users.c.user_id,
-        model.ranked_bots_users.c.bot_id,
-        ranked_users.c.username,
-        ranked_users.c.rank.label("player_rank"),
-        model.ranked_bots_users.c.num_submissions.label("version_number"),
-        model.ranked_bots_users.c.mu,
-        # The database isn't smart enough to know that there is only one rank
-        # value for a given (user_id, bot_id).
-        sqlfunc.any_value(model.ranked_bots_users.c.rank).label('rank'),
+        model.bots.c.user_id,
+        model.bots.c.id.label("bot_id"),
     ]).select_from(
-        ranked_users.join(
-            model.ranked_bots_users,
-            (model.ranked_bots_users.c.user_id
-             == ranked_users.c.user_id)
-            & seed_filter
+        model.bots.join(
+            model.users,
+            model.users.c.id == model.bots.c.user_id
         ).join(
             model.game_participants.join(
                 model.games,
                 model.games.c.id == model.game_participants.c.game_id
             ),
-            (ranked_users.c.user_id == model.game_participants.c.user_id)
-            & (model.ranked_bots_users.c.bot_id
-               == model.game_participants.c.bot_id),
+            (model.bots.c.user_id == model.game_participants.c.user_id) &
+            (model.bots.c.id == model.game_participants.c.bot_id),
             isouter=True
         )
-    ).group_by(ranked_users.c.user_id, model.ranked_bots_users.c.bot_id
-    ).reduce_columns().alias("temptable")
+    ).where(
+        bot_restrictions
+    ).group_by(
+        model.bots.c.user_id, model.bots.c.id
+    ).order_by(max_time.asc()).limit(15 + excluded)).fetchall()
 
-    # Of those users, select ones with under 400 games, preferring
-    # ones in older games, and get their data
-    outer_bots = model.bots.alias("bot")
-    bot_restrictions = (outer_bots.c.compile_status ==
-                        model.CompileStatus.SUCCESSFUL.value)
-    if restrictions:
-        bot_restrictions &= outer_bots.c.games_played < 400
-
-    potential_players = sqlalchemy.sql.select([
-        gamers_last_play.c.user_id,
-        gamers_last_play.c.bot_id,
-        gamers_last_play.c.username,
-        gamers_last_play.c.version_number,
-        gamers_last_play.c.mu,
-        gamers_last_play.c.rank,
-        gamers_last_play.c.player_rank,
-    ]).select_from(
-        gamers_last_play.join(
-            outer_bots,
-            (outer_bots.c.user_id == gamers_last_play.c.user_id) &
-            (outer_bots.c.id == gamers_last_play.c.bot_id))) \
-        .where(bot_restrictions) \
-        .order_by(gamers_last_play.c.max_time.asc()) \
-        .limit(15).alias("orderedtable")
+    candidates = []
+    for player in potential_players:
+        bot = snapshot.get(player["user_id"], player["bot_id"])
+        if bot is not None and seed_filter(bot):
+            candidates.append(bot)
+
+    if not candidates:
+        return None
 
     if restrictions:
         # Then sort them randomly and take one
-        query = potential_players.select().order_by(sqlfunc.rand()).limit(1)
-    else:
-        query = potential_players.select().limit(1)
+        return random.choice(candidates)
 
-    return conn.execute(query).first()
+    return candidates[0]
 
 
-def find_newbie_seed_player(conn, ranked_users, seed_filter):
+def find_newbie_seed_player(snapshot, seed_filter):
     """
     Find a seed player that has not played that many games.
-    :param conn:
-    :param seed_filter: SQL expression to limit which players can be used.
+    :param snapshot: The ranking snapshot to take players from.
+    :param seed_filter: Predicate to limit which players can be used.
     :return:
     """
-    sqlfunc = sqlalchemy.sql.func
-    game_curve = 1 / (model.bots.c.games_played + 1)
-    # weight the curve between half and full weight
-    rand_factor = 0.5 + (sqlfunc.rand() * 0.5)
-    # Since the curve is cut in half every doubling of games, this means a bot
-    # will always be chosen ahead of any bots that have more than twice the
-    # number of games
-    ordering = rand_factor * -game_curve
-    query = sqlalchemy.sql.select([
-        ranked_users.c.user_id,
-        model.bots.c.id.label("bot_id"),
-        ranked_users.c.username,
-        model.ranked_bots_users.c.rank,
-        ranked_users.c.rank.label("player_rank"),
-        model.bots.c.version_number,
-        model.bots.c.mu,
-    ]).select_from(
-        model.ranked_bots_users.join(
-            model.bots,
-            (model.ranked_bots_users.c.user_id == model.bots.c.user_id) &
-            (model.ranked_bots_users.c.bot_id == model.bots.c.id)
-        ).join(
-            ranked_users,
-            model.ranked_bots_users.c.user_id == ranked_users.c.user_id
-        )
-    ).where(
-        (model.bots.c.compile_status == model.CompileStatus.SUCCESSFUL.value) &
-        seed_filter
-    ).order_by(ordering).limit(20).reduce_columns().alias("seed_query").select(
-    ).order_by(sqlfunc.rand())
+    def ordering(bot):
+        game_curve = 1 / (bot["games_played"] + 1)
+        # weight the curve between half and full weight
+        rand_factor = 0.5 + (random.random() * 0.5)
+        # Since the curve is cut in half every doubling of games, this
+        # means a bot will always be chosen ahead of any bots that have more
+        # than twice the number of games
+        return rand_factor * -game_curve
+
+    candidates = heapq.nsmallest(
+        20, filter(seed_filter, snapshot.bots), key=ordering)
+    if not candidates:
+        return None
 
-    return conn.execute(query).first()
+    return random.choice(candidates)
 
 
-def find_seed_player(conn, ranked_users, seed_filter):
+def find_seed_player(conn, snapshot, gpu_enabled=None, rank_limit=None,
+                     exclude=()):
     """
     Find a seed player for a game.
     :param conn: A database connection.
-    :param rank_users: The table clause to base player ranks on.
-    :param seed_filter: A WHERE clause to restrict player ranks.
+    :param snapshot: The ranking snapshot to take players from.
+    :param gpu_enabled: If not None, only seed users with this GPU flag.
+    :param rank_limit: If not None, only seed users ranked at or above this.
+    :param exclude: (user ID, bot ID) pairs of bots not to seed.
     :return: A seed player, or None.
     """
+    seed_filter = bot_filter(gpu_enabled=gpu_enabled, rank_limit=rank_limit,
+                             exclude=exclude)
+
     if not config.COMPETITION_FINALS_PAIRING:
         rand_value = random.random()
 
@@ -415,8 +412,10 @@ def find_seed_player(conn, ranked_users, seed_filter):
             logging.info("Matchmaking: seed player: looking for random bot"
                          " with under 400 games played that hasn't played"
                          " recently")
-            result = find_idle_seed_player(conn, ranked_users, seed_filter,
-                                             restrictions=True)
+            result = find_idle_seed_player(conn, snapshot, seed_filter,
+                                           gpu_enabled=gpu_enabled,
+                                           restrictions=True,
+                                           excluded=len(exclude))
             if result:
                 return result
         # Give 65% of games to lowest games played
@@ -425,44 +424,23 @@ def find_seed_player(conn, ranked_users, seed_filter):
         if rand_value > 0.1:
             logging.info("Matchmaking: seed player: looking for random bot"
                          " with fewest games played")
-            result = find_newbie_seed_player(conn, ranked_users, seed_filter)
+            result = find_newbie_seed_player(snapshot, seed_filter)
             if result:
                 return result
 
         # Give 10% of games to overall user who has least recently played
         logging.info("Matchmaking: seed player: looking for random bot"
                      " that hasn't played recently")
-        result = find_idle_seed_player(conn, ranked_users, seed_filter,
-                                         restrictions=False)
+        result = find_idle_seed_player(conn, snapshot, seed_filter,
+                                       gpu_enabled=gpu_enabled,
+                                       restrictions=False,
+                                       excluded=len(exclude))
         if result:
             return result
     else:
         # For finals take players with least games played
-        least_played = sqlalchemy.sql.select([
-            model.ranked_bots_users.c.user_id,
-            model.ranked_bots_users.c.bot_id,
-            model.ranked_bots_users.c.username,
-            model.ranked_bots_users.c.rank,
-            ranked_users.c.rank.label("player_rank"),
-            model.ranked_bots_users.c.mu,
-            model.ranked_bots_users.c.num_submissions.label("version_number"),
-        ]).select_from(
-            model.ranked_bots_users.join(
-                # This join should have no effect on the result but it makes
-                # the query 30-40 times faster.
-                model.bots,
-                (model.ranked_bots_users.c.user_id == model.bots.c.user_id) &
-                (model.ranked_bots_users.c.bot_id == model.bots.c.id)
-            ).join(
-                ranked_users,
-                (model.ranked_bots_users.c.user_id == ranked_users.c.user_id) &
-                seed_filter
-            )
-        ).where(
-            model.bots.c.compile_status == model.CompileStatus.SUCCESSFUL.value
-        ).order_by(model.bots.c.games_played.asc()
-        ).limit(20).alias("least_played").select().order_by(
-            sqlalchemy.sql.func.rand()
-        ).limit(1)
-
-        return conn.execute(least_played).first()
+        least_played = heapq.nsmallest(
+            20, filter(seed_filter, snapshot.bots),
+            key=lambda bot: bot["games_played"])
+        if least_played:
+            return random.choice(least_played)
@@ -0,0 +1,178 @@
+"""
+Coordinator-local snapshot of the bot rankings, used for matchmaking.
+
+Matchmaking used to rank every bot in MySQL (via ranked_bots_query and
+friends) on every /task call. Instead, we keep an in-memory snapshot of all
+bots in leaderboard order, refreshed periodically from the bot_rank table,
+and answer seed and "close by mu" queries against it.
+"""
+import bisect
+import threading
+import time
+
+import sqlalchemy
+
+from .. import config, model
+
+
+class RankingSnapshot(object):
+    """
+    An immutable-ish view of all bots, ranked by score.
+
+    Each bot is a dictionary with the user and bot IDs, username, version
+    number, mu, sigma, score, games played, compile status, GPU flag, the
+    bot's rank, and the rank of its user (the rank of the user's best bot).
+    """
+    def __init__(self, rows):
+        self.bots = []
+        self._by_key = {}
+        self._by_user = {}
+        player_ranks = {}
+        ranked_users = set()
+
+        # Rows come in sorted by rank
+        for row in rows:
+            bot = {
+                "user_id": row["user_id"],
+                "bot_id": row["bot_id"],
+                "username": row["username"],
+                "version_number": row["version_number"],
+                "mu": row["mu"],
+                "sigma": row["sigma"],
+                "score": row["score"],
+                "games_played": row["games_played"],
+                "compile_status": row["compile_status"],
+                "is_gpu_enabled": bool(row["is_gpu_enabled"]),
+                "rank": row["rank"],
+            }
+            self.bots.append(bot)
+            self._by_key[(bot["user_id"], bot["bot_id"])] = bot
+            self._by_user.setdefault(bot["user_id"], []).append(bot)
+            player_ranks.setdefault(bot["user_id"], bot["rank"])
+            if bot["games_played"] > 0:
+                ranked_users.add(bot["user_id"])
+
+        for bot in self.bots:
+            bot["player_rank"] = player_ranks[bot["user_id"]]
+
+        self.total_ranked_users = len(ranked_users)
+        self._mu_dirty = True
+        self._by_mu = []
+        self._mu_keys = []
+
+    def get(self, user_id, bot_id):
+        """Look up a bot by user and bot ID, or None if it isn't known."""
+        return self._by_key.get((user_id, bot_id))
+
+    def get_user_bots(self, user_id):
+        """List all of a user's bots, best first."""
+        return self._by_user.get(user_id, [])
+
+    def update_rating(self, user_id, bot_id, version_number, mu, sigma, score):
+        """
+        Apply a rating change to the snapshot in place.
+
+        Ranks are not recomputed; they catch up on the next refresh.
+        """
+        bot = self.get(user_id, bot_id)
+        if bot is None or bot["version_number"] != version_number:
+            return
+
+        bot["mu"] = mu
+        bot["sigma"] = sigma
+        bot["score"] = score
+        self._mu_dirty = True
+
+    def _ensure_mu_index(self):
+        if self._mu_dirty:
+            self._by_mu = sorted(self.bots, key=lambda bot: bot["mu"])
+            self._mu_keys = [bot["mu"] for bot in self._by_mu]
+            self._mu_dirty = False
+
+    def closest_by_mu(self, mu, limit, predicate):
+        """
+        Find up to `limit` bots matching `predicate` whose mu is closest to
+        the given mu, nearest first.
+        """
+        self._ensure_mu_index()
+        by_mu = self._by_mu
+
+        result = []
+        right = bisect.bisect_left(self._mu_keys, mu)
+        left = right - 1
+        while len(result) < limit and (left >= 0 or right < len(by_mu)):
+            if right >= len(by_mu) or (
+                    left >= 0 and
+                    mu - by_mu[left]["mu"] <= by_mu[right]["mu"] - mu):
+                candidate = by_mu[left]
+                left -= 1
+            else:
+                candidate = by_mu[right]
+                right += 1
+
+            if predicate(candidate):
+                result.append(candidate)
+
+        return result
+
+
+_snapshot = None
+_snapshot_time = 0
+_lock = threading.Lock()
+
+
+def _load_snapshot(conn):
+    rows = conn.execute(sqlalchemy.sql.select([
+        model.bots.c.user_id,
+        model.bots.c.id.label("bot_id"),
+        model.users.c.username,
+        model.users.c.is_gpu_enabled,
+        model.bots.c.version_number,
+        model.bots.c.mu,
+        model.bots.c.sigma,
+        model.bots.c.score,
+        model.bots.c.games_played,
+        model.bots.c.compile_status,
+        model.bot_ranks.c.rank,
+    ]).select_from(model.bots.join(
+        model.users,
+        model.bots.c.user_id == model.users.c.id,
+    ).join(
+        model.bot_ranks,
+        (model.bot_ranks.c.user_id == model.bots.c.user_id) &
+        (model.bot_ranks.c.bot_id == model.bots.c.id)
+    )).order_by(model.bot_ranks.c.rank)).fetchall()
+
+    return RankingSnapshot(rows)
+
+
+def get_snapshot(conn):
+    """
+    Get the current ranking snapshot, reloading it from the database if it
+    is older than RANKING_CACHE_REFRESH_INTERVAL seconds.
+    """
+    global _snapshot, _snapshot_time
+
+    with _lock:
+        now = time.monotonic()
+        if (_snapshot is None or
+                now - _snapshot_time > config.RANKING_CACHE_REFRESH_INTERVAL):
+            _snapshot = _load_snapshot(conn)
+            _snapshot_time = now
+
+        return _snapshot
+
+
+def update_rating(user_id, bot_id, version_number, mu, sigma, score):
+    """Reflect a bot's new rating in the snapshot, if one is loaded."""
+    with _lock:
+        if _snapshot is not None:
+            _snapshot.update_rating(user_id, bot_id, version_number,
+                                    mu, sigma, score)
+
+
+def invalidate():
+    """Force the snapshot to be reloaded on next use."""
+    global _snapshot
+    with _lock:
+        _snapshot = None
@@ -1,6 +1,7 @@
 import base64
 import binascii
 import io
+import re
 import tempfile
 
 import flask
@@ -9,7 +10,7 @@ import google.cloud.exceptions as gcloud_exceptions
 
 from werkzeug.contrib.cache import FileSystemCache
 
-from .. import config, model, util
+from .. import config, model, replay_cache, util
 
 from .blueprint import coordinator_api
 
@@ -18,6 +19,9 @@ from .blueprint import coordinator_api
 cache_dir = tempfile.TemporaryDirectory()
 cache = FileSystemCache(cache_dir.name, default_timeout=60*5)
 
+# How many times to try fetching a bot that keeps changing meanwhile
+BOT_FETCH_ATTEMPTS = 3
+
 
 @coordinator_api.route("/download/worker", methods=["GET"])
 def download_source_blob():
@@ -67,9 +71,86 @@ def upload_bot():
     return util.response_success()
 
 
+def _cached_bot_name(source_hash):
+    """The name of a compiled bot cached by the hash of its source."""
+    if not source_hash or not re.fullmatch("[0-9a-f]{64}", source_hash):
+        raise util.APIError(400, message="Please provide a valid source hash.")
+    return config.COMPILE_CACHE_PREFIX + source_hash
+
+
+@coordinator_api.route("/compileCache", methods=["POST"])
+def cache_bot():
+    """
+    Cache a bot's compiled bot by the hash of its source, with its
+    language, copying it within object storage.
+    """
+    user_id = flask.request.form.get("user_id", None)
+    bot_id = flask.request.form.get("bot_id", None)
+    name = _cached_bot_name(flask.request.form.get("source_hash"))
+    language = flask.request.form.get("language", "Other")
+
+    if not user_id or not bot_id:
+        raise util.APIError(400, message="Please provide user and bot ID.")
+
+    bucket = model.get_bot_bucket()
+    blob = bucket.get_blob("{}_{}".format(user_id, bot_id))
+    if blob is None:
+        raise util.APIError(404, message="Bot not found.")
+
+    cached_blob = bucket.copy_blob(blob, bucket, name)
+    cached_blob.metadata = {"language": language}
+    cached_blob.patch()
+    return util.response_success()
+
+
+@coordinator_api.route("/compileCache/claim", methods=["POST"])
+def claim_cached_bot():
+    """
+    Use a cached compiled bot for a bot with the same source, copying it
+    into place within object storage.
+
+    Returns the language of the cached bot, or 404 if there is none.
+    """
+    user_id = flask.request.form.get("user_id", None)
+    bot_id = flask.request.form.get("bot_id", None)
+    name = _cached_bot_name(flask.request.form.get("source_hash"))
+
+    if not user_id or not bot_id:
+        raise util.APIError(400, message="Please provide user and bot ID.")
+
+    bucket = model.get_bot_bucket()
+    blob = bucket.get_blob(name)
+    if blob is None:
+        raise util.APIError(404, message="Compiled bot not cached.")
+
+    try:
+        bucket.copy_blob(blob, bucket, "{}_{}".format(user_id, bot_id))
+    except gcloud_exceptions.NotFound:
+        raise util.APIError(404, message="Compiled bot not cached.")
+
+    return util.response_success({
+        "language": (blob.metadata or {}).get("language", "Other"),
+    })
+
+
+def _md5_hex(blob):
+    """The MD5 hash of a blob's contents, as a hex string."""
+    return binascii.hexlify(base64.b64decode(blob.md5_hash)).decode('utf-8')
+
+
 @coordinator_api.route("/botFile", methods=["GET"])
 def download_bot():
-    """Retrieve a compiled or uncompiled bot from object storage."""
+    """
+    Retrieve a compiled or uncompiled bot from object storage.
+
+    Each generation of a bot is fetched once, in chunks, into the local
+    disk cache (see replay_cache.py), and served from there, so resumed
+    downloads only send the rest of the file. The fetched contents are
+    checked against the MD5 hash in the metadata of the generation being
+    served. The hash is sent along in the X-Bot-Hash header and as the
+    ETag, so that workers can check the download, and resume it with Range
+    and If-Range, without another request.
+    """
     user_id = flask.request.values.get("user_id", None)
     bot_id = flask.request.values.get("bot_id", None)
     compile = flask.request.values.get("compile", False)
@@ -80,18 +161,36 @@ def download_bot():
         bucket = model.get_bot_bucket()
 
     # Retrieve from GCloud
-    try:
-        botname = "{}_{}".format(user_id, bot_id)
-        blob = gcloud_storage.Blob(botname,
-                                   bucket, chunk_size=262144)
-        buffer = io.BytesIO()
-        blob.download_to_file(buffer)
-        buffer.seek(0)
-        return flask.send_file(buffer, mimetype="application/zip",
-                               as_attachment=True,
-                               attachment_filename=botname + ".zip")
-    except gcloud_exceptions.NotFound:
-        raise util.APIError(404, message="Bot not found.")
+    botname = "{}_{}".format(user_id, bot_id)
+    for _ in range(BOT_FETCH_ATTEMPTS):
+        blob = bucket.get_blob(botname)
+        if blob is None:
+            raise util.APIError(404, message="Bot not found.")
+        blob.chunk_size = 262144
+
+        try:
+            bot_file, size = replay_cache.open_blob(
+                blob,
+                "bot/{}/{}/{}/{}".format(bucket.name, botname,
+                                         blob.generation, blob.md5_hash),
+                md5_hash=base64.b64decode(blob.md5_hash))
+            break
+        except gcloud_exceptions.NotFound:
+            raise util.APIError(404, message="Bot not found.")
+        except ValueError:
+            # Replaced by a new upload since its metadata was read
+            continue
+    else:
+        raise util.APIError(
+            503, message="Bot changed while being fetched, please retry.")
+
+    bot_hash = _md5_hex(blob)
+    response = util.send_file_range(bot_file, size,
+                                    mimetype="application/zip",
+                                    attachment_filename=botname + ".zip",
+                                    etag=bot_hash)
+    response.headers["X-Bot-Hash"] = bot_hash
+    return response
 
 
 @coordinator_api.route("/botHash")
@@ -114,5 +213,5 @@ def hash_bot():
         raise util.APIError(400, message="Bot does not exist.")
 
     return util.response_success({
-        "hash": binascii.hexlify(base64.b64decode(blob.md5_hash)).decode('utf-8'),
-    })
\ No newline at end of file
+        "hash": _md5_hex(blob),
+    })
@@ -0,0 +1,181 @@
+"""
+Background matchmaking: keep a bounded queue of ready game tasks so that
+/task can hand one out without running matchmaking inside the request.
+
+Separate queues are kept for CPU and GPU workers, since they get different
+seed players. A queue is only refilled while workers of that kind have
+asked for work recently, so we don't matchmake for capabilities nobody has.
+Workers may wait for a task to become ready (long polling), so that idle
+workers don't each keep asking for one.
+
+Tasks are made from the same ranking snapshot until it expires, so the
+bots seeding queued tasks and the challenges they are for are tracked, and
+not used for another task until theirs is taken. A challenge is only
+marked as playing when its task is handed out.
+"""
+import collections
+import logging
+import queue
+import threading
+import time
+
+import sqlalchemy
+
+from .. import config, model
+
+from .matchmaking import serve_game_task, start_challenge_game
+
+
+# Keyed by whether the task is for a GPU worker
+_queues = {
+    False: queue.Queue(maxsize=config.TASK_QUEUE_SIZE),
+    True: queue.Queue(maxsize=config.TASK_QUEUE_SIZE),
+}
+# When a worker of each kind last asked for a game task
+_last_demand = {
+    False: None,
+    True: None,
+}
+# Set when a task is taken, so the producer refills promptly
+_wakeup = threading.Event()
+# Seed bots ((user ID, bot ID) pairs) and challenge IDs of queued tasks
+_queued_seeds = collections.Counter()
+_queued_challenges = collections.Counter()
+_queued_lock = threading.Lock()
+
+_producer = None
+_producer_lock = threading.Lock()
+
+
+def _wants_tasks(has_gpu, now):
+    last_demand = _last_demand[has_gpu]
+    return (last_demand is not None and
+            now - last_demand < config.TASK_QUEUE_DEMAND_WINDOW)
+
+
+def _track(task, count):
+    """Add (count=1) or remove (count=-1) a task's seed or challenge."""
+    with _queued_lock:
+        if task["challenge"] is not None:
+            queued, key = _queued_challenges, task["challenge"]
+        else:
+            # The seed player comes first
+            seed = task["users"][0]
+            queued, key = _queued_seeds, (seed["user_id"], seed["bot_id"])
+        queued[key] += count
+        if queued[key] <= 0:
+            del queued[key]
+
+
+def _produce():
+    """Refill the task queues forever."""
+    while True:
+        produced = False
+        for has_gpu, task_queue in _queues.items():
+            if task_queue.full() or not _wants_tasks(has_gpu, time.monotonic()):
+                continue
+
+            with _queued_lock:
+                busy_seeds = set(_queued_seeds)
+                busy_challenges = set(_queued_challenges)
+
+            try:
+                with model.engine.connect() as conn:
+                    task = serve_game_task(conn, has_gpu=has_gpu,
+                                           busy_seeds=busy_seeds,
+                                           busy_challenges=busy_challenges,
+                                           start_challenge=False)
+            except Exception:
+                logging.exception("Matchmaking: could not produce game task")
+                task = None
+
+            if task:
+                _track(task, 1)
+                try:
+                    task_queue.put_nowait((time.monotonic(), task))
+                    produced = True
+                except queue.Full:
+                    _track(task, -1)
+
+        if not produced:
+            _wakeup.wait(config.TASK_QUEUE_IDLE_WAIT)
+            _wakeup.clear()
+
+
+def _ensure_producer():
+    global _producer
+    with _producer_lock:
+        if _producer is None or not _producer.is_alive():
+            _producer = threading.Thread(target=_produce,
+                                         name="matchmaking-producer",
+                                         daemon=True)
+            _producer.start()
+
+
+def is_task_current(conn, task):
+    """
+    Check that every bot in a prepared game task is still playable, i.e.
+    the bot still exists, is compiled, and hasn't been replaced by a new
+    version since the task was made.
+    """
+    users = task["users"]
+    bots = conn.execute(sqlalchemy.sql.select([
+        model.bots.c.user_id,
+        model.bots.c.id,
+        model.bots.c.version_number,
+        model.bots.c.compile_status,
+    ]).where(
+        sqlalchemy.tuple_(model.bots.c.user_id, model.bots.c.id).in_([
+            (user["user_id"], user["bot_id"]) for user in users
+        ])
+    )).fetchall()
+
+    current = {
+        (bot["user_id"], bot["id"]): bot["version_number"]
+        for bot in bots
+        if bot["compile_status"] == model.CompileStatus.SUCCESSFUL.value
+    }
+    return all(current.get((user["user_id"], user["bot_id"])) ==
+               user["version_number"]
+               for user in users)
+
+
+def pop_task(has_gpu=False, wait=0):
+    """
+    Take a prepared game task for a worker, or None if none is ready.
+
+    Tasks that have sat in the queue too long, that reference a bot
+    version that is no longer current, or whose challenge was started
+    elsewhere, are discarded.
+
+    :param wait: How many seconds to wait for a task to become ready, if
+    there is none. No database connection is held while waiting.
+    """
+    deadline = time.monotonic() + wait
+    _ensure_producer()
+    # Let the producer know there is demand right away
+    _wakeup.set()
+
+    task_queue = _queues[has_gpu]
+    try:
+        while True:
+            now = time.monotonic()
+            _last_demand[has_gpu] = now
+            created, task = task_queue.get(timeout=max(0, deadline - now))
+            _track(task, -1)
+            if time.monotonic() - created > config.TASK_QUEUE_MAX_AGE:
+                continue
+            with model.engine.connect() as conn:
+                if not is_task_current(conn, task):
+                    logging.info("Matchmaking: discarding outdated game task")
+                    continue
+                if (task["challenge"] is not None and
+                        not start_challenge_game(conn, task["challenge"])):
+                    logging.info("Matchmaking: discarding game task for a "
+                                 "challenge that was already started")
+                    continue
+            return task
+    except queue.Empty:
+        return None
+    finally:
+        _wakeup.set()
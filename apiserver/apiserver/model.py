@@ -35,9 +35,11 @@ leagues = sqlalchemy.Table("leagues", metadata, autoload=True)
 user_notifications = sqlalchemy.Table("user_notification", metadata, autoload=True)
 bots = sqlalchemy.Table("bot", metadata, autoload=True)
 bot_history = sqlalchemy.Table("bot_history", metadata, autoload=True)
+bot_ranks = sqlalchemy.Table("bot_rank", metadata, autoload=True)
 games = sqlalchemy.Table("game", metadata, autoload=True)
 game_stats = sqlalchemy.Table("game_stat", metadata, autoload=True)
 game_view_stats = sqlalchemy.Table("game_view_stat", metadata, autoload=True)
+game_bot_resources = sqlalchemy.Table("game_bot_resource", metadata, autoload=True)
 game_bot_stats = sqlalchemy.Table("game_bot_stat", metadata, autoload=True)
 game_participants = sqlalchemy.Table("game_participant", metadata, autoload=True)
 hackathons = sqlalchemy.Table("hackathon", metadata, autoload=True)
@@ -46,17 +48,17 @@ hackathon_snapshot = sqlalchemy.Table("hackathon_snapshot", metadata, autoload=T
 challenges = sqlalchemy.Table("challenge", metadata, autoload=True)
 challenge_participants = sqlalchemy.Table("challenge_participant", metadata, autoload=True)
 
-def ranked_bots_query(variable="rank", alias="ranked_bots"):
+def ranked_bots_query(alias="ranked_bots"):
     """
     Builds a query that ranks all bots.
 
-    This is a function in case you need this as a subquery multiple times,
-    and would like to avoid reusing the same SQL variable.
-
-    Unfortunately, MySQL does not support SQL variables in views.
+    Ranks are read from the bot_rank table, which is kept up to date as
+    scores change (see ranking.py), so this does not sort the bots table.
+    Bots without a bot_rank row yet are listed last, without a rank.
     """
     return sqlalchemy.sql.select([
-        sqlalchemy.sql.text("(@{v}:=@{v} + 1) AS bot_rank".format(v=variable)),
+        bot_ranks.c.rank.label("bot_rank"),
+        bot_ranks.c.tier,
         bots.c.user_id,
         bots.c.id.label("bot_id"),
         bots.c.mu,
@@ -67,9 +69,12 @@ def ranked_bots_query(variable="rank", alias="ranked_bots"):
         bots.c.language,
         bots.c.update_time,
         bots.c.compile_status,
-    ]).select_from(bots).select_from(sqlalchemy.sql.select([
-        sqlalchemy.sql.text("@{}:=0".format(variable))
-    ]).alias("rn")).order_by(bots.c.score.desc()).alias(alias)
+    ]).select_from(bots.join(
+        bot_ranks,
+        (bot_ranks.c.user_id == bots.c.user_id) &
+        (bot_ranks.c.bot_id == bots.c.id),
+        isouter=True,
+    )).order_by(bot_ranks.c.rank.is_(None), bot_ranks.c.rank).alias(alias)
 
 
 def hackathon_ranked_bots_query(hackathon_id,
@@ -179,7 +184,7 @@ ranked_bots_users = sqlalchemy.sql.select([
 
 # Users, ranked by their best bot
 def ranked_users_query(alias="ranked_users"):
-    ranked_bots = ranked_bots_query("rurank")
+    ranked_bots = ranked_bots_query()
     return sqlalchemy.sql.select([
         users.c.id.label("user_id"),
         users.c.username,
@@ -0,0 +1,202 @@
+"""
+In-process order-statistic index over bot scores.
+
+Bots are grouped into fixed-width score buckets, and a Fenwick tree over the
+buckets (highest scores first) counts the bots in each, so the number of
+bots scoring above any score is found in O(log n). Each bucket keeps its
+bots sorted by score, to order bots within it.
+
+Bots are ranked as in the bot_rank table: by score, highest first, with
+ties broken by user ID and then bot ID, so every bot has a rank of its own.
+The index is updated in place
+as scores change in this process (see ranking.py), and reloaded from the
+database periodically to pick up changes made elsewhere.
+"""
+import bisect
+import math
+import threading
+import time
+
+import sqlalchemy
+
+from . import config, model, util
+
+
+class _FenwickTree(object):
+    """Prefix sums over a fixed number of counters, 1-indexed."""
+    def __init__(self, size):
+        self.size = size
+        self._tree = [0] * (size + 1)
+
+    def add(self, index, delta):
+        while index <= self.size:
+            self._tree[index] += delta
+            index += index & -index
+
+    def prefix(self, index):
+        """Sum of counters 1..index."""
+        total = 0
+        while index > 0:
+            total += self._tree[index]
+            index -= index & -index
+        return total
+
+
+class RankIndex(object):
+    """
+    An order-statistic index of bots by score.
+
+    :param rows: Rows with the user ID, bot ID, score and games played of
+    every bot.
+    """
+    def __init__(self, rows):
+        rows = list(rows)
+        scores = [row["score"] for row in rows] or [0]
+        width = config.RANK_INDEX_BUCKET_WIDTH
+        # Leave room for scores to move before they fall in an edge bucket
+        self._max_score = max(scores) + config.RANK_INDEX_SCORE_MARGIN
+        min_score = min(scores) - config.RANK_INDEX_SCORE_MARGIN
+        self._width = width
+        num_buckets = int(math.ceil((self._max_score - min_score) / width)) + 1
+
+        # Lookups and updates come from different request threads
+        self._lock = threading.RLock()
+        self._tree = _FenwickTree(num_buckets)
+        # Each bucket is a sorted list of (-score, user ID, bot ID)
+        self._buckets = [[] for _ in range(num_buckets)]
+        self._scores = {}
+        # Bots that have played a game, by user, to count ranked users
+        self._played = {}
+
+        for row in rows:
+            key = (row["user_id"], row["bot_id"])
+            self._insert(key, row["score"])
+            if row["games_played"] > 0:
+                self._played.setdefault(row["user_id"], set()).add(key)
+
+    def _bucket(self, score):
+        """The 1-based bucket of a score; edge buckets hold anything beyond."""
+        index = int((self._max_score - score) // self._width) + 1
+        return min(max(index, 1), self._tree.size)
+
+    def _insert(self, key, score):
+        bucket = self._bucket(score)
+        bisect.insort(self._buckets[bucket - 1], (-score,) + key)
+        self._tree.add(bucket, 1)
+        self._scores[key] = score
+
+    def _remove(self, key):
+        score = self._scores.pop(key)
+        bucket = self._bucket(score)
+        entries = self._buckets[bucket - 1]
+        del entries[bisect.bisect_left(entries, (-score,) + key)]
+        self._tree.add(bucket, -1)
+
+    def __len__(self):
+        return len(self._scores)
+
+    @property
+    def total_ranked_users(self):
+        """The number of users with a bot that has played a game."""
+        with self._lock:
+            return len(self._played)
+
+    def update(self, user_id, bot_id, score, played=False):
+        """Set a bot's score, adding the bot if it isn't indexed yet."""
+        key = (user_id, bot_id)
+        with self._lock:
+            if key in self._scores:
+                self._remove(key)
+            self._insert(key, score)
+            if played:
+                self._played.setdefault(user_id, set()).add(key)
+
+    def remove(self, user_id, bot_id):
+        """Remove a bot from the index, if it is indexed."""
+        key = (user_id, bot_id)
+        with self._lock:
+            if key in self._scores:
+                self._remove(key)
+            played = self._played.get(user_id)
+            if played is not None:
+                played.discard(key)
+                if not played:
+                    del self._played[user_id]
+
+    def rank_of_score(self, score, user_id, bot_id):
+        """The rank a bot would have with the given score."""
+        bucket = self._bucket(score)
+        with self._lock:
+            return (1 + self._tree.prefix(bucket - 1) +
+                    bisect.bisect_left(self._buckets[bucket - 1],
+                                       (-score, user_id, bot_id)))
+
+    def rank(self, user_id, bot_id):
+        """The rank of a bot, or None if it isn't indexed."""
+        with self._lock:
+            score = self._scores.get((user_id, bot_id))
+            if score is None:
+                return None
+            return self.rank_of_score(score, user_id, bot_id)
+
+    def tier(self, rank):
+        """The tier of a rank, given the current number of ranked users."""
+        return util.tier(rank, self.total_ranked_users)
+
+    def tier_thresholds(self):
+        """The lowest rank that fits each tier."""
+        return util.tier_thresholds(self.total_ranked_users)
+
+
+_index = None
+_index_time = 0
+_lock = threading.Lock()
+
+
+def _load_index(conn):
+    rows = conn.execute(sqlalchemy.sql.select([
+        model.bots.c.user_id,
+        model.bots.c.id.label("bot_id"),
+        model.bots.c.score,
+        model.bots.c.games_played,
+    ])).fetchall()
+
+    return RankIndex(rows)
+
+
+def get_index(conn):
+    """
+    Get the rank index, reloading it from the database if it is older than
+    RANK_INDEX_REFRESH_INTERVAL seconds.
+    """
+    global _index, _index_time
+
+    with _lock:
+        now = time.monotonic()
+        if (_index is None or
+                now - _index_time > config.RANK_INDEX_REFRESH_INTERVAL):
+            _index = _load_index(conn)
+            _index_time = now
+
+        return _index
+
+
+def update(user_id, bot_id, score, played=False):
+    """Reflect a bot's new score in the index, if one is loaded."""
+    with _lock:
+        if _index is not None:
+            _index.update(user_id, bot_id, score, played=played)
+
+
+def remove(user_id, bot_id):
+    """Remove a bot from the index, if one is loaded."""
+    with _lock:
+        if _index is not None:
+            _index.remove(user_id, bot_id)
+
+
+def invalidate():
+    """Force the index to be reloaded on next use."""
+    global _index
+    with _lock:
+        _index = None
@@ -0,0 +1,354 @@
+"""
+Maintenance of the materialized leaderboard (the bot_rank table).
+
+Every bot has a row in bot_rank holding its score, its rank and its tier.
+Bots are ranked by score, highest first, with ties broken by user ID and
+then bot ID, so every bot has a rank of its own.
+
+When a score changes (or a bot is added or removed), only the bots ranked
+between the bot's old and new place shift by one, along with their tiers.
+The new place is found from the bot ranked right ahead of it, which is
+locked, so concurrent changes don't compute their places from ranks that
+are about to change. When the tier thresholds move (as users are ranked for
+the first time), every tier is recomputed, without re-sorting, by the next
+change made after the move reaches the rank index.
+
+In case ranks ever drift from the scores anyway, refresh() repairs them in
+the background every RANK_REFRESH_INTERVAL seconds, and
+scripts/rebuild_bot_rank.py rebuilds the table from scratch.
+
+The in-process rank index (rank_index.py) is kept in step with the scores;
+changes made within index_updates_on_commit only reach it once the
+transaction they were made in commits.
+"""
+import contextlib
+import logging
+import threading
+import time
+
+import sqlalchemy
+
+from . import config, model, rank_index
+
+
+# Rank index updates held back until the current thread's transaction
+# commits (see index_updates_on_commit)
+_pending = threading.local()
+
+# The tier thresholds this process last computed every tier with
+_last_thresholds = None
+
+_refresher = None
+_refresher_lock = threading.Lock()
+
+
+@contextlib.contextmanager
+def index_updates_on_commit():
+    """
+    Hold back the rank index updates this thread makes within, applying
+    them once the block exits without an error. Wrap the transaction the
+    changes are made in.
+    """
+    _pending.updates = []
+    try:
+        yield
+        updates = _pending.updates
+    finally:
+        _pending.updates = None
+
+    for update, args in updates:
+        update(*args)
+
+
+def _update_index(update, *args):
+    updates = getattr(_pending, "updates", None)
+    if updates is None:
+        update(*args)
+    else:
+        updates.append((update, args))
+
+
+def _tier_case(thresholds, rank):
+    """Build a SQL expression computing the tier of a rank, like util.tier."""
+    return sqlalchemy.case([
+        (rank <= threshold, tier)
+        for tier, threshold in sorted(thresholds.items(),
+                                      key=lambda item: item[1])
+    ], else_=config.TIER_4_NAME)
+
+
+def _refresh_tiers(conn, index):
+    """Recompute every tier if the tier thresholds have moved."""
+    global _last_thresholds
+
+    thresholds = index.tier_thresholds()
+    if thresholds == _last_thresholds:
+        return
+
+    tier = _tier_case(thresholds, model.bot_ranks.c.rank)
+    conn.execute(model.bot_ranks.update().where(
+        model.bot_ranks.c.tier.is_(None) | (model.bot_ranks.c.tier != tier)
+    ).values(tier=tier))
+    _last_thresholds = thresholds
+
+
+def _bot_clause(user_id, bot_id):
+    return ((model.bot_ranks.c.user_id == user_id) &
+            (model.bot_ranks.c.bot_id == bot_id))
+
+
+def _ranked_ahead(score, user_id, bot_id):
+    """A clause matching the bots ranked ahead of the given score and bot."""
+    return ((model.bot_ranks.c.score > score) |
+            ((model.bot_ranks.c.score == score) &
+             ((model.bot_ranks.c.user_id < user_id) |
+              ((model.bot_ranks.c.user_id == user_id) &
+               (model.bot_ranks.c.bot_id < bot_id)))))
+
+
+def _rank_ahead(conn, score, user_id, bot_id):
+    """
+    Find the rank of the bot that would be ranked right ahead of the given
+    one with the given score, locking it, or 0 if there is none.
+    """
+    row = conn.execute(sqlalchemy.sql.select([
+        model.bot_ranks.c.rank,
+    ], for_update=True).where(
+        _ranked_ahead(score, user_id, bot_id) &
+        sqlalchemy.not_(_bot_clause(user_id, bot_id))
+    ).order_by(
+        model.bot_ranks.c.score.asc(),
+        model.bot_ranks.c.user_id.desc(),
+        model.bot_ranks.c.bot_id.desc(),
+    ).limit(1)).first()
+    return row["rank"] if row else 0
+
+
+def _shift(conn, index, low_rank, high_rank, delta):
+    """Move the bots ranked between two ranks (inclusive) by delta places."""
+    if low_rank > high_rank:
+        return
+
+    rank = model.bot_ranks.c.rank
+    conn.execute(model.bot_ranks.update().where(
+        (rank >= low_rank) & (rank <= high_rank)
+    ).values(
+        rank=rank + delta,
+        tier=_tier_case(index.tier_thresholds(), rank + delta),
+    ))
+
+
+def insert_bot(conn, user_id, bot_id, score=0):
+    """Add a newly created bot to the leaderboard."""
+    index = rank_index.get_index(conn)
+    _refresh_tiers(conn, index)
+    rank = _rank_ahead(conn, score, user_id, bot_id) + 1
+    # Everyone from that place on drops a place
+    conn.execute(model.bot_ranks.update().where(
+        model.bot_ranks.c.rank >= rank
+    ).values(
+        rank=model.bot_ranks.c.rank + 1,
+        tier=_tier_case(index.tier_thresholds(), model.bot_ranks.c.rank + 1),
+    ))
+    conn.execute(model.bot_ranks.insert().values(
+        user_id=user_id,
+        bot_id=bot_id,
+        score=score,
+        rank=rank,
+        tier=index.tier(rank),
+    ))
+    _update_index(rank_index.update, user_id, bot_id, score)
+
+
+def remove_bot(conn, user_id, bot_id):
+    """Remove a bot from the leaderboard, before the bot is deleted."""
+    bot = conn.execute(model.bot_ranks.select(
+        _bot_clause(user_id, bot_id), for_update=True)).first()
+    if bot:
+        index = rank_index.get_index(conn)
+        _refresh_tiers(conn, index)
+        conn.execute(model.bot_ranks.delete().where(
+            _bot_clause(user_id, bot_id)))
+        # Everyone behind moves up a place
+        conn.execute(model.bot_ranks.update().where(
+            model.bot_ranks.c.rank > bot["rank"]
+        ).values(
+            rank=model.bot_ranks.c.rank - 1,
+            tier=_tier_case(index.tier_thresholds(),
+                            model.bot_ranks.c.rank - 1),
+        ))
+    _update_index(rank_index.remove, user_id, bot_id)
+
+
+def update_score(conn, user_id, bot_id, score):
+    """Move a bot on the leaderboard after it played a game."""
+    bot = conn.execute(model.bot_ranks.select(
+        _bot_clause(user_id, bot_id), for_update=True)).first()
+    if not bot:
+        insert_bot(conn, user_id, bot_id, score)
+    elif score != bot["score"]:
+        index = rank_index.get_index(conn)
+        _refresh_tiers(conn, index)
+        old_rank = bot["rank"]
+        rank_ahead = _rank_ahead(conn, score, user_id, bot_id)
+        if rank_ahead < old_rank:
+            # Bots we overtook drop a place
+            rank = rank_ahead + 1
+            _shift(conn, index, rank, old_rank - 1, 1)
+        else:
+            # Bots that overtook us move up a place
+            rank = rank_ahead
+            _shift(conn, index, old_rank + 1, rank, -1)
+
+        conn.execute(model.bot_ranks.update().where(
+            _bot_clause(user_id, bot_id)
+        ).values(
+            score=score,
+            rank=rank,
+            tier=index.tier(rank),
+        ))
+    _update_index(rank_index.update, user_id, bot_id, score, True)
+
+
+def _ranked_rows(conn):
+    """
+    Read every bot, with its bot_rank row if it has one, in leaderboard
+    order (by the score in bot_rank, if any).
+    """
+    score = sqlalchemy.sql.func.coalesce(model.bot_ranks.c.score,
+                                         model.bots.c.score)
+    return conn.execute(sqlalchemy.sql.select([
+        model.bots.c.user_id,
+        model.bots.c.id.label("bot_id"),
+        score.label("score"),
+        model.bot_ranks.c.rank,
+        model.bot_ranks.c.tier,
+    ]).select_from(model.bots.join(
+        model.bot_ranks,
+        (model.bot_ranks.c.user_id == model.bots.c.user_id) &
+        (model.bot_ranks.c.bot_id == model.bots.c.id),
+        isouter=True,
+    )).order_by(
+        score.desc(), model.bots.c.user_id, model.bots.c.id,
+    )).fetchall()
+
+
+def refresh():
+    """
+    Repair ranks and tiers that drifted from the scores in bot_rank, and add
+    any bots missing from it.
+
+    Bots are read without locking anything. Rows that need repairing are
+    then written in batches of RANK_REFRESH_BATCH_SIZE, each in its own
+    transaction and in primary key order. Only ranks and tiers are
+    written, and only to rows whose rank and score haven't changed since
+    they were read, so that changes made in the meantime are kept.
+
+    :return: The number of rows written.
+    """
+    with model.engine.connect() as conn:
+        rows = _ranked_rows(conn)
+        index = rank_index.get_index(conn)
+
+        changed = []
+        missing = []
+        for position, row in enumerate(rows):
+            rank = position + 1
+            tier = index.tier(rank)
+            if row["rank"] is None:
+                missing.append({
+                    "user_id": row["user_id"],
+                    "bot_id": row["bot_id"],
+                    "score": row["score"],
+                    "rank": rank,
+                    "tier": tier,
+                })
+            elif row["rank"] != rank or row["tier"] != tier:
+                changed.append({
+                    "b_user_id": row["user_id"],
+                    "b_bot_id": row["bot_id"],
+                    "b_score": row["score"],
+                    "b_old_rank": row["rank"],
+                    "b_rank": rank,
+                    "b_tier": tier,
+                })
+
+        changed.sort(key=lambda row: (row["b_user_id"], row["b_bot_id"]))
+        update = model.bot_ranks.update().where(
+            (model.bot_ranks.c.user_id == sqlalchemy.bindparam("b_user_id")) &
+            (model.bot_ranks.c.bot_id == sqlalchemy.bindparam("b_bot_id")) &
+            (model.bot_ranks.c.rank == sqlalchemy.bindparam("b_old_rank")) &
+            (model.bot_ranks.c.score == sqlalchemy.bindparam("b_score"))
+        ).values(
+            rank=sqlalchemy.bindparam("b_rank"),
+            tier=sqlalchemy.bindparam("b_tier"),
+        )
+        batch_size = config.RANK_REFRESH_BATCH_SIZE
+        for start in range(0, len(changed), batch_size):
+            with conn.begin():
+                conn.execute(update, changed[start:start + batch_size])
+
+        missing.sort(key=lambda row: (row["user_id"], row["bot_id"]))
+        for start in range(0, len(missing), batch_size):
+            with conn.begin():
+                # A bot may have been added in the meantime
+                conn.execute(model.bot_ranks.insert().prefix_with("IGNORE"),
+                             missing[start:start + batch_size])
+
+    return len(changed) + len(missing)
+
+
+def _refresh_forever():
+    while True:
+        time.sleep(config.RANK_REFRESH_INTERVAL)
+        try:
+            repaired = refresh()
+        except Exception:
+            logging.exception("Could not repair the leaderboard ranks")
+            continue
+        if repaired:
+            logging.warning("Repaired {} leaderboard ranks".format(repaired))
+
+
+def ensure_refresher():
+    """Start repairing ranks in the background, if not yet started."""
+    global _refresher
+    with _refresher_lock:
+        if _refresher is None or not _refresher.is_alive():
+            _refresher = threading.Thread(target=_refresh_forever,
+                                          name="rank-refresher",
+                                          daemon=True)
+            _refresher.start()
+
+
+def rebuild(conn):
+    """
+    Recompute the whole leaderboard from the bot table.
+
+    :return: The number of ranked bots.
+    """
+    global _last_thresholds
+
+    rows = conn.execute(sqlalchemy.sql.select([
+        model.bots.c.user_id,
+        model.bots.c.id,
+        model.bots.c.score,
+    ]).order_by(model.bots.c.score.desc(), model.bots.c.user_id,
+                model.bots.c.id)).fetchall()
+
+    rank_index.invalidate()
+    index = rank_index.get_index(conn)
+    ranks = [{
+        "user_id": row["user_id"],
+        "bot_id": row["id"],
+        "score": row["score"],
+        "rank": position + 1,
+        "tier": index.tier(position + 1),
+    } for position, row in enumerate(rows)]
+
+    conn.execute(model.bot_ranks.delete())
+    if ranks:
+        conn.execute(model.bot_ranks.insert(), ranks)
+    _last_thresholds = index.tier_thresholds()
+
+    return len(ranks)
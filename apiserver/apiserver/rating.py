@@ -0,0 +1,120 @@
+"""
+TrueSkill rating of games.
+
+TrueSkill environments are built once per set of parameters and reused,
+instead of reconfiguring trueskill's global environment for every game.
+"""
+import functools
+import math
+
+import sqlalchemy
+import trueskill
+
+from . import config
+
+
+@functools.lru_cache(maxsize=None)
+def environment(tau, draw_probability):
+    """Get a TrueSkill environment with the given parameters."""
+    return trueskill.TrueSkill(tau=tau, draw_probability=draw_probability)
+
+
+def competition_environment():
+    """Get the TrueSkill environment the current competition stage uses."""
+    if config.COMPETITION_FINALS_PAIRING:
+        return environment(config.FINALS_RATING_TAU,
+                           config.RATING_DRAW_PROBABILITY)
+    return environment(config.RATING_TAU, config.RATING_DRAW_PROBABILITY)
+
+
+def score(rating):
+    """The leaderboard score of a rating."""
+    return rating.mu - 3 * rating.sigma
+
+
+@functools.lru_cache(maxsize=None)
+def _draw_margin(env):
+    """The draw margin of a two-player game."""
+    return trueskill.calc_draw_margin(env.draw_probability, 2, env)
+
+
+def rate(env, players):
+    """
+    Rate a game.
+
+    :param env: The TrueSkill environment to rate in.
+    :param players: A list of (mu, sigma) pairs, in the order the players
+    finished (first place first).
+    :return: A list of new (mu, sigma) pairs, in the same order.
+    """
+    if len(players) != 2:
+        new_ratings = env.rate([(env.create_rating(mu=mu, sigma=sigma),)
+                                for mu, sigma in players])
+        return [(rating.mu, rating.sigma) for rating, in new_ratings]
+
+    # Two-player games have a closed form, which gives the same result as
+    # running the factor graph, much faster
+    (winner_mu, winner_sigma), (loser_mu, loser_sigma) = players
+    winner_variance = winner_sigma ** 2 + env.tau ** 2
+    loser_variance = loser_sigma ** 2 + env.tau ** 2
+    total_variance = 2 * env.beta ** 2 + winner_variance + loser_variance
+    c = math.sqrt(total_variance)
+    difference = (winner_mu - loser_mu) / c
+    draw_margin = _draw_margin(env) / c
+    v = env.v_win(difference, draw_margin)
+    w = env.w_win(difference, draw_margin)
+    return [
+        (winner_mu + winner_variance / c * v,
+         math.sqrt(winner_variance *
+                   (1 - winner_variance / total_variance * w))),
+        (loser_mu - loser_variance / c * v,
+         math.sqrt(loser_variance *
+                   (1 - loser_variance / total_variance * w))),
+    ]
+
+
+def rate_games(env, games, ratings):
+    """
+    Rate a batch of games in order, so that a player in several games is
+    rated starting from their rating after the previous one.
+
+    :param env: The TrueSkill environment to rate in.
+    :param games: An iterable of games, each a list of player keys in the
+    order the players finished (first place first).
+    :param ratings: A dictionary of trueskill.Rating by player key, for
+    every player. It is updated in place.
+    """
+    for players in games:
+        new_ratings = rate(env, [(ratings[player].mu, ratings[player].sigma)
+                                 for player in players])
+        for player, (mu, sigma) in zip(players, new_ratings):
+            ratings[player] = env.create_rating(mu=mu, sigma=sigma)
+
+
+# Bot rows always exist when ratings are stored, so this never actually
+# inserts one
+_UPSERT_BOT_RATINGS = sqlalchemy.sql.text(
+    "INSERT INTO bot (user_id, id, mu, sigma, score) "
+    "VALUES (:user_id, :bot_id, :mu, :sigma, :score) "
+    "ON DUPLICATE KEY UPDATE "
+    "mu = VALUES(mu), sigma = VALUES(sigma), score = VALUES(score)")
+
+
+def store_bot_ratings(conn, ratings):
+    """
+    Write the ratings and scores of bots in a single statement.
+
+    :param ratings: A dictionary of (mu, sigma) pairs keyed by (user ID,
+    bot ID). The bots must exist.
+    """
+    if not ratings:
+        return
+
+    # In key order, to lock rows in a consistent order
+    conn.execute(_UPSERT_BOT_RATINGS, [{
+        "user_id": user_id,
+        "bot_id": bot_id,
+        "mu": mu,
+        "sigma": sigma,
+        "score": mu - 3 * sigma,
+    } for (user_id, bot_id), (mu, sigma) in sorted(ratings.items())])
@@ -0,0 +1,173 @@
+"""
+Local disk cache of replays, and other blobs, fetched from object storage.
+
+Replays never change once stored, so recently requested ones are kept in
+REPLAY_CACHE_DIR, keyed by their bucket and name, and served from there.
+Other blobs are cached the same way under a key naming the version of the
+blob (see open_blob), e.g. bots by their generation.
+The least recently used files are deleted once the cache holds more than
+REPLAY_CACHE_SIZE bytes. Files are fetched to disk in chunks, never held
+in memory, and a file that is being served stays readable even if it is
+evicted meanwhile.
+
+Several processes may share the cache directory; each keeps its own view
+of the cache's contents and usage, built from the directory on first use.
+"""
+import collections
+import hashlib
+import os
+import tempfile
+import threading
+
+import google.cloud.storage as gcloud_storage
+
+from . import config, model
+
+
+_TEMP_SUFFIX = ".tmp"
+
+# Cached files, least recently used first, with their sizes
+_entries = collections.OrderedDict()
+_total_size = 0
+_loaded = False
+_lock = threading.Lock()
+# Requests for the same replay wait for a single fetch
+_fetch_locks = [threading.Lock() for _ in range(16)]
+
+
+def etag(bucket_class, replay_name):
+    """A strong ETag for a replay, which never changes."""
+    return hashlib.sha1("{}/{}".format(
+        bucket_class, replay_name).encode("utf-8")).hexdigest()
+
+
+def _path(key):
+    return os.path.join(config.REPLAY_CACHE_DIR,
+                        hashlib.sha1(key.encode("utf-8")).hexdigest())
+
+
+def _load():
+    """Index the files already in the cache directory."""
+    global _loaded, _total_size
+    os.makedirs(config.REPLAY_CACHE_DIR, exist_ok=True)
+
+    files = []
+    for entry in os.scandir(config.REPLAY_CACHE_DIR):
+        if entry.name.endswith(_TEMP_SUFFIX) or not entry.is_file():
+            continue
+        stat = entry.stat()
+        files.append((stat.st_mtime, entry.path, stat.st_size))
+
+    for _, path, size in sorted(files):
+        _entries[path] = size
+        _total_size += size
+    _loaded = True
+
+
+def _touch(path, size):
+    """Mark a cached file as most recently used, and evict others."""
+    global _total_size
+    with _lock:
+        if not _loaded:
+            _load()
+
+        if path in _entries:
+            _entries.move_to_end(path)
+        else:
+            # Fetched now, or by another process
+            _entries[path] = size
+            _total_size += size
+
+        while _total_size > config.REPLAY_CACHE_SIZE and len(_entries) > 1:
+            evicted, evicted_size = _entries.popitem(last=False)
+            _total_size -= evicted_size
+            try:
+                os.unlink(evicted)
+            except FileNotFoundError:
+                pass
+
+    # Keep the order across restarts
+    try:
+        os.utime(path)
+    except FileNotFoundError:
+        pass
+
+
+def _open_cached(path):
+    global _total_size
+    try:
+        replay_file = open(path, "rb")
+    except FileNotFoundError:
+        with _lock:
+            # Evicted by another process
+            _total_size -= _entries.pop(path, 0)
+        return None
+
+    _touch(path, os.fstat(replay_file.fileno()).st_size)
+    return replay_file
+
+
+def _fetch(blob, path, md5_hash):
+    os.makedirs(config.REPLAY_CACHE_DIR, exist_ok=True)
+    with tempfile.NamedTemporaryFile(dir=config.REPLAY_CACHE_DIR,
+                                     suffix=_TEMP_SUFFIX,
+                                     delete=False) as temp_file:
+        try:
+            blob.download_to_file(temp_file)
+            if md5_hash is not None:
+                temp_file.seek(0)
+                content_hash = hashlib.md5()
+                for chunk in iter(lambda: temp_file.read(262144), b""):
+                    content_hash.update(chunk)
+                if content_hash.digest() != md5_hash:
+                    raise ValueError(
+                        "Blob {} changed while being fetched".format(
+                            blob.name))
+        except:
+            os.unlink(temp_file.name)
+            raise
+
+    # Open before moving into place, so an eviction can't race with us
+    cached_file = open(temp_file.name, "rb")
+    os.replace(temp_file.name, path)
+    _touch(path, os.fstat(cached_file.fileno()).st_size)
+    return cached_file
+
+
+def open_blob(blob, key, md5_hash=None):
+    """
+    Open a blob, fetching it into the cache if it isn't there.
+
+    :param blob: The blob to fetch.
+    :param key: A key unique to the blob's contents, which must never be
+    used for different contents.
+    :param md5_hash: If given, the MD5 digest (as bytes) the fetched
+    contents must have.
+    :return: A binary file object, positioned at the start, and the size of
+    the blob in bytes.
+    :raises google.cloud.exceptions.NotFound: If the blob doesn't exist.
+    :raises ValueError: If the fetched contents don't match md5_hash.
+    """
+    path = _path(key)
+    cached_file = _open_cached(path)
+    if cached_file is None:
+        with _fetch_locks[hash(path) % len(_fetch_locks)]:
+            cached_file = _open_cached(path)
+            if cached_file is None:
+                cached_file = _fetch(blob, path, md5_hash)
+
+    return cached_file, os.fstat(cached_file.fileno()).st_size
+
+
+def open_replay(bucket_class, replay_name):
+    """
+    Open a replay, fetching it into the cache if it isn't there.
+
+    :return: A binary file object, positioned at the start, and the size of
+    the replay in bytes.
+    :raises google.cloud.exceptions.NotFound: If the replay doesn't exist.
+    """
+    blob = gcloud_storage.Blob(replay_name,
+                               model.get_replay_bucket(bucket_class),
+                               chunk_size=262144)
+    return open_blob(blob, "{}/{}".format(bucket_class, replay_name))
@@ -0,0 +1,119 @@
+"""
+Benchmark the match listing helper at different page sizes.
+
+Reports the median latency and the number of SQL statements per page. Use
+--seed to first insert synthetic games (played by existing users) so that
+the pages are full, and --cleanup to remove them again afterwards.
+
+A page should take two statements (the games, then their participants)
+whatever its size. Latencies depend on the database and its data, so
+compare revisions by running this from each against the same database.
+"""
+
+import argparse
+import statistics
+import sys
+import time
+
+import sqlalchemy
+import sqlalchemy.event
+
+from .. import model
+from ..web import match as match_api
+
+
+BENCHMARK_REPLAY_PREFIX = "benchmark-"
+
+
+def seed(conn, num_games, players_per_game):
+    bots = conn.execute(sqlalchemy.sql.select([
+        model.bots.c.user_id,
+        model.bots.c.id,
+        model.bots.c.version_number,
+    ]).limit(players_per_game)).fetchall()
+    if len(bots) < players_per_game:
+        raise ValueError("Need at least {} bots to seed games."
+                         .format(players_per_game))
+
+    with conn.begin():
+        for index in range(num_games):
+            game_id = conn.execute(model.games.insert().values(
+                replay_name="{}{}".format(BENCHMARK_REPLAY_PREFIX, index),
+                map_width=240,
+                map_height=160,
+                map_seed=index,
+                map_generator="benchmark",
+                time_played=sqlalchemy.sql.func.NOW(),
+            )).inserted_primary_key[0]
+            conn.execute(model.game_participants.insert(), [{
+                "game_id": game_id,
+                "user_id": bot["user_id"],
+                "bot_id": bot["id"],
+                "version_number": bot["version_number"],
+                "log_name": None,
+                "rank": rank + 1,
+                "player_index": rank,
+                "timed_out": False,
+            } for rank, bot in enumerate(bots)])
+
+
+def cleanup(conn):
+    with conn.begin():
+        result = conn.execute(model.games.delete().where(
+            model.games.c.replay_name.startswith(BENCHMARK_REPLAY_PREFIX)))
+    return result.rowcount
+
+
+def benchmark(limit, repeat):
+    statements = []
+
+    def count_statement(*args):
+        statements.append(1)
+
+    sqlalchemy.event.listen(model.engine, "before_cursor_execute",
+                            count_statement)
+    try:
+        timings = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            matches = match_api.list_matches_helper(
+                0, limit, sqlalchemy.true(), sqlalchemy.true(),
+                [model.games.c.time_played.desc()])
+            timings.append(time.perf_counter() - start)
+    finally:
+        sqlalchemy.event.remove(model.engine, "before_cursor_execute",
+                                count_statement)
+
+    return len(matches), statistics.median(timings), len(statements) / repeat
+
+
+def main(args=sys.argv[1:]):
+    parser = argparse.ArgumentParser(
+        description="Benchmark listing matches.")
+    parser.add_argument("--seed", type=int, default=0,
+                        help="Insert this many synthetic games first.")
+    parser.add_argument("--players", type=int, default=4,
+                        help="Players in each synthetic game.")
+    parser.add_argument("--cleanup", action="store_true",
+                        help="Delete synthetic games when done.")
+    parser.add_argument("--repeat", type=int, default=20)
+    parser.add_argument("--limit", type=int, action="append",
+                        help="Page sizes to measure (default: 50 and 250).")
+    cfg = parser.parse_args(args)
+
+    with model.engine.connect() as conn:
+        if cfg.seed:
+            seed(conn, cfg.seed, cfg.players)
+            print("Seeded %d games" % cfg.seed)
+
+        try:
+            for limit in cfg.limit or [50, 250]:
+                rows, latency, statements = benchmark(limit, cfg.repeat)
+                print("limit=%d: %d rows, median %.1f ms, %.0f statements "
+                      "per page" % (limit, rows, latency * 1000, statements))
+        finally:
+            if cfg.cleanup:
+                print("Deleted %d games" % cleanup(conn))
+
+if __name__ == "__main__":
+    main()
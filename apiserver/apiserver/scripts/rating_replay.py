@@ -0,0 +1,345 @@
+"""
+Recompute TrueSkill ratings by replaying the results of stored games.
+
+Games (other than challenge games) are streamed from the database in the
+order they were stored, with a server-side cursor, and rated in memory from
+default ratings, with the given TrueSkill parameters. As when games are
+uploaded, games from --finals-from on (by default, the games after
+LAST_OPEN_GAME if COMPETITION_FINALS_PAIRING is set) are rated with
+--finals-tau instead of --tau. Ratings are kept in flat arrays with a slot
+per bot. As when a new version is compiled, a new version of a bot keeps
+its mu but starts over with the default sigma. Replaying across a rating
+reset (see rating_reset.py) doesn't reset ratings there; use --first-game to
+start after it instead.
+
+By default, the top bots are printed. With --execute, the rating and games
+played of every bot's current version are written back as replayed, and the
+leaderboard rebuilt. A bot whose current version played none of the
+replayed games gets the rating it would have had: the mu of its last
+replayed version with the default sigma, or the default rating, and no
+games played. Games played only count replayed games. Snapshots of running
+hackathons get the new ratings, but keep their games played.
+
+With --windows, the games are split into consecutive windows that are each
+replayed from default ratings, in parallel, for what-if comparisons; such
+results can't be written back.
+"""
+
+import argparse
+import array
+import itertools
+import multiprocessing
+import sys
+import time
+
+import sqlalchemy
+
+from .. import config, model, ranking, rating
+
+
+# How many bots are written per statement
+WRITE_BATCH_SIZE = 1000
+
+
+class BotRatings:
+    """Ratings of bots, in arrays indexed by slot."""
+    def __init__(self, env):
+        self.env = env
+        self.slots = {}
+        self.keys = []
+        self.versions = array.array("l")
+        self.mu = array.array("d")
+        self.sigma = array.array("d")
+        self.games_played = array.array("l")
+
+    def slot(self, user_id, bot_id, version_number):
+        """Get the slot of a bot, starting a new version if needed."""
+        slot = self.slots.get((user_id, bot_id))
+        if slot is None:
+            slot = self.slots[user_id, bot_id] = len(self.keys)
+            self.keys.append((user_id, bot_id))
+            self.versions.append(version_number)
+            self.mu.append(self.env.mu)
+            self.sigma.append(self.env.sigma)
+            self.games_played.append(0)
+        elif version_number > self.versions[slot]:
+            self.versions[slot] = version_number
+            self.sigma[slot] = self.env.sigma
+            self.games_played[slot] = 0
+        return slot
+
+    def top(self, limit):
+        """List the highest scoring bots' slots."""
+        slots = [slot for slot in range(len(self.keys))
+                 if self.games_played[slot] > 0]
+        slots.sort(key=lambda slot: self.mu[slot] - 3 * self.sigma[slot],
+                   reverse=True)
+        return slots[:limit]
+
+
+def game_range(conn, first_game, last_game):
+    """Find the IDs of the first and last games to replay."""
+    clause = model.games.c.challenge_id.is_(None)
+    if first_game is not None:
+        clause &= model.games.c.id >= first_game
+    if last_game is not None:
+        clause &= model.games.c.id <= last_game
+
+    return tuple(conn.execute(sqlalchemy.sql.select([
+        sqlalchemy.sql.func.min(model.games.c.id),
+        sqlalchemy.sql.func.max(model.games.c.id),
+    ]).where(clause)).first())
+
+
+def stream_games(conn, first_game, last_game):
+    """
+    Stream games between two IDs (inclusive), in order.
+
+    :return: An iterator over (game ID, players) pairs, where players is a
+    list of (user ID, bot ID, version number) tuples in the order the
+    players finished.
+    """
+    rows = conn.execution_options(stream_results=True).execute(
+        sqlalchemy.sql.select([
+            model.game_participants.c.game_id,
+            model.game_participants.c.user_id,
+            model.game_participants.c.bot_id,
+            model.game_participants.c.version_number,
+        ]).select_from(model.game_participants.join(
+            model.games,
+            model.games.c.id == model.game_participants.c.game_id
+        )).where(
+            model.games.c.challenge_id.is_(None) &
+            (model.game_participants.c.game_id >= first_game) &
+            (model.game_participants.c.game_id <= last_game)
+        ).order_by(
+            model.game_participants.c.game_id,
+            model.game_participants.c.rank,
+        ))
+
+    for game_id, participants in itertools.groupby(rows,
+                                                   lambda row: row[0]):
+        yield game_id, [row[1:] for row in participants]
+
+
+def replay(conn, env, first_game, last_game, finals_env=None,
+           finals_from=None):
+    """
+    Replay games between two IDs (inclusive) from default ratings.
+
+    :param finals_env: The environment to rate games from finals_from on
+    in, if finals_from is not None.
+    :return: The number of games, and the resulting BotRatings.
+    """
+    ratings = BotRatings(env)
+    num_games = 0
+    for game_id, players in stream_games(conn, first_game, last_game):
+        game_env = env
+        if finals_from is not None and game_id >= finals_from:
+            game_env = finals_env
+        slots = [ratings.slot(*player) for player in players]
+        new_ratings = rating.rate(game_env,
+                                  [(ratings.mu[slot], ratings.sigma[slot])
+                                   for slot in slots])
+        for slot, (mu, sigma) in zip(slots, new_ratings):
+            ratings.mu[slot] = mu
+            ratings.sigma[slot] = sigma
+            ratings.games_played[slot] += 1
+        num_games += 1
+
+    return num_games, ratings
+
+
+def replay_window(window):
+    """Replay a window of games in a worker process."""
+    (first_game, last_game, tau, finals_tau, finals_from,
+     draw_probability) = window
+    env = rating.environment(tau, draw_probability)
+    finals_env = rating.environment(finals_tau, draw_probability)
+    with model.engine.connect() as conn:
+        num_games, ratings = replay(conn, env, first_game, last_game,
+                                    finals_env, finals_from)
+    # The environment can't be sent back to the parent process
+    ratings.env = None
+    return num_games, ratings
+
+
+def split_windows(first_game, last_game, num_windows):
+    """Split a range of game IDs into consecutive windows."""
+    size = (last_game - first_game + num_windows) // num_windows
+    return [(start, min(start + size - 1, last_game))
+            for start in range(first_game, last_game + 1, size)]
+
+
+def write_ratings(conn, ratings, env):
+    """
+    Store the replayed ratings and games played of every bot's current
+    version (see the module docstring for bots that weren't replayed),
+    update the snapshots of running hackathons, and rebuild the
+    leaderboard.
+
+    :return: The number of bots updated, and how many of them were reset
+    because their current version wasn't replayed.
+    """
+    bots = conn.execute(sqlalchemy.sql.select([
+        model.bots.c.user_id,
+        model.bots.c.id,
+        model.bots.c.version_number,
+    ]).order_by(model.bots.c.user_id, model.bots.c.id)).fetchall()
+
+    updates = []
+    num_reset = 0
+    for bot in bots:
+        slot = ratings.slots.get((bot["user_id"], bot["id"]))
+        if slot is not None and ratings.versions[slot] == bot["version_number"]:
+            mu, sigma = ratings.mu[slot], ratings.sigma[slot]
+            games_played = ratings.games_played[slot]
+        else:
+            # A later version keeps its mu; bots never replayed start over
+            mu = env.mu if slot is None else ratings.mu[slot]
+            sigma = env.sigma
+            games_played = 0
+            num_reset += 1
+        updates.append({
+            "b_user_id": bot["user_id"],
+            "b_bot_id": bot["id"],
+            "b_mu": mu,
+            "b_sigma": sigma,
+            "b_score": mu - 3 * sigma,
+            "b_games_played": games_played,
+        })
+
+    update = model.bots.update().where(
+        (model.bots.c.user_id == sqlalchemy.bindparam("b_user_id")) &
+        (model.bots.c.id == sqlalchemy.bindparam("b_bot_id"))
+    ).values(
+        mu=sqlalchemy.bindparam("b_mu"),
+        sigma=sqlalchemy.bindparam("b_sigma"),
+        score=sqlalchemy.bindparam("b_score"),
+        games_played=sqlalchemy.bindparam("b_games_played"),
+    )
+    for start in range(0, len(updates), WRITE_BATCH_SIZE):
+        conn.execute(update, updates[start:start + WRITE_BATCH_SIZE])
+
+    running_hackathons = sqlalchemy.sql.select([
+        model.hackathons.c.id,
+    ]).where(
+        (model.hackathons.c.start_date <= sqlalchemy.sql.func.now()) &
+        (model.hackathons.c.end_date > sqlalchemy.sql.func.now())
+    )
+    conn.execute(model.hackathon_snapshot.update().where(
+        model.hackathon_snapshot.c.hackathon_id.in_(running_hackathons) &
+        (model.hackathon_snapshot.c.user_id == model.bots.c.user_id) &
+        (model.hackathon_snapshot.c.bot_id == model.bots.c.id)
+    ).values(
+        score=model.bots.c.score,
+        mu=model.bots.c.mu,
+        sigma=model.bots.c.sigma,
+        version_number=model.bots.c.version_number,
+    ))
+
+    ranking.rebuild(conn)
+
+    return len(updates), num_reset
+
+
+def print_top(ratings, limit):
+    for place, slot in enumerate(ratings.top(limit), 1):
+        user_id, bot_id = ratings.keys[slot]
+        print("%4d. user %d bot %d v%d: score %.3f (mu %.3f, sigma %.3f, "
+              "%d games)" % (place, user_id, bot_id, ratings.versions[slot],
+                             ratings.mu[slot] - 3 * ratings.sigma[slot],
+                             ratings.mu[slot], ratings.sigma[slot],
+                             ratings.games_played[slot]))
+
+
+def main(args=sys.argv[1:]):
+    parser = argparse.ArgumentParser(
+        description="Recompute ratings by replaying stored games.")
+    parser.add_argument("--tau", type=float, default=config.RATING_TAU,
+                        help="TrueSkill dynamics factor.")
+    parser.add_argument("--finals-tau", type=float,
+                        default=config.FINALS_RATING_TAU,
+                        help="TrueSkill dynamics factor for finals games.")
+    parser.add_argument("--finals-from", type=int,
+                        default=(config.LAST_OPEN_GAME + 1
+                                 if config.COMPETITION_FINALS_PAIRING
+                                 else None),
+                        help="ID of the first finals game.")
+    parser.add_argument("--draw-probability", type=float,
+                        default=config.RATING_DRAW_PROBABILITY)
+    parser.add_argument("--first-game", type=int,
+                        help="ID of the first game to replay.")
+    parser.add_argument("--last-game", type=int,
+                        help="ID of the last game to replay.")
+    parser.add_argument("--windows", type=int, default=1,
+                        help="Replay this many windows of games "
+                             "independently, in parallel.")
+    parser.add_argument("--processes", type=int,
+                        help="Number of worker processes for windows "
+                             "(default: one per CPU).")
+    parser.add_argument("--top", type=int, default=10,
+                        help="How many of the top bots to print.")
+    parser.add_argument("--execute", action="store_true",
+                        help="Store the new ratings.")
+    cfg = parser.parse_args(args)
+
+    if cfg.execute and cfg.windows > 1:
+        parser.error("Ratings replayed in windows cannot be stored.")
+
+    env = rating.environment(cfg.tau, cfg.draw_probability)
+    finals_env = rating.environment(cfg.finals_tau, cfg.draw_probability)
+    start_time = time.perf_counter()
+
+    with model.engine.connect() as conn:
+        first_game, last_game = game_range(conn, cfg.first_game,
+                                           cfg.last_game)
+        if first_game is None:
+            print("No games to replay.")
+            return
+
+        if cfg.windows <= 1:
+            num_games, ratings = replay(conn, env, first_game, last_game,
+                                        finals_env, cfg.finals_from)
+            print("Replayed %d games (%d to %d) of %d bots in %.1f s" % (
+                num_games, first_game, last_game, len(ratings.keys),
+                time.perf_counter() - start_time))
+            print_top(ratings, cfg.top)
+
+            transaction = conn.begin()
+            try:
+                num_updated, num_reset = write_ratings(conn, ratings, env)
+                print("%d bot ratings updated, %d of them reset" % (
+                    num_updated, num_reset))
+            except:
+                transaction.rollback()
+                raise
+            else:
+                if cfg.execute:
+                    transaction.commit()
+                    print("Ratings committed.")
+                else:
+                    transaction.rollback()
+                    print("Ratings rolled back, use --execute to commit.")
+            return
+
+    # Worker processes must not share the parent's database connections
+    model.engine.dispose()
+    windows = split_windows(first_game, last_game, cfg.windows)
+    with multiprocessing.Pool(cfg.processes) as pool:
+        results = pool.map(replay_window, [
+            (first, last, cfg.tau, cfg.finals_tau, cfg.finals_from,
+             cfg.draw_probability)
+            for first, last in windows
+        ])
+
+    for (first, last), (num_games, ratings) in zip(windows, results):
+        print("Games %d to %d: %d games of %d bots" % (
+            first, last, num_games, len(ratings.keys)))
+        print_top(ratings, cfg.top)
+    print("Replayed %d windows in %.1f s" % (
+        len(windows), time.perf_counter() - start_time))
+
+
+if __name__ == "__main__":
+    main()
@@ -8,7 +8,7 @@ import sys
 
 import sqlalchemy
 
-from .. import model
+from .. import model, ranking
 
 def main(args=sys.argv[1:]):
     parser = argparse.ArgumentParser(description="Reset user ratings.")
@@ -52,6 +52,7 @@ def main(args=sys.argv[1:]):
                 )
             insert_res = conn.execute(history_insert)
             update_res = conn.execute(bots_update)
+            ranking.rebuild(conn)
             max_game_res = conn.execute(sqlalchemy.sql.select([
                     func.max(model.games.c.id)]).select_from(model.games))
             max_game = max_game_res.fetchone()[0]
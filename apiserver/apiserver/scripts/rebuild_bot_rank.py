@@ -0,0 +1,35 @@
+"""
+Recompute the materialized leaderboard (bot_rank table) from scratch.
+
+The coordinator moves ranks as scores change, and repairs any that drift;
+this is for populating it initially, or repairing it all at once.
+"""
+
+import argparse
+import sys
+
+from .. import model, ranking
+
+def main(args=sys.argv[1:]):
+    parser = argparse.ArgumentParser(description="Rebuild bot ranks.")
+    parser.add_argument("--execute", action="store_true")
+    cfg = parser.parse_args(args)
+
+    with model.engine.connect() as conn:
+        transaction = conn.begin()
+        try:
+            num_bots = ranking.rebuild(conn)
+            print("%d bots ranked" % num_bots)
+        except:
+            transaction.rollback()
+            raise
+        else:
+            if cfg.execute:
+                transaction.commit()
+                print("Rebuild committed.")
+            else:
+                transaction.rollback()
+                print("Rebuild rolled back, use --execute to commit.")
+
+if __name__ == "__main__":
+    main()
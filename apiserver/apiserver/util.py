@@ -2,6 +2,7 @@ import math
 import urllib.parse
 
 import flask
+import werkzeug.wsgi
 from flask_cors import cross_origin as flask_cross_origin
 
 from . import config
@@ -32,6 +33,7 @@ def cross_origin(*args, **kwargs):
     kwargs["origins"] = config.CORS_ORIGINS
     kwargs["supports_credentials"] = True
     kwargs["allow_headers"] = ["Origin", "Accept", "Content-Type"]
+    kwargs["expose_headers"] = [config.NEXT_CURSOR_HEADER]
     return flask_cross_origin(*args, **kwargs)
 
 
@@ -102,3 +104,33 @@ def build_site_url(page, params, base_url=config.SITE_URL):
     return "{}?{}".format(
         urllib.parse.urljoin(base_url, page),
         urllib.parse.urlencode(params))
+
+
+def send_file_range(file_obj, size, *, mimetype, attachment_filename=None,
+                    etag=None):
+    """
+    Stream a file in chunks, supporting Range and conditional requests.
+
+    :param file_obj: A binary file object, positioned at the start. It is
+    closed once the response has been sent.
+    :param size: The size of the file in bytes.
+    :param mimetype: The mimetype of the file.
+    :param attachment_filename: If given, send the file as an attachment
+    with this name.
+    :param etag: An optional strong ETag identifying the file's contents.
+    :return: A Flask response: the whole file, the requested range (206),
+    or Not Modified (304).
+    """
+    response = flask.current_app.response_class(
+        werkzeug.wsgi.wrap_file(flask.request.environ, file_obj),
+        mimetype=mimetype,
+        direct_passthrough=True)
+    response.content_length = size
+    if attachment_filename is not None:
+        response.headers.set("Content-Disposition", "attachment",
+                             filename=attachment_filename)
+    if etag is not None:
+        response.set_etag(etag)
+
+    return response.make_conditional(flask.request, accept_ranges=True,
+                                     complete_length=size)
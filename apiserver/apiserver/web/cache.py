@@ -0,0 +1,84 @@
+"""
+Response caching for public read endpoints.
+
+Responses are cached in the shared cache backend (see apiserver/cache.py),
+keyed by the request path, its query arguments and the generations of the
+tags the endpoint depends on. Cached responses carry an ETag and a
+Last-Modified date, so clients can revalidate with a conditional GET and
+get an empty 304 when nothing changed.
+"""
+import datetime
+import functools
+import hashlib
+import urllib.parse
+
+import flask
+
+from .. import cache
+
+
+# Headers of cached responses that are set anew when they are served
+_REBUILT_HEADERS = {"content-type", "content-length"}
+
+
+def cached(ttl, tags=(), vary=None):
+    """
+    Cache a view's successful responses.
+
+    :param ttl: How many seconds a response may be served from the cache.
+    :param tags: The tags the response depends on; either a list of tags,
+    or a function taking the view's keyword arguments and returning one.
+    :param vary: An optional function taking the view's keyword arguments
+    and returning a value that is added to the cache key, for responses
+    that differ between viewers. Such responses are marked private.
+    """
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            if flask.request.method != "GET":
+                return view(*args, **kwargs)
+
+            view_tags = tags(**kwargs) if callable(tags) else tags
+            variant = vary(**kwargs) if vary else None
+            key = "response:{}?{}|{}|{}".format(
+                flask.request.path,
+                urllib.parse.urlencode(
+                    sorted(flask.request.args.items(multi=True))),
+                variant,
+                ",".join(cache.generations(*view_tags)))
+
+            entry = cache.backend.get(key)
+            if entry is None:
+                response = flask.make_response(view(*args, **kwargs))
+                if response.status_code != 200:
+                    return response
+
+                body = response.get_data()
+                entry = {
+                    "body": body,
+                    "mimetype": response.mimetype,
+                    "headers": [
+                        (name, value) for name, value in response.headers
+                        if name.lower() not in _REBUILT_HEADERS],
+                    "etag": hashlib.sha1(body).hexdigest(),
+                    "last_modified": datetime.datetime.utcnow().replace(
+                        microsecond=0),
+                }
+                cache.backend.set(key, entry, timeout=ttl)
+
+            response = flask.current_app.response_class(
+                entry["body"], mimetype=entry["mimetype"])
+            response.headers.extend(entry.get("headers", ()))
+            response.set_etag(entry["etag"])
+            response.last_modified = entry["last_modified"]
+            # Let clients keep the response, but have them check it's current
+            response.cache_control.no_cache = True
+            if variant is not None:
+                response.cache_control.private = True
+            else:
+                response.cache_control.public = True
+            return response.make_conditional(flask.request)
+
+        return wrapper
+
+    return decorator
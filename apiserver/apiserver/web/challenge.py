@@ -85,23 +85,34 @@ def list_challenges_helper(offset, limit, participant_clause,
             ).correlate(model.challenges))
         ).order_by(*order_clause).offset(offset).limit(limit).reduce_columns()
 
-        challenges = conn.execute(query)
+        challenges = conn.execute(query).fetchall()
         result = []
-        for challenge in challenges.fetchall():
-            participants = conn.execute(sqlalchemy.sql.select([
-                model.challenge_participants.c.user_id,
-                model.challenge_participants.c.points,
-                model.challenge_participants.c.ships_produced,
-                model.challenge_participants.c.attacks_made,
-                model.users.c.username,
-            ]).select_from(model.challenge_participants.join(
-                model.users,
-                model.challenge_participants.c.user_id == model.users.c.id
-            )).where(
-                model.challenge_participants.c.challenge_id == challenge["id"]
-            )).fetchall()
-
-            result.append(make_challenge_record(challenge, participants))
+        if not challenges:
+            return result
+
+        # Fetch the participants of all challenges on the page at once
+        participants_by_challenge = {}
+        participants = conn.execute(sqlalchemy.sql.select([
+            model.challenge_participants.c.challenge_id,
+            model.challenge_participants.c.user_id,
+            model.challenge_participants.c.points,
+            model.challenge_participants.c.ships_produced,
+            model.challenge_participants.c.attacks_made,
+            model.users.c.username,
+        ]).select_from(model.challenge_participants.join(
+            model.users,
+            model.challenge_participants.c.user_id == model.users.c.id
+        )).where(
+            model.challenge_participants.c.challenge_id.in_(
+                [challenge["id"] for challenge in challenges])
+        ))
+        for participant in participants:
+            participants_by_challenge.setdefault(
+                participant["challenge_id"], []).append(participant)
+
+        for challenge in challenges:
+            result.append(make_challenge_record(
+                challenge, participants_by_challenge.get(challenge["id"], [])))
 
         return result
 
@@ -10,6 +10,7 @@ import sqlalchemy
 
 from .. import model, util
 
+from . import cache as web_cache
 from . import util as api_util
 from .blueprint import web_api
 
@@ -233,6 +234,7 @@ def update_hackathon(hackathon_id, *, user_id):
 
 @web_api.route("/hackathon/<int:hackathon_id>/leaderboard")
 @util.cross_origin(methods=["GET"])
+@web_cache.cached(ttl=60, tags=["leaderboard"])
 def get_hackathon_leaderboard(hackathon_id):
     with model.engine.connect() as conn:
 
@@ -6,13 +6,20 @@ import operator
 import flask
 import sqlalchemy
 
-from .. import config, model, util
+from .. import config, model, rank_index, util
 
+from . import cache as web_cache
 from . import util as api_util
 from .blueprint import web_api
 
 _COUNT_KEY = 'count'
 _LEADERBOARD_ALIAS = 'full_leaderboard'
+# The leaderboard is paged by rank; bots with the same rank by user and bot
+_LEADERBOARD_KEYSET = [
+    (model.ranked_bots_users.c.rank, False),
+    (model.ranked_bots_users.c.user_id, False),
+    (model.ranked_bots_users.c.bot_id, False),
+]
 
 
 def _count_leaderboard_query(where_clause):
@@ -29,6 +36,7 @@ def _count_leaderboard_query(where_clause):
 
 @web_api.route("/leaderboard")
 @util.cross_origin(methods=["GET"])
+@web_cache.cached(ttl=60, tags=["leaderboard"])
 def leaderboard():
     result = []
     offset, limit = api_util.get_offset_limit(default_limit=250,
@@ -48,17 +56,22 @@ def leaderboard():
         "language": model.ranked_bots_users.c.language,
     }, ["tier"])
 
-    if not order_clause:
-        order_clause = [model.ranked_bots_users.c.rank]
+    # Bots get a rank on the next rank refresh (see ranking.py)
+    where_clause &= model.ranked_bots_users.c.rank.isnot(None)
+    # Pages are read by rank, which bot_rank indexes, so a cursor is as
+    # cheap to follow as the first page
+    where_clause, order_clause, offset, paged = api_util.get_keyset_page(
+        _LEADERBOARD_KEYSET, where_clause, order_clause, offset)
 
     with model.engine.connect() as conn:
         if _COUNT_KEY in flask.request.args:
             return str(api_util.get_value(conn.execute(_count_leaderboard_query(where_clause))))
 
-        total_users = api_util.get_value(conn.execute(model.total_ranked_users))
+        index = rank_index.get_index(conn)
+        total_users = index.total_ranked_users
 
         tier_filter = None
-        tier_thresholds = util.tier_thresholds(total_users)
+        tier_thresholds = index.tier_thresholds()
         for (field, op, val) in manual_sort:
             if field == "tier":
                 column = model.ranked_bots_users.c.rank
@@ -114,7 +127,8 @@ def leaderboard():
                 .where(where_clause).order_by(*order_clause)
                 .offset(offset).limit(limit).reduce_columns())
 
-        for row in query.fetchall():
+        rows = query.fetchall()
+        for row in rows:
             user = {
                 "user_id": row["user_id"],
                 "username": row["username"],
@@ -140,11 +154,16 @@ def leaderboard():
 
             result.append(user)
 
-    return flask.jsonify(result)
+    response = flask.jsonify(result)
+    if paged and rows and len(rows) == limit:
+        api_util.set_next_cursor(response, [
+            rows[-1]["rank"], rows[-1]["user_id"], rows[-1]["bot_id"]])
+    return response
 
 
 @web_api.route("/leagues")
 @util.cross_origin(methods=["GET"])
+@web_cache.cached(ttl=3600)
 def leagues():
     result = []
     with model.engine.connect() as conn:
@@ -1,22 +1,22 @@
 """
 Match API endpoints - list matches and get replays/error logs.
 """
-import io
-
 import flask
 import sqlalchemy
 import google.cloud.exceptions as gcloud_exceptions
-import google.cloud.storage as gcloud_storage
 
-from .. import model, util
+from .. import config, model, replay_cache, util
 
 from .blueprint import web_api
+from . import cache as web_cache
 from . import util as api_util
+from . import view_counts
 
 
 def get_match_helper(match_id):
     """
-    Get a particular match by its ID.
+    Get a particular match by its ID. Matches whose replay has not been
+    uploaded yet are not found.
 
     :param match_id: The ID of the match.
     :return: A dictionary with the game information.
@@ -44,7 +44,8 @@ def get_match_helper(match_id):
             model.games.c.time_played,
             model.games.c.challenge_id,
         ]).where(
-            model.games.c.id == match_id
+            (model.games.c.id == match_id) &
+            model.games.c.artifacts_uploaded
         )).first()
 
         if not match:
@@ -72,20 +73,35 @@ def get_match_helper(match_id):
                 "sigma": row["sigma"],
             }
 
-        # Update game_view_stat table
-        conn.execute(model.game_view_stats.update().where(
-            model.game_view_stats.c.game_id == match_id
-        ).values(
-            views_total=model.game_view_stats.c.views_total + 1,
-        ))
-
     return result
 
 
+def record_match_view(match_id):
+    """Count a view of a match; counts are written in batches."""
+    view_counts.record(match_id)
+
+
+# Match listings are paged from the most recent game
+MATCH_KEYSET = [
+    (model.games.c.time_played, True),
+    (model.games.c.id, True),
+]
+
+
+def list_matches_response(matches, limit, paged):
+    """Build the response for a page of matches."""
+    response = flask.jsonify(matches)
+    if paged and matches and len(matches) == limit:
+        api_util.set_next_cursor(response, [
+            matches[-1]["time_played"], matches[-1]["game_id"]])
+    return response
+
+
 def list_matches_helper(offset, limit, participant_clause,
                         where_clause, order_clause):
     """
-    Generate a list of matches by certain criteria.
+    Generate a list of matches by certain criteria. Matches whose replay
+    has not been uploaded yet are left out.
 
     :param int offset: How
     :param int limit: How many results to return.
@@ -116,6 +132,7 @@ def list_matches_helper(offset, limit, participant_clause,
             (model.games.c.id == model.game_stats.c.game_id)
         )).where(
             where_clause &
+            model.games.c.artifacts_uploaded &
             sqlalchemy.sql.exists(
                 model.game_participants.select(
                     participant_clause &
@@ -125,17 +142,37 @@ def list_matches_helper(offset, limit, participant_clause,
         ).order_by(
             *order_clause
         ).offset(offset).limit(limit).reduce_columns()
-        matches = conn.execute(query)
-
-        for match in matches.fetchall():
-            participants = conn.execute(
-                model.game_participants.join(
-                    model.users,
-                    model.game_participants.c.user_id == model.users.c.id
-                ).select(
-                    model.game_participants.c.game_id == match["id"]
-                )
-            )
+        matches = conn.execute(query).fetchall()
+        if not matches:
+            return result
+
+        # Fetch the participants of all matches on the page at once
+        participants_by_game = {}
+        participants = conn.execute(sqlalchemy.sql.select([
+            model.game_participants.c.game_id,
+            model.game_participants.c.user_id,
+            model.game_participants.c.bot_id,
+            model.game_participants.c.version_number,
+            model.game_participants.c.player_index,
+            model.game_participants.c.rank,
+            model.game_participants.c.timed_out,
+            model.game_participants.c.leaderboard_rank,
+            model.game_participants.c.mu,
+            model.game_participants.c.sigma,
+            model.users.c.username,
+        ]).select_from(model.game_participants.join(
+            model.users,
+            model.game_participants.c.user_id == model.users.c.id
+        )).where(
+            model.game_participants.c.game_id.in_(
+                [match["id"] for match in matches])
+        ))
+        for participant in participants:
+            participants_by_game.setdefault(
+                participant["game_id"], []).append(participant)
+
+        for match in matches:
+            participants = participants_by_game.get(match["id"], [])
 
             match = {
                 "game_id": match["id"],
@@ -172,6 +209,7 @@ def list_matches_helper(offset, limit, participant_clause,
 
 @web_api.route("/match")
 @util.cross_origin(methods=["GET"])
+@web_cache.cached(ttl=30, tags=["matches"])
 def list_matches():
     offset, limit = api_util.get_offset_limit()
     where_clause, order_clause, manual_sort = api_util.get_sort_filter({
@@ -190,14 +228,24 @@ def list_matches():
         if field == "timed_out":
             participant_clause &= model.game_participants.c.timed_out
 
+    where_clause, order_clause, offset, paged = api_util.get_keyset_page(
+        MATCH_KEYSET, where_clause, order_clause, offset)
     result = list_matches_helper(
         offset, limit, participant_clause, where_clause, order_clause)
 
-    return flask.jsonify(result)
+    return list_matches_response(result, limit, paged)
 
 
 @web_api.route("/match/<int:match_id>")
 def get_match(match_id):
+    response = get_cached_match(match_id=match_id)
+    # Views are counted even when the match is served from the cache
+    record_match_view(match_id)
+    return response
+
+
+@web_cache.cached(ttl=3600)
+def get_cached_match(match_id):
     match = get_match_helper(match_id)
     if not match:
         raise util.APIError(404, message="Match not found.")
@@ -208,22 +256,24 @@ def get_match(match_id):
                methods=["GET"])
 @util.cross_origin(methods=["GET"])
 def get_replay(replay_bucket, replay_name):
-    bucket = model.get_replay_bucket(replay_bucket)
-    blob = gcloud_storage.Blob(replay_name, bucket, chunk_size=262144)
-    buffer = io.BytesIO()
+    return send_replay(replay_bucket, replay_name,
+                       "{}.{}.hlt".format(replay_name, replay_bucket))
 
+
+def send_replay(replay_bucket, replay_name, attachment_filename):
+    """Serve a replay from the local replay cache."""
     try:
-        blob.download_to_file(buffer)
+        replay_file, size = replay_cache.open_replay(replay_bucket,
+                                                     replay_name)
     except gcloud_exceptions.NotFound:
         raise util.APIError(404, message="Replay not found.")
 
-    buffer.seek(0)
-    response = flask.make_response(flask.send_file(
-        buffer,
+    response = util.send_file_range(
+        replay_file, size,
         mimetype="application/x-halite-2-replay",
-        as_attachment=True,
-        attachment_filename="{}.{}.hlt".format(replay_name, replay_bucket)))
-
-    response.headers["Content-Length"] = str(buffer.getbuffer().nbytes)
-
+        attachment_filename=attachment_filename,
+        etag=replay_cache.etag(replay_bucket, replay_name))
+    # Replays never change, so clients need not revalidate them
+    response.cache_control.public = True
+    response.cache_control.max_age = config.REPLAY_MAX_AGE
     return response
@@ -8,8 +8,9 @@ import flask
 import sqlalchemy
 import tld
 
-from .. import config, model, notify, util
+from .. import cache, config, model, notify, ranking, util
 
+from . import cache as web_cache
 from . import util as web_util
 from .blueprint import web_api
 
@@ -183,6 +184,9 @@ def list_users():
         "num_games": model.all_users.c.num_games,
         "rank": model.all_users.c.rank,
     })
+    where_clause, order_clause, offset, paged = web_util.get_keyset_page(
+        [(model.all_users.c.user_id, False)],
+        where_clause, order_clause, offset)
 
     with model.engine.connect() as conn:
         total_users = conn.execute(model.total_ranked_users).first()[0]
@@ -196,7 +200,10 @@ def list_users():
             result.append(make_user_record(row, logged_in=False,
                                            total_users=total_users))
 
-    return flask.jsonify(result)
+    response = flask.jsonify(result)
+    if paged and result and len(result) == limit:
+        web_util.set_next_cursor(response, [result[-1]["user_id"]])
+    return response
 
 
 @web_api.route("/user", methods=["POST"])
@@ -343,6 +350,7 @@ def create_user(*, user_id):
         conn.execute(model.users.update().where(
             model.users.c.id == user_id
         ).values(**values))
+    cache.invalidate(cache.user_tag(user_id), cache.login_tag(user_id))
 
     send_confirmation_email(
         notify.Recipient(user_id, user_data["username"], user_data["github_email"],
@@ -357,6 +365,13 @@ def create_user(*, user_id):
 @web_api.route("/user/<int:intended_user>", methods=["GET"])
 @util.cross_origin(methods=["GET", "PUT"])
 @web_util.requires_login(optional=True, accept_key=True)
+@web_cache.cached(
+    ttl=60,
+    tags=lambda intended_user, user_id: [
+        "leaderboard", cache.user_tag(intended_user)],
+    # Users see private fields of their own record
+    vary=lambda intended_user, user_id:
+        "owner" if user_id == intended_user else None)
 def get_user(intended_user, *, user_id):
     with model.engine.connect() as conn:
         query = model.all_users.select(
@@ -434,6 +449,8 @@ def verify_user_email(user_id):
                 is_email_good=1,
                 verification_code="",
             ))
+            cache.invalidate(cache.user_tag(user_id),
+                             cache.login_tag(user_id))
             return util.response_success({
                 "message": "Email verified."
             })
@@ -575,6 +592,7 @@ def update_user(intended_user_id, *, user_id):
         conn.execute(model.users.update().where(
             model.users.c.id == user_id
         ).values(**update))
+        cache.invalidate(cache.user_tag(user_id), cache.login_tag(user_id))
 
         user_data = conn.execute(sqlalchemy.sql.select(["*"]).select_from(
             model.users.join(
@@ -613,7 +631,13 @@ def update_user(intended_user_id, *, user_id):
 @web_api.route("/user/<int:intended_user_id>", methods=["DELETE"])
 @web_util.requires_login(accept_key=True, admin=True)
 def delete_user(intended_user_id, *, user_id):
-    with model.engine.connect() as conn:
+    with ranking.index_updates_on_commit(), model.engine.begin() as conn:
+        user_bots = conn.execute(sqlalchemy.sql.select([
+            model.bots.c.id,
+        ]).where(model.bots.c.user_id == intended_user_id)).fetchall()
+        for bot in user_bots:
+            ranking.remove_bot(conn, intended_user_id, bot["id"])
+
         conn.execute(model.games.delete().where(
             sqlalchemy.sql.exists(
                 model.game_participants.select().where(
@@ -624,6 +648,9 @@ def delete_user(intended_user_id, *, user_id):
         ))
         conn.execute(model.users.delete().where(
             model.users.c.id == intended_user_id))
+    # Also logs out the user's API keys and sessions
+    cache.invalidate("leaderboard", cache.user_tag(intended_user_id),
+                     cache.login_tag(intended_user_id))
     return util.response_success()
 
 @web_api.route("/user/addsubscriber/<string:recipient>", methods=["POST"])
@@ -664,6 +691,8 @@ def reset_api_key(intended_user=None, *, user_id):
         ).values(
             api_key_hash=config.api_key_context.hash(api_key),
         ))
+        # Stop accepting the old key
+        cache.invalidate(cache.user_tag(user_id), cache.login_tag(user_id))
 
         return util.response_success({
             "api_key": "{}:{}".format(user_id, api_key),
@@ -671,6 +700,9 @@ def reset_api_key(intended_user=None, *, user_id):
 
 @web_api.route("/user/<int:intended_user_id>/history", methods=["GET"])
 @util.cross_origin(methods=["GET"])
+@web_cache.cached(
+    ttl=600,
+    tags=lambda intended_user_id: [cache.user_tag(intended_user_id)])
 def get_rank_history(intended_user_id):
     result = []
     with model.engine.connect() as conn:
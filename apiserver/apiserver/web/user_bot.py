@@ -9,7 +9,7 @@ import sqlalchemy
 import google.cloud.storage as gcloud_storage
 import google.cloud.exceptions as gcloud_exceptions
 
-from .. import model, util
+from .. import model, ranking, util
 
 from . import util as api_util
 from .blueprint import web_api
@@ -120,7 +120,7 @@ def create_user_bot(intended_user, *, user_id):
 
     _ = validate_bot_submission()
 
-    with model.engine.connect() as conn:
+    with ranking.index_updates_on_commit(), model.engine.begin() as conn:
         current_bot = conn.execute(
             model.bots.select(model.bots.c.user_id == user_id)).first()
         if current_bot:
@@ -132,6 +132,7 @@ def create_user_bot(intended_user, *, user_id):
             id=0,
             compile_status=model.CompileStatus.DISABLED.value,
         ))
+        ranking.insert_bot(conn, user_id, 0)
 
     store_user_bot(intended_user=intended_user, user_id=user_id, bot_id=0)
     return util.response_success({
@@ -193,7 +194,8 @@ def delete_user_bot(intended_user, bot_id, *, user_id):
         raise api_util.user_mismatch_error(
             message="Cannot delete bot for another user.")
 
-    with model.engine.connect() as conn:
+    with ranking.index_updates_on_commit(), model.engine.begin() as conn:
+        ranking.remove_bot(conn, user_id, bot_id)
         conn.execute(model.bots.delete().where(
             (model.bots.c.user_id == user_id) &
             (model.bots.c.id == bot_id)
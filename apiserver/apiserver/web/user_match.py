@@ -29,19 +29,20 @@ def list_user_matches(intended_user):
         if field == "timed_out":
             participant_clause &= model.game_participants.c.timed_out
 
+    where_clause, order_clause, offset, paged = api_util.get_keyset_page(
+        match_api.MATCH_KEYSET, where_clause, order_clause, offset)
     result = match_api.list_matches_helper(
         offset, limit, participant_clause, where_clause, order_clause)
 
-    return flask.jsonify(result)
+    return match_api.list_matches_response(result, limit, paged)
 
 
 @web_api.route("/user/<int:intended_user>/match/<int:match_id>", methods=["GET"])
 @util.cross_origin(methods=["GET"])
 def get_user_match(intended_user, match_id):
-    result = match_api.get_match_helper(match_id)
-    if not result:
-        raise util.APIError(404, message="Match not found.")
-    return flask.jsonify(result)
+    response = match_api.get_cached_match(match_id=match_id)
+    match_api.record_match_view(match_id)
+    return response
 
 
 @web_api.route("/user/<int:intended_user>/match/<int:match_id>/replay",
@@ -52,28 +53,21 @@ def get_match_replay(intended_user, match_id):
         match = conn.execute(sqlalchemy.sql.select([
             model.games.c.replay_name,
             model.games.c.replay_bucket,
+            model.games.c.artifacts_uploaded,
         ]).where(
             model.games.c.id == match_id
         )).first()
 
         if not match:
             raise util.APIError(404, message="Match not found.")
+        if not match["artifacts_uploaded"]:
+            raise util.APIError(
+                404, message="Replay is still being uploaded, try again "
+                             "shortly.")
 
-        bucket = model.get_replay_bucket(match["replay_bucket"])
-        blob = gcloud_storage.Blob(match["replay_name"], bucket,
-                                   chunk_size=262144)
-        buffer = io.BytesIO()
-        blob.download_to_file(buffer)
-        buffer.seek(0)
-        response = flask.make_response(flask.send_file(
-            buffer,
-            mimetype="application/x-halite-2-replay",
-            as_attachment=True,
-            attachment_filename=str(match_id)+".hlt"))
-
-        response.headers["Content-Length"] = str(buffer.getbuffer().nbytes)
-
-        return response
+    return match_api.send_replay(match["replay_bucket"],
+                                 match["replay_name"],
+                                 str(match_id) + ".hlt")
 
 
 @web_api.route("/user/<int:intended_user>/match/<int:match_id>/error_log",
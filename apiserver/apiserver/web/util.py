@@ -1,13 +1,31 @@
+import base64
+import binascii
 import datetime
 import functools
+import hashlib
+import json
 import operator
+import threading
 
 import arrow
+import cachetools
 import flask
 import sqlalchemy
 import pycountry
 
-from .. import config, model, util
+from .. import cache, config, model, util
+
+
+# Users who recently logged in, so that API keys (hashed with argon2, which
+# is deliberately slow) aren't verified on every request. Entries are valid
+# for the generation of the user's login tag (cache.login_tag) they were made
+# under, so invalidating the tag logs out cached keys and sessions. With the
+# default "lru" cache backend, an invalidation only reaches processes on the
+# machine that made it; processes elsewhere keep using their entries for up
+# to LOGIN_CACHE_TTL seconds.
+_login_cache = cachetools.TTLCache(config.LOGIN_CACHE_SIZE,
+                                   config.LOGIN_CACHE_TTL)
+_login_cache_lock = threading.Lock()
 
 
 def validate_country(country_code, subdivision_code):
@@ -31,6 +49,29 @@ def validate_user_level(level):
                      'Professional')
 
 
+def _cached_login(key, user_id, lookup):
+    """
+    Look up a user record through the login cache.
+
+    :param key: The cache key, unique to the user and credential.
+    :param user_id: The ID of the user.
+    :param lookup: A function returning the user record, or None if the
+    credential is not valid; only valid ones are cached.
+    """
+    generation = cache.generations(cache.login_tag(user_id))[0]
+    with _login_cache_lock:
+        entry = _login_cache.get(key)
+    if entry is not None and entry[0] == generation:
+        return entry[1]
+
+    user = lookup()
+    if user is not None:
+        user = dict(user)
+        with _login_cache_lock:
+            _login_cache[key] = (generation, user)
+    return user
+
+
 def validate_api_key(api_key):
     """
     Validate the given API key and retrieve the corresponding user record.
@@ -45,6 +86,13 @@ def validate_api_key(api_key):
 
     user_id, api_key = api_key.split(":", 1)
     user_id = int(user_id)
+    # Never keep the key itself around
+    key_hash = hashlib.sha256(api_key.encode("utf-8")).hexdigest()
+    return _cached_login(("api_key", user_id, key_hash), user_id,
+                         lambda: _verify_api_key(user_id, api_key))
+
+
+def _verify_api_key(user_id, api_key):
     with model.engine.connect() as conn:
         user = conn.execute(sqlalchemy.sql.select([
             model.users.c.id.label("user_id"),
@@ -67,6 +115,14 @@ def validate_session_cookie(user_id):
     """
     Validate the session cookie and retrieve the corresponding user record.
     """
+    if user_id is None:
+        return None
+
+    return _cached_login(("session", user_id), user_id,
+                         lambda: _get_session_user(user_id))
+
+
+def _get_session_user(user_id):
     with model.engine.connect() as conn:
         user = conn.execute(sqlalchemy.sql.select([
             model.users.c.id.label("user_id"),
@@ -159,6 +215,92 @@ def get_offset_limit(*, default_limit=50, max_limit=250):
     return offset, limit
 
 
+def get_cursor(keyset):
+    """
+    Get the pagination cursor from the query string, if there is one.
+
+    :param keyset: The (column, descending) pairs the listing is paged by.
+    :return: A list with a value for each column of the keyset, or None.
+    :raises util.APIError: If the cursor is invalid.
+    """
+    cursor = flask.request.values.get("cursor")
+    if not cursor:
+        return None
+
+    try:
+        values = json.loads(
+            base64.urlsafe_b64decode(cursor.encode("ascii")).decode("utf-8"))
+        if not isinstance(values, list) or len(values) != len(keyset):
+            raise ValueError
+        for index, (column, _) in enumerate(keyset):
+            if isinstance(column.type, sqlalchemy.types.DateTime):
+                values[index] = arrow.get(values[index]).datetime
+    except (ValueError, TypeError, binascii.Error, arrow.parser.ParserError):
+        raise util.APIError(400, message="Cursor is invalid.")
+
+    return values
+
+
+def make_cursor(values):
+    """Make an opaque pagination cursor pointing after the given values."""
+    values = [value.isoformat() if isinstance(value, datetime.datetime)
+              else value for value in values]
+    return base64.urlsafe_b64encode(
+        json.dumps(values).encode("utf-8")).decode("ascii")
+
+
+def get_keyset_page(keyset, where_clause, order_clause, offset):
+    """
+    Set up keyset (cursor) pagination for a listing, where possible.
+
+    A listing can be paged with a cursor when it isn't ordered, or is
+    ordered by a prefix of its keyset: columns that together order rows
+    uniquely. Such a listing is ordered by the whole keyset, and if a
+    cursor is given, starts after the cursor instead of at an offset, so
+    that deep pages cost as much as the first.
+
+    :param keyset: A list of (column, descending) pairs.
+    :param where_clause: The where clause from get_sort_filter.
+    :param order_clause: The order clause from get_sort_filter.
+    :param offset: The offset from get_offset_limit.
+    :return: A 4-tuple of (where_clause, order_clause, offset, paged),
+    where paged is True if the listing is paged by keyset.
+    :raises util.APIError: If a cursor is given but the listing can't be
+    paged by keyset.
+    """
+    full_order = [column.desc() if descending else column.asc()
+                  for column, descending in keyset]
+    paged = len(order_clause) <= len(full_order) and all(
+        ordering.element is keyset_ordering.element and
+        ordering.modifier is keyset_ordering.modifier
+        for ordering, keyset_ordering in zip(order_clause, full_order))
+
+    cursor = get_cursor(keyset)
+    if not paged:
+        if cursor is not None:
+            raise util.APIError(
+                400, message="Cannot use a cursor with this order.")
+        return where_clause, order_clause, offset, False
+
+    if cursor is not None:
+        # Rows after the cursor: greater (or less) on the first column that
+        # differs from it
+        after = sqlalchemy.false()
+        equal = sqlalchemy.true()
+        for (column, descending), value in zip(keyset, cursor):
+            after |= equal & (column < value if descending else column > value)
+            equal &= column == value
+        where_clause &= after
+        offset = 0
+
+    return where_clause, full_order, offset, True
+
+
+def set_next_cursor(response, values):
+    """Point a listing response to its next page."""
+    response.headers[config.NEXT_CURSOR_HEADER] = make_cursor(values)
+
+
 def operator_like(field, value):
     return field.like("%{}%".format(value))
 
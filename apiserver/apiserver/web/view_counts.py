@@ -0,0 +1,79 @@
+"""
+Write-behind counting of match views.
+
+Views are tallied in memory and flushed to game_view_stat by a background
+thread every VIEW_COUNT_FLUSH_INTERVAL seconds, in a single multi-row
+upsert, so that viewing a match never writes to (or waits on a lock for)
+its row. Counts still pending when the process exits are flushed then;
+counts are lost only if the process dies abruptly.
+"""
+import atexit
+import collections
+import logging
+import threading
+import time
+
+import sqlalchemy
+
+from .. import config, model
+
+
+_pending = collections.Counter()
+_lock = threading.Lock()
+_flusher = None
+
+
+def record(match_id):
+    """Count a view of a match."""
+    global _flusher
+    with _lock:
+        _pending[match_id] += 1
+        if _flusher is None:
+            _flusher = threading.Thread(target=_flush_forever,
+                                        name="view-count-flusher",
+                                        daemon=True)
+            _flusher.start()
+
+
+def flush():
+    """Write all pending view counts to the database."""
+    global _pending
+    with _lock:
+        counts, _pending = _pending, collections.Counter()
+
+    if not counts:
+        return
+
+    # Ignore games deleted in the meantime (foreign key failures)
+    statement = sqlalchemy.sql.text(
+        "INSERT IGNORE INTO game_view_stat (game_id, views_total) VALUES " +
+        ", ".join("(:game_id_{0}, :views_{0})".format(index)
+                  for index in range(len(counts))) +
+        " ON DUPLICATE KEY UPDATE "
+        "views_total = views_total + VALUES(views_total)")
+    params = {}
+    # Sorted, so that concurrent flushes lock rows in the same order
+    for index, (game_id, views) in enumerate(sorted(counts.items())):
+        params["game_id_{}".format(index)] = game_id
+        params["views_{}".format(index)] = views
+
+    try:
+        with model.engine.connect() as conn:
+            conn.execute(statement, **params)
+    except Exception:
+        # Put the counts back, to try again on the next flush
+        with _lock:
+            _pending.update(counts)
+        raise
+
+
+def _flush_forever():
+    while True:
+        time.sleep(config.VIEW_COUNT_FLUSH_INTERVAL)
+        try:
+            flush()
+        except Exception:
+            logging.exception("Could not flush match view counts")
+
+
+atexit.register(flush)
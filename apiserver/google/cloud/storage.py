@@ -1,3 +1,5 @@
+import shutil
+
 
 class Blob:
   def __init__(self, fname, bucket, *args, **kwargs):
@@ -9,6 +11,13 @@ class Blob:
     file_storage.save('/tmp/halite/{}'.format(self._fname))
     pass
 
+  def upload_from_filename(self, filename):
+    shutil.copyfile(filename, '/tmp/halite/{}'.format(self._fname))
+
+  def download_to_file(self, file_obj):
+    with open('/tmp/halite/{}'.format(self._fname), 'rb') as blob_file:
+      shutil.copyfileobj(blob_file, file_obj)
+
 class Bucket:
   def __init__(self, *args, **kwargs):
     print('Bucket')
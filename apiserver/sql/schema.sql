@@ -94,6 +94,26 @@ CREATE TABLE `bot_history` (
 ) ENGINE=InnoDB DEFAULT CHARSET=utf8;
 /*!40101 SET character_set_client = @saved_cs_client */;
 
+--
+-- Table structure for table `bot_rank`
+--
+
+DROP TABLE IF EXISTS `bot_rank`;
+/*!40101 SET @saved_cs_client     = @@character_set_client */;
+/*!40101 SET character_set_client = utf8 */;
+CREATE TABLE `bot_rank` (
+  `user_id` mediumint(8) unsigned NOT NULL,
+  `bot_id` mediumint(8) unsigned NOT NULL,
+  `score` double NOT NULL,
+  `rank` mediumint(8) unsigned NOT NULL,
+  `tier` varchar(16) DEFAULT NULL,
+  PRIMARY KEY (`user_id`,`bot_id`),
+  KEY `bot_rank_score` (`score`,`user_id`,`bot_id`),
+  KEY `bot_rank_rank` (`rank`),
+  CONSTRAINT `bot_rank_bot_fk` FOREIGN KEY (`user_id`, `bot_id`) REFERENCES `bot` (`user_id`, `id`) ON DELETE CASCADE
+) ENGINE=InnoDB DEFAULT CHARSET=utf8;
+/*!40101 SET character_set_client = @saved_cs_client */;
+
 --
 -- Table structure for table `challenge`
 --
@@ -155,13 +175,41 @@ CREATE TABLE `game` (
   `time_played` datetime DEFAULT CURRENT_TIMESTAMP,
   `replay_bucket` smallint(5) NOT NULL DEFAULT '0',
   `challenge_id` int(11) DEFAULT NULL,
+  `artifacts_uploaded` tinyint(1) NOT NULL DEFAULT '1',
+  `result_id` varchar(32) DEFAULT NULL,
   PRIMARY KEY (`id`),
+  UNIQUE KEY `game_result_id` (`result_id`),
   KEY `game_time_played` (`time_played`),
   KEY `game_challenge_fk` (`challenge_id`),
   CONSTRAINT `game_challenge_fk` FOREIGN KEY (`challenge_id`) REFERENCES `challenge` (`id`) ON DELETE CASCADE
 ) ENGINE=InnoDB AUTO_INCREMENT=3492600 DEFAULT CHARSET=utf8;
 /*!40101 SET character_set_client = @saved_cs_client */;
 
+--
+-- Table structure for table `game_bot_resource`
+--
+
+DROP TABLE IF EXISTS `game_bot_resource`;
+/*!40101 SET @saved_cs_client     = @@character_set_client */;
+/*!40101 SET character_set_client = utf8 */;
+CREATE TABLE `game_bot_resource` (
+  `game_id` mediumint(8) unsigned NOT NULL,
+  `user_id` mediumint(8) unsigned NOT NULL,
+  `bot_id` mediumint(8) unsigned NOT NULL,
+  `worker` varchar(64) NOT NULL,
+  `cpu_time` double NOT NULL,
+  `peak_memory` bigint(20) unsigned NOT NULL,
+  `memory_failures` int(10) unsigned NOT NULL,
+  `throttled_periods` int(10) unsigned NOT NULL,
+  `throttled_time` double NOT NULL,
+  PRIMARY KEY (`game_id`,`user_id`,`bot_id`),
+  KEY `game_bot_resource_bot` (`user_id`,`bot_id`),
+  KEY `game_bot_resource_worker` (`worker`),
+  CONSTRAINT `game_bot_resource_bot_fk` FOREIGN KEY (`user_id`, `bot_id`) REFERENCES `bot` (`user_id`, `id`) ON DELETE CASCADE,
+  CONSTRAINT `game_bot_resource_game_fk` FOREIGN KEY (`game_id`) REFERENCES `game` (`id`) ON DELETE CASCADE
+) ENGINE=InnoDB DEFAULT CHARSET=utf8;
+/*!40101 SET character_set_client = @saved_cs_client */;
+
 --
 -- Table structure for table `game_bot_stat`
 --
@@ -523,7 +571,7 @@ SET @@SESSION.SQL_LOG_BIN= 0;
 
 LOCK TABLES `alembic_version` WRITE;
 /*!40000 ALTER TABLE `alembic_version` DISABLE KEYS */;
-INSERT INTO `alembic_version` VALUES ('451d4bb125cb');
+INSERT INTO `alembic_version` VALUES ('e7a2c95b1d38');
 /*!40000 ALTER TABLE `alembic_version` ENABLE KEYS */;
 UNLOCK TABLES;
 SET @@SESSION.SQL_LOG_BIN = @MYSQLDUMP_TEMP_LOG_BIN;
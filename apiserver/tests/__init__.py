@@ -0,0 +1,11 @@
+"""
+Unit tests for the API server.
+
+Run them from the apiserver directory with:
+
+    python3 -m unittest discover tests
+
+Importing apiserver.model reflects the tables of the configured database
+(config.DATABASE_URL), so it must be reachable, although the tests don't
+read or write any rows.
+"""
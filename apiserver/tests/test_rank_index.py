@@ -0,0 +1,107 @@
+import random
+import unittest
+
+from apiserver import config, rank_index, util
+
+
+SEED = 0
+
+
+def make_rows(scores, played=()):
+    """Build index rows from a {(user_id, bot_id): score} dictionary."""
+    return [{
+        "user_id": user_id,
+        "bot_id": bot_id,
+        "score": score,
+        "games_played": 1 if (user_id, bot_id) in played else 0,
+    } for (user_id, bot_id), score in scores.items()]
+
+
+def expected_ranks(scores):
+    """Rank bots by score, highest first, then by user and bot ID."""
+    order = sorted(scores, key=lambda key: (-scores[key], key))
+    return {key: rank for rank, key in enumerate(order, 1)}
+
+
+class TestRankIndex(unittest.TestCase):
+    def assert_ranks(self, index, scores):
+        for key, rank in expected_ranks(scores).items():
+            self.assertEqual(index.rank(*key), rank, key)
+
+    def test_ranks_are_distinct(self):
+        scores = {
+            (1, 0): 10.0,
+            (2, 0): 12.5,
+            (2, 1): 10.0,
+            (3, 0): 10.0,
+            (4, 0): -3.0,
+        }
+        index = rank_index.RankIndex(make_rows(scores))
+
+        self.assertEqual(index.rank(2, 0), 1)
+        # Ties are broken by user ID, then bot ID
+        self.assertEqual(index.rank(1, 0), 2)
+        self.assertEqual(index.rank(2, 1), 3)
+        self.assertEqual(index.rank(3, 0), 4)
+        self.assertEqual(index.rank(4, 0), 5)
+        self.assertIsNone(index.rank(5, 0))
+
+    def test_ranks_match_sorting(self):
+        rng = random.Random(SEED)
+        for _ in range(50):
+            # Few distinct scores, so that many bots tie
+            scores = {
+                (rng.randrange(20), rng.randrange(3)):
+                    rng.choice([0, 1.25, 5, 5.01, 30])
+                for _ in range(rng.randrange(60))
+            }
+            index = rank_index.RankIndex(make_rows(scores))
+            self.assertEqual(len(index), len(scores))
+            self.assert_ranks(index, scores)
+
+    def test_updates_and_removals(self):
+        rng = random.Random(SEED)
+        scores = {(user_id, 0): rng.uniform(0, 40) for user_id in range(40)}
+        index = rank_index.RankIndex(make_rows(scores))
+
+        for _ in range(500):
+            key = (rng.randrange(50), rng.randrange(2))
+            if key in scores and rng.random() < 0.2:
+                del scores[key]
+                index.remove(*key)
+            else:
+                # Including scores beyond the buckets the index was built
+                # with, which land in the edge buckets
+                scores[key] = round(rng.uniform(-100, 140), 1)
+                index.update(key[0], key[1], scores[key])
+
+        self.assertEqual(len(index), len(scores))
+        self.assert_ranks(index, scores)
+
+    def test_tiers(self):
+        scores = {(user_id, 0): float(user_id) for user_id in range(1, 1001)}
+        scores[(1, 1)] = 0.5
+        # Users 1 to 600 have played, user 1 with both bots
+        played = {(user_id, 0) for user_id in range(1, 601)} | {(1, 1)}
+        index = rank_index.RankIndex(make_rows(scores, played))
+
+        self.assertEqual(index.total_ranked_users, 600)
+        self.assertEqual(index.tier_thresholds(), util.tier_thresholds(600))
+        for rank in (1, 2, 3, 4, 5, 6, 10, 11, 20, 599, 600, 601, 1001):
+            self.assertEqual(index.tier(rank), util.tier(rank, 600))
+        self.assertEqual(index.tier(1), config.TIER_0_NAME)
+        self.assertEqual(index.tier(1001), config.TIER_4_NAME)
+
+        index.update(700, 0, 700.0, played=True)
+        self.assertEqual(index.total_ranked_users, 601)
+
+        # A user stays ranked until their last played bot is removed
+        index.remove(1, 0)
+        self.assertEqual(index.total_ranked_users, 601)
+        index.remove(1, 1)
+        self.assertEqual(index.total_ranked_users, 600)
+        self.assertEqual(index.tier_thresholds(), util.tier_thresholds(600))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,106 @@
+import random
+import unittest
+
+from apiserver.coordinator import ranking_cache
+
+
+SEED = 0
+
+
+def make_rows(mus):
+    """Build snapshot rows for bots with the given mus, in rank order."""
+    return [{
+        "user_id": user_id,
+        "bot_id": 0,
+        "username": "user{}".format(user_id),
+        "version_number": 1,
+        "mu": mu,
+        "sigma": 1.0,
+        "score": mu - 3,
+        "games_played": 1,
+        "compile_status": "Successful",
+        "is_gpu_enabled": False,
+        "rank": rank,
+    } for rank, (user_id, mu) in enumerate(
+        sorted(enumerate(mus), key=lambda item: -item[1]), 1)]
+
+
+def any_bot(bot):
+    return True
+
+
+def expected_closest(snapshot, mu, limit, predicate):
+    """Find the closest bots by sorting them all by distance."""
+    candidates = sorted((bot for bot in snapshot.bots if predicate(bot)),
+                        key=lambda bot: abs(bot["mu"] - mu))
+    return candidates[:limit]
+
+
+class TestClosestByMu(unittest.TestCase):
+    def assert_closest(self, snapshot, mu, limit, predicate):
+        result = snapshot.closest_by_mu(mu, limit, predicate)
+
+        expected = expected_closest(snapshot, mu, limit, predicate)
+        self.assertEqual(len(result), len(expected))
+        # Equally close bots may come in either order
+        self.assertEqual([abs(bot["mu"] - mu) for bot in result],
+                         [abs(bot["mu"] - mu) for bot in expected])
+        self.assertTrue(all(predicate(bot) for bot in result))
+        self.assertEqual(len(set(id(bot) for bot in result)), len(result))
+
+    def test_nearest_first(self):
+        snapshot = ranking_cache.RankingSnapshot(
+            make_rows([10, 20, 24, 27, 40]))
+        result = snapshot.closest_by_mu(25, 3, any_bot)
+        self.assertEqual([bot["mu"] for bot in result], [24, 27, 20])
+
+    def test_predicate(self):
+        snapshot = ranking_cache.RankingSnapshot(
+            make_rows([10, 20, 24, 27, 40]))
+        result = snapshot.closest_by_mu(
+            25, 2, lambda bot: bot["mu"] % 2 == 0)
+        self.assertEqual([bot["mu"] for bot in result], [24, 20])
+
+        self.assertEqual(snapshot.closest_by_mu(25, 2, lambda bot: False), [])
+
+    def test_beyond_the_ends(self):
+        snapshot = ranking_cache.RankingSnapshot(make_rows([10, 20, 30]))
+        self.assertEqual(
+            [bot["mu"] for bot in snapshot.closest_by_mu(0, 2, any_bot)],
+            [10, 20])
+        self.assertEqual(
+            [bot["mu"] for bot in snapshot.closest_by_mu(99, 5, any_bot)],
+            [30, 20, 10])
+
+    def test_empty(self):
+        snapshot = ranking_cache.RankingSnapshot([])
+        self.assertEqual(snapshot.closest_by_mu(25, 3, any_bot), [])
+
+    def test_matches_sorting(self):
+        rng = random.Random(SEED)
+        for _ in range(50):
+            mus = [rng.choice([rng.uniform(0, 50), 25.0])
+                   for _ in range(rng.randrange(40))]
+            snapshot = ranking_cache.RankingSnapshot(make_rows(mus))
+            modulus = rng.randint(1, 4)
+            self.assert_closest(
+                snapshot, rng.uniform(-10, 60), rng.randint(1, 10),
+                lambda bot: bot["user_id"] % modulus == 0)
+
+    def test_after_rating_update(self):
+        snapshot = ranking_cache.RankingSnapshot(make_rows([10, 20, 30]))
+        self.assertEqual(
+            [bot["mu"] for bot in snapshot.closest_by_mu(29, 1, any_bot)],
+            [30])
+
+        # The bot that had mu 10 is now the closest
+        bot = snapshot.bots[-1]
+        snapshot.update_rating(bot["user_id"], bot["bot_id"], 1, 28.5, 1.0,
+                               25.5)
+        self.assertEqual(
+            [bot["mu"] for bot in snapshot.closest_by_mu(29, 1, any_bot)],
+            [28.5])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,58 @@
+import unittest
+
+from apiserver import config, rating
+
+
+# Enough to tell a wrong formula apart from floating-point noise
+PLACES = 9
+
+RATINGS = [
+    (25.0, 25 / 3),
+    (25.0, 25 / 3),
+    (38.2, 1.1),
+    (12.7, 6.4),
+    (30.0, 0.9),
+    (-4.5, 2.0),
+]
+
+
+class TestRate(unittest.TestCase):
+    def environments(self):
+        return [
+            rating.environment(config.RATING_TAU,
+                               config.RATING_DRAW_PROBABILITY),
+            rating.environment(config.FINALS_RATING_TAU,
+                               config.RATING_DRAW_PROBABILITY),
+            rating.environment(25 / 300, 0.1),
+        ]
+
+    def assert_rated_like_trueskill(self, env, players):
+        expected = env.rate([(env.create_rating(mu=mu, sigma=sigma),)
+                             for mu, sigma in players])
+        result = rating.rate(env, players)
+
+        self.assertEqual(len(result), len(players))
+        for (mu, sigma), (expected_rating,) in zip(result, expected):
+            self.assertAlmostEqual(mu, expected_rating.mu, places=PLACES)
+            self.assertAlmostEqual(sigma, expected_rating.sigma,
+                                   places=PLACES)
+
+    def test_two_players(self):
+        # Two-player games use a closed form instead of trueskill.rate
+        for env in self.environments():
+            for winner in RATINGS:
+                for loser in RATINGS:
+                    self.assert_rated_like_trueskill(env, [winner, loser])
+
+    def test_more_players(self):
+        for env in self.environments():
+            self.assert_rated_like_trueskill(env, RATINGS[:3])
+            self.assert_rated_like_trueskill(env, RATINGS[2:])
+
+    def test_environment_is_reused(self):
+        self.assertIs(rating.environment(0.01, 0.001),
+                      rating.environment(0.01, 0.001))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,74 @@
+import base64
+import datetime
+import json
+import unittest
+
+import sqlalchemy
+
+from apiserver import app, util
+from apiserver.web import util as web_util
+
+
+KEYSET = [
+    (sqlalchemy.Column("time_played", sqlalchemy.DateTime), True),
+    (sqlalchemy.Column("id", sqlalchemy.Integer), True),
+]
+
+
+def encode(values):
+    return base64.urlsafe_b64encode(
+        json.dumps(values).encode("utf-8")).decode("ascii")
+
+
+class TestCursor(unittest.TestCase):
+    def get_cursor(self, cursor, keyset=KEYSET):
+        with app.test_request_context(query_string={"cursor": cursor}):
+            return web_util.get_cursor(keyset)
+
+    def assert_invalid(self, cursor):
+        with self.assertRaises(util.APIError) as context:
+            self.get_cursor(cursor)
+        self.assertEqual(context.exception.status_code, 400)
+
+    def test_round_trip(self):
+        time_played = datetime.datetime(2017, 11, 20, 13, 5, 59, 123456)
+        cursor = web_util.make_cursor([time_played, 42])
+
+        values = self.get_cursor(cursor)
+        # Times are read back as UTC
+        self.assertEqual(values, [
+            time_played.replace(tzinfo=datetime.timezone.utc),
+            42,
+        ])
+
+    def test_round_trip_without_times(self):
+        keyset = [
+            (sqlalchemy.Column("score", sqlalchemy.Float), True),
+            (sqlalchemy.Column("username", sqlalchemy.String), False),
+        ]
+        values = [17.25, "someone"]
+        cursor = web_util.make_cursor(values)
+
+        self.assertEqual(self.get_cursor(cursor, keyset), values)
+
+    def test_cursor_is_url_safe(self):
+        cursor = web_util.make_cursor(["???>>>~~~", 1])
+        self.assertNotIn("+", cursor)
+        self.assertNotIn("/", cursor)
+
+    def test_no_cursor(self):
+        with app.test_request_context():
+            self.assertIsNone(web_util.get_cursor(KEYSET))
+        self.assertIsNone(self.get_cursor(""))
+
+    def test_invalid_cursors(self):
+        self.assert_invalid("not a cursor")
+        self.assert_invalid(base64.urlsafe_b64encode(b"\xff").decode("ascii"))
+        self.assert_invalid(encode({"time_played": "2017-11-20"}))
+        self.assert_invalid(encode(["2017-11-20T13:05:59"]))
+        self.assert_invalid(encode(["2017-11-20T13:05:59", 42, 1]))
+        self.assert_invalid(encode(["yesterday", 42]))
+
+
+if __name__ == "__main__":
+    unittest.main()
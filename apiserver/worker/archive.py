@@ -2,14 +2,94 @@ import zipfile
 import os
 import platform
 import shutil
+import tarfile
+
+import zstd
+
+
+# Archives are told apart by their first bytes
+ZSTD_MAGIC = b"\x28\xb5\x2f\xfd"
+
+# Files that are already compressed, which are stored in zip archives as-is
+# rather than deflated again
+COMPRESSED_EXTENSIONS = {
+    ".7z", ".bz2", ".egg", ".gif", ".gz", ".h5", ".jar", ".jpeg", ".jpg",
+    ".npz", ".png", ".pt", ".pth", ".tgz", ".war", ".whl", ".xz", ".zip",
+    ".zst",
+}
+
+# Compression level of zstd archives, and how many threads compress them
+# (-1 for one per core)
+ZSTD_LEVEL = 3
+ZSTD_THREADS = -1
+
+
+class _ChunkReader(object):
+    """Adapt an iterator of byte chunks to a minimal file-like object."""
+    def __init__(self, chunks):
+        self._chunks = chunks
+        self._buffer = b""
+
+    def read(self, size=-1):
+        while size < 0 or len(self._buffer) < size:
+            chunk = next(self._chunks, None)
+            if chunk is None:
+                break
+            self._buffer += chunk
+
+        if size < 0:
+            size = len(self._buffer)
+        data, self._buffer = self._buffer[:size], self._buffer[size:]
+        return data
+
+
+def _walk(folderPath, excludedPath):
+    """List the directories and files in a folder, with their archive names."""
+    for rootPath, dirs, files in os.walk(folderPath):
+        for name in dirs + files:
+            path = os.path.join(rootPath, name)
+            if os.path.abspath(path) != os.path.abspath(excludedPath):
+                yield path, os.path.relpath(path, folderPath)
+
+
+def _is_safe_member(member):
+    """
+    Whether a tar member may be unpacked: a plain file or directory inside
+    the destination. Links are refused, as the worker changes the
+    permissions of unpacked files, which would follow them.
+    """
+    name = os.path.normpath(member.name)
+    return not (os.path.isabs(name) or name.startswith(os.pardir) or
+                not (member.isfile() or member.isdir()))
 
 
 def unpack(filePath):
-    """Unpacks and deletes a zip file into the files current path"""
+    """
+    Unpacks and deletes an archive into the files current path
+
+    Archives are either zip files or zstd-compressed tar files (see
+    tarFolder).
+    """
     folderPath = os.path.dirname(filePath)
 
-    with zipfile.ZipFile(filePath) as f:
-        f.extractall(folderPath)
+    with open(filePath, "rb") as archive_file:
+        is_zstd = archive_file.read(len(ZSTD_MAGIC)) == ZSTD_MAGIC
+
+    if is_zstd:
+        decompressor = zstd.ZstdDecompressor()
+        with open(filePath, "rb") as archive_file:
+            chunks = decompressor.read_from(archive_file)
+            with tarfile.open(fileobj=_ChunkReader(chunks), mode="r|") as f:
+                for member in f:
+                    if _is_safe_member(member):
+                        f.extract(member, folderPath)
+            # Finish decompressing (the tar file's padding) while the file
+            # is still open
+            for _ in chunks:
+                pass
+    else:
+        with zipfile.ZipFile(filePath) as f:
+            f.extractall(folderPath)
 
     # Remove __MACOSX folder if present
     macFolderPath = os.path.join(folderPath, "__MACOSX")
@@ -21,17 +101,34 @@ def unpack(filePath):
 
 def zipFolder(folderPath, destinationFilePath):
     """Zips a folder to a path"""
-    zipFile = zipfile.ZipFile(destinationFilePath, "w", zipfile.ZIP_DEFLATED)
+    with zipfile.ZipFile(destinationFilePath, "w",
+                         zipfile.ZIP_DEFLATED) as zipFile:
+        for path, name in _walk(folderPath, destinationFilePath):
+            if os.path.isdir(path):
+                continue
+            extension = os.path.splitext(path)[1].lower()
+            if extension in COMPRESSED_EXTENSIONS:
+                zipFile.write(path, name, zipfile.ZIP_STORED)
+            else:
+                zipFile.write(path, name)
 
-    originalDir = os.getcwd()
-    try:
-        os.chdir(folderPath)
 
-        for rootPath, dirs, files in os.walk("."):
-            for file in files:
-                if os.path.basename(file) != os.path.basename(destinationFilePath):
-                    zipFile.write(os.path.join(rootPath, file))
+def tarFolder(folderPath, destinationFilePath):
+    """
+    Packs a folder into a zstd-compressed tar file at a path
 
-        zipFile.close()
-    finally:
-        os.chdir(originalDir)
+    Unlike zip files, these keep file permissions, and are compressed with
+    several threads. Already compressed files cost little extra, as zstd
+    stores blocks it can't compress as-is. Symlinks (which compilation may
+    have created) are left out, like anything that isn't a plain file or
+    directory.
+    """
+    compressor = zstd.ZstdCompressor(level=ZSTD_LEVEL, threads=ZSTD_THREADS)
+    with open(destinationFilePath, "wb") as archive_file:
+        with compressor.write_to(archive_file) as writer:
+            with tarfile.open(fileobj=writer, mode="w|") as tarFile:
+                for path, name in _walk(folderPath, destinationFilePath):
+                    if os.path.islink(path) or not (
+                            os.path.isfile(path) or os.path.isdir(path)):
+                        continue
+                    tarFile.add(path, name, recursive=False)
@@ -1,5 +1,5 @@
-import urllib.request
 import requests
+import requests.adapters
 from hashlib import md5
 import json
 import os
@@ -12,6 +12,19 @@ MAX_BOT_UPLOAD_SIZE = 100 * 1024 * 1024
 # Maximum wait time in between compiled bot archive upload attempts,
 # in seconds
 MAX_UPLOAD_BACKOFF = 32
+# Bots are downloaded in chunks of this many bytes
+DOWNLOAD_CHUNK_SIZE = 256 * 1024
+# Connect and read timeouts for bot downloads, in seconds
+DOWNLOAD_TIMEOUT = (10, 60)
+# How long the coordinator may hold a task request while waiting for a
+# task, in seconds
+TASK_WAIT = 25
+
+# Keeps connections to the coordinator open between requests, and shares
+# them among the threads running games
+session = requests.Session()
+session.mount("http://", requests.adapters.HTTPAdapter(pool_maxsize=16))
+session.mount("https://", requests.adapters.HTTPAdapter(pool_maxsize=16))
 
 
 with open("config.json") as configfile:
@@ -19,17 +32,34 @@ with open("config.json") as configfile:
     MANAGER_URL = config["MANAGER_URL"]
     SECRET_FOLDER = config["SECRET_FOLDER"]
     CAPABILITIES = config.get("CAPABILITIES", [])
+    # How many games to run at once; by default, derived from the machine
+    GAME_SLOTS = config.get("GAME_SLOTS")
+    # Whether to only compile bots, several at once, rather than play games
+    COMPILE_WORKER = config.get("COMPILE_WORKER", False)
+    # How many bots a compile worker compiles at once; by default, derived
+    # from the machine
+    COMPILE_SLOTS = config.get("COMPILE_SLOTS")
+    # How compiled bots are packed: "zstd" (a zstd-compressed tar file), or
+    # "zip" while there are still workers that can only unpack zip files
+    ARTIFACT_FORMAT = config.get("ARTIFACT_FORMAT", "zstd")
     provided_size = config.get("MAX_BOT_UPLOAD_SIZE", MAX_BOT_UPLOAD_SIZE)
     if provided_size:
         MAX_BOT_UPLOAD_SIZE = provided_size
 
 
-def getTask():
-    """Gets either a run or a compile task from the API"""
+def getTask(wait=TASK_WAIT):
+    """
+    Gets either a run or a compile task from the API
+
+    :param wait: How many seconds the coordinator may wait for a task to
+    become ready before answering that there is none.
+    """
     params = {
         "capability": CAPABILITIES,
+        "wait": wait,
     }
-    content = requests.get(MANAGER_URL+"task", params=params).text
+    content = session.get(MANAGER_URL+"task", params=params,
+                          timeout=(10, wait + 30)).text
 
     print("Task call %s\n" % content)
     if content == "null":
@@ -38,6 +68,30 @@ def getTask():
         return json.loads(content)
 
 
+def getCompileTasks(count):
+    """
+    Gets up to count compile tasks from the API, for a compile worker
+
+    :return: A list of compile tasks, empty if there are none.
+    """
+    params = {
+        "capability": CAPABILITIES,
+        "compile_only": 1,
+        "compile_count": count,
+    }
+    content = session.get(MANAGER_URL+"task", params=params,
+                          timeout=(10, 30)).text
+
+    print("Task call %s\n" % content)
+    task = json.loads(content)
+    if task["type"] == "compile_batch":
+        return task["tasks"]
+    elif task["type"] == "compile":
+        return [task]
+    else:
+        return []
+
+
 def getBotHash(user_id, bot_id, is_compile=False):
     """Gets the checksum of a user's bot's zipped source code"""
     params = {
@@ -47,7 +101,7 @@ def getBotHash(user_id, bot_id, is_compile=False):
     if is_compile:
         params["compile"] = 1
 
-    result = requests.get(MANAGER_URL+"botHash", params=params)
+    result = session.get(MANAGER_URL+"botHash", params=params)
 
     print("Getting bot hash %s\n" % result.text)
     return json.loads(result.text).get("hash")
@@ -57,37 +111,76 @@ def storeBotLocally(user_id, bot_id, storage_dir, is_compile=False):
     """
     Download and store a bot's zip file locally
 
-    Checks the file's checksum to make sure the file was downloaded properly
+    The file is streamed to disk and hashed as it arrives, then checked
+    against the hash sent along with it. Interrupted downloads are resumed
+    where they stopped; corrupted ones are started over.
     """
-
-    iterations = 0
-    while iterations < 100:
-        url = MANAGER_URL + "botFile?user_id={}&bot_id={}".format(user_id, bot_id)
-        if is_compile:
-            url += "&compile=1"
-
-        print("Bot file url %s\n" % url)
-
-        remote_zip = urllib.request.urlopen(url)
-        zip_filename = remote_zip.headers.get('Content-disposition').split("filename")[1]
-        zip_path = os.path.join(storage_dir, zip_filename)
-        if os.path.exists(zip_path):
-            os.remove(zip_path)
-
-        remote_zip_contents = remote_zip.read()
-        remote_zip.close()
-
-        local_zip = open(zip_path, "wb")
-        local_zip.write(remote_zip_contents)
-        local_zip.close()
-
-        content_hash = md5(remote_zip_contents).hexdigest()
-        remote_hash = getBotHash(user_id, bot_id, is_compile)
-        if content_hash != remote_hash:
+    params = {
+        "user_id": user_id,
+        "bot_id": bot_id,
+    }
+    if is_compile:
+        params["compile"] = 1
+    zip_path = os.path.join(storage_dir, "{}_{}.zip".format(user_id, bot_id))
+
+    received = 0
+    content_hash = md5()
+    etag = None
+    remote_hash = None
+
+    with open(zip_path, "wb") as local_zip:
+        iterations = 0
+        while iterations < 100:
+            headers = {}
+            if received:
+                headers["Range"] = "bytes={}-".format(received)
+                # Start over if the bot changed in the meantime
+                headers["If-Range"] = etag
+
+            print("Downloading bot %s from byte %d\n" % (params, received))
+            try:
+                result = session.get(MANAGER_URL+"botFile", params=params,
+                                     headers=headers, stream=True,
+                                     timeout=DOWNLOAD_TIMEOUT)
+                try:
+                    result.raise_for_status()
+                    if result.status_code != 206:
+                        received = 0
+                        content_hash = md5()
+                        local_zip.seek(0)
+                        local_zip.truncate()
+                        total_size = int(result.headers["Content-Length"])
+                    else:
+                        total_size = int(result.headers["Content-Range"]
+                                         .rpartition("/")[2])
+                    etag = result.headers.get("ETag")
+                    remote_hash = result.headers.get("X-Bot-Hash")
+
+                    for chunk in result.iter_content(DOWNLOAD_CHUNK_SIZE):
+                        local_zip.write(chunk)
+                        content_hash.update(chunk)
+                        received += len(chunk)
+                finally:
+                    result.close()
+            except (requests.ConnectionError, requests.Timeout,
+                    requests.exceptions.ChunkedEncodingError) as e:
+                print("Bot download interrupted: %s\n" % e)
+                iterations += 1
+                continue
+
+            if received < total_size and etag is not None:
+                iterations += 1
+                continue
+
+            if remote_hash is None:
+                # An older coordinator doesn't send the hash
+                remote_hash = getBotHash(user_id, bot_id, is_compile)
+            if content_hash.hexdigest() == remote_hash:
+                return zip_path
+
+            print("Hashes do not match! Redoing bot download...\n")
+            received = 0
             iterations += 1
-            continue
-
-        return zip_path
 
     raise RuntimeError("Could not download bot with valid hash, aborting")
 
@@ -103,7 +196,7 @@ def storeBotRemotely(user_id, bot_id, zip_file_path):
     backoff = 1
 
     while iterations < 10:
-        r = requests.post(MANAGER_URL+"botFile",
+        r = session.post(MANAGER_URL+"botFile",
                           data={
                               "user_id": str(user_id),
                               "bot_id": str(bot_id),
@@ -129,9 +222,39 @@ def storeBotRemotely(user_id, bot_id, zip_file_path):
     raise RuntimeError("Could not upload bot with valid hash, aborting")
 
 
+def claimCachedBot(user_id, bot_id, source_hash):
+    """
+    Use a compiled bot cached by the coordinator under the hash of its
+    source for a bot.
+
+    :return: The language of the bot, or None if it isn't cached.
+    """
+    r = session.post(MANAGER_URL+"compileCache/claim", data={
+        "user_id": user_id,
+        "bot_id": bot_id,
+        "source_hash": source_hash,
+    })
+    if r.status_code == 404:
+        return None
+    r.raise_for_status()
+    return r.json()["language"]
+
+
+def cacheBot(user_id, bot_id, source_hash, language):
+    """Have the coordinator cache a bot's stored compiled bot."""
+    r = session.post(MANAGER_URL+"compileCache", data={
+        "user_id": user_id,
+        "bot_id": bot_id,
+        "source_hash": source_hash,
+        "language": language,
+    })
+    print("Cached compiled bot %s\n" % r.text)
+    r.raise_for_status()
+
+
 def compileResult(user_id, bot_id, did_compile, language, errors=None):
     """Posts the result of a compilation task"""
-    r = requests.post(MANAGER_URL+"compile", data={
+    r = session.post(MANAGER_URL+"compile", data={
         "user_id": user_id,
         "bot_id": bot_id,
         "did_compile": int(did_compile),
@@ -164,9 +287,62 @@ def gameResult(users, game_output, challenge):
     print("Uploading game result")
     print(json.dumps(users, indent=4))
     print(json.dumps(game_output, indent=4))
-    r = requests.post(MANAGER_URL+"game", data=data, files=files)
+    r = session.post(MANAGER_URL+"game", data=data, files=files)
 
     print("Got game result %s (GMT)\n" % str(strftime("%Y-%m-%d %H:%M:%S", gmtime())))
     print("\n-------Game result:-----")
     print(r.text)
     print("------------------------\n")
+
+
+def gameResults(results):
+    """
+    POST the results of several games to the game coordinator at once.
+    :param results: A list of (users, game_output, challenge, result_id)
+    tuples; the first three as would be passed to gameResult, and an ID
+    unique to the result, so that the coordinator stores it only once.
+    :return: The coordinator's result for each game, in order.
+    """
+    print("Posting %d game results %s (GMT)\n" % (
+        len(results), str(strftime("%Y-%m-%d %H:%M:%S", gmtime()))))
+    files = {}
+    games = []
+    for users, game_output, challenge, result_id in results:
+        # Games in a batch can have files with the same name (error logs
+        # are named after the player and the second the game started), so
+        # each game's files are posted under names prefixed with its
+        # result ID
+        prefix = result_id + "-"
+        replay_path = game_output["replay"]
+        error_log_paths = game_output["error_logs"]
+        game_output = dict(game_output)
+        game_output["replay"] = prefix + os.path.basename(replay_path)
+        game_output["error_logs"] = {
+            player_tag: prefix + os.path.basename(path)
+            for player_tag, path in error_log_paths.items()
+        }
+        users = [dict(user, log_name=prefix + user["log_name"])
+                 if user.get("log_name") else user
+                 for user in users]
+
+        files[game_output["replay"]] = open(replay_path, "rb").read()
+        for player_tag, path in error_log_paths.items():
+            files[game_output["error_logs"][player_tag]] = \
+                open(path, "rb").read()
+
+        games.append({
+            "users": users,
+            "game_output": game_output,
+            "challenge": challenge,
+            "result_id": result_id,
+        })
+
+    r = session.post(MANAGER_URL+"games",
+                      data={"games": json.dumps(games)}, files=files)
+
+    print("Got game results %s (GMT)\n" % str(strftime("%Y-%m-%d %H:%M:%S", gmtime())))
+    print("\n-------Game results:-----")
+    print(r.text)
+    print("-------------------------\n")
+    r.raise_for_status()
+    return r.json()["games"]
@@ -0,0 +1,95 @@
+"""
+Benchmark the compiled bot artifact formats.
+
+Packs each given bot (a directory, or a zip file such as a downloaded
+submission) as a deflated zip file, as a zip file storing already compressed
+files as-is, and as a zstd-compressed tar file, then unpacks it again, and
+reports the median times and the archive sizes.
+
+    python3 benchmark_archive.py [--repeat N] BOT [BOT ...]
+"""
+import argparse
+import os
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+import zipfile
+
+import archive
+
+
+def _old_zip_folder(folderPath, destinationFilePath):
+    """Deflate every file, as compiled bots used to be packed."""
+    with zipfile.ZipFile(destinationFilePath, "w",
+                         zipfile.ZIP_DEFLATED) as zipFile:
+        for path, name in archive._walk(folderPath, destinationFilePath):
+            if not os.path.isdir(path):
+                zipFile.write(path, name)
+
+
+def _directory_size(path):
+    return sum(os.lstat(os.path.join(dirpath, filename)).st_size
+               for dirpath, _, filenames in os.walk(path)
+               for filename in filenames)
+
+
+FORMATS = [
+    ("zip (deflate all)", ".zip", _old_zip_folder),
+    ("zip (store compressed)", ".zip", archive.zipFolder),
+    ("tar.zst", ".tar.zst", archive.tarFolder),
+]
+
+
+def benchmark(bot_dir, work_dir, pack, extension, repeat):
+    pack_times = []
+    unpack_times = []
+    for _ in range(repeat):
+        archive_path = os.path.join(work_dir, "bot" + extension)
+        start = time.perf_counter()
+        pack(bot_dir, archive_path)
+        pack_times.append(time.perf_counter() - start)
+        size = os.path.getsize(archive_path)
+
+        unpack_dir = os.path.join(work_dir, "unpacked")
+        os.mkdir(unpack_dir)
+        unpacked_path = os.path.join(unpack_dir, "bot" + extension)
+        shutil.move(archive_path, unpacked_path)
+        start = time.perf_counter()
+        archive.unpack(unpacked_path)
+        unpack_times.append(time.perf_counter() - start)
+        shutil.rmtree(unpack_dir)
+
+    return (statistics.median(pack_times), statistics.median(unpack_times),
+            size)
+
+
+def main(args=sys.argv[1:]):
+    parser = argparse.ArgumentParser(
+        description="Benchmark packing and unpacking compiled bots.")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("bots", nargs="+",
+                        help="Bot directories or zip files.")
+    cfg = parser.parse_args(args)
+
+    for bot in cfg.bots:
+        with tempfile.TemporaryDirectory() as work_dir:
+            if os.path.isdir(bot):
+                bot_dir = bot
+            else:
+                bot_dir = os.path.join(work_dir, "source")
+                with zipfile.ZipFile(bot) as bot_zip:
+                    bot_zip.extractall(bot_dir)
+
+            print("%s (%.1f MiB)" % (bot, _directory_size(bot_dir)
+                                     / 1024 / 1024))
+            for name, extension, pack in FORMATS:
+                pack_time, unpack_time, size = benchmark(
+                    bot_dir, work_dir, pack, extension, cfg.repeat)
+                print("  %-24s pack %7.1f ms  unpack %7.1f ms  %8.1f KiB" % (
+                    name, pack_time * 1000, unpack_time * 1000, size / 1024))
+
+
+if __name__ == "__main__":
+    main()
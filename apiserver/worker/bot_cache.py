@@ -0,0 +1,168 @@
+"""
+Worker-local cache of compiled bots, extracted and ready to run.
+
+Bots are downloaded (and their hash checked) only when they aren't cached
+yet. Each game gets its own copy of a cached bot, since bots may write to
+their directory and have its permissions changed; copies are made with
+reflinks where the filesystem supports them, so they are cheap.
+
+Bots are keyed by user, bot and version number, as a new version is
+compiled whenever a bot changes. The least recently used bots are deleted
+once the cache grows beyond its size limit.
+"""
+import collections
+import os
+import shutil
+import subprocess
+import tempfile
+import threading
+
+import archive
+import backend
+
+
+# Where extracted bots are cached
+CACHE_DIR = backend.config.get("BOT_CACHE_DIR",
+                               os.path.join(os.getcwd(), "bot_cache"))
+# How many bytes of extracted bots to keep
+CACHE_SIZE = backend.config.get("BOT_CACHE_SIZE", 4 * 1024 * 1024 * 1024)
+
+# Cached bot directories, least recently used first, with their sizes
+_entries = collections.OrderedDict()
+_total_size = 0
+# Directories being copied from, which must not be evicted
+_in_use = collections.Counter()
+_lock = threading.Lock()
+_loaded = False
+# Games wanting the same bot wait for a single download
+_download_locks = [threading.Lock() for _ in range(16)]
+
+
+def _directory_size(path):
+    size = 0
+    for dirpath, _, filenames in os.walk(path):
+        for filename in filenames:
+            size += os.lstat(os.path.join(dirpath, filename)).st_size
+    return size
+
+
+def _load():
+    """Index the bots already in the cache directory."""
+    global _loaded, _total_size
+    os.makedirs(CACHE_DIR, exist_ok=True)
+
+    bots = []
+    for entry in os.scandir(CACHE_DIR):
+        if entry.name.startswith("tmp"):
+            # Left behind by an interrupted download
+            shutil.rmtree(entry.path, ignore_errors=True)
+        elif entry.is_dir():
+            bots.append((entry.stat().st_mtime, entry.path))
+
+    for _, path in sorted(bots):
+        size = _directory_size(path)
+        _entries[path] = size
+        _total_size += size
+    _loaded = True
+
+
+def _evict():
+    """Delete the least recently used bots while over the size limit."""
+    global _total_size
+    for path in list(_entries):
+        if _total_size <= CACHE_SIZE:
+            break
+        if _in_use[path]:
+            continue
+        _total_size -= _entries.pop(path)
+        shutil.rmtree(path, ignore_errors=True)
+
+
+def _add(path, size, outdated_prefix):
+    """Index a newly cached bot, dropping older versions of it."""
+    global _total_size
+    with _lock:
+        for other in list(_entries):
+            if (other != path and not _in_use[other] and
+                    os.path.basename(other).startswith(outdated_prefix)):
+                _total_size -= _entries.pop(other)
+                shutil.rmtree(other, ignore_errors=True)
+
+        _entries[path] = size
+        _total_size += size
+        _evict()
+
+
+def _download(user_id, bot_id, path):
+    """Download and extract a bot into the cache."""
+    staging_dir = tempfile.mkdtemp(dir=CACHE_DIR)
+    try:
+        archive.unpack(backend.storeBotLocally(user_id, bot_id, staging_dir))
+        os.rename(staging_dir, path)
+    except:
+        shutil.rmtree(staging_dir, ignore_errors=True)
+        raise
+
+
+def _acquire(user_id, bot_id, version_number):
+    """
+    Get the cached directory of a bot, downloading it if needed, and keep it
+    from being evicted until it is released.
+    """
+    name = "{}_{}_v{}".format(user_id, bot_id, version_number)
+    path = os.path.join(CACHE_DIR, name)
+
+    with _lock:
+        if not _loaded:
+            _load()
+        cached = path in _entries
+        if cached:
+            _entries.move_to_end(path)
+            _in_use[path] += 1
+
+    if not cached:
+        with _download_locks[hash(name) % len(_download_locks)]:
+            with _lock:
+                cached = path in _entries
+                if cached:
+                    _in_use[path] += 1
+            if not cached:
+                _download(user_id, bot_id, path)
+                with _lock:
+                    _in_use[path] += 1
+                _add(path, _directory_size(path),
+                     "{}_{}_v".format(user_id, bot_id))
+
+    return path
+
+
+def _release(path):
+    with _lock:
+        _in_use[path] -= 1
+        if not _in_use[path]:
+            del _in_use[path]
+        _evict()
+
+
+def prefetch(user_id, bot_id, version_number):
+    """Download a compiled bot into the cache, if it isn't cached."""
+    _release(_acquire(user_id, bot_id, version_number))
+
+
+def copy_bot(user_id, bot_id, version_number, destination):
+    """
+    Copy a compiled bot into a new directory, downloading it if it isn't
+    cached.
+
+    :param destination: The directory to create, which must not exist.
+    """
+    path = _acquire(user_id, bot_id, version_number)
+    try:
+        # Hard links would share files (and permissions) with the cache;
+        # reflinks are copy-on-write
+        subprocess.run(["cp", "-a", "--reflink=auto", path, destination],
+                       check=True)
+        # Keep the order across restarts
+        os.utime(path)
+    finally:
+        _release(path)
@@ -0,0 +1,160 @@
+"""
+Reuse of compiled bots whose source was compiled before.
+
+Bots are often submitted again unchanged, and many submissions are
+unmodified starter kits. Before compiling, the normalized source tree (file
+paths, contents and executable bits, ignoring OS and editor clutter) is
+hashed, along with the artifact format and CACHE_VERSION. The hash is
+looked up first with the coordinator, which keeps compiled bots in object
+storage and copies them into place there, then in a cache on local disk,
+whose hits are uploaded like a new compiled bot. Successfully compiled
+bots are cached in both, with their language.
+"""
+import hashlib
+import json
+import logging
+import os
+import shutil
+import stat
+import tempfile
+
+import backend
+
+
+# Bump to stop reusing bots compiled before, e.g. when compilers change
+CACHE_VERSION = 1
+
+# Where compiled bots are cached locally
+CACHE_DIR = backend.config.get("COMPILE_CACHE_DIR",
+                               os.path.join(os.getcwd(), "compile_cache"))
+# How many bytes of compiled bots to keep locally
+CACHE_SIZE = backend.config.get("COMPILE_CACHE_SIZE", 2 * 1024 * 1024 * 1024)
+
+# Files and directories that don't affect how a bot compiles or runs
+IGNORED_NAMES = {
+    ".DS_Store", "Thumbs.db", "desktop.ini",
+    "__MACOSX", ".git", ".hg", ".svn", ".idea", ".vscode",
+}
+
+_ARTIFACT = "bot"
+_LANGUAGE = "language.json"
+
+
+def source_hash(bot_dir):
+    """Hash the normalized source tree of a bot."""
+    digest = hashlib.sha256("{} {}\n".format(
+        CACHE_VERSION, backend.ARTIFACT_FORMAT).encode("utf-8"))
+
+    for dirpath, dirnames, filenames in os.walk(bot_dir):
+        dirnames[:] = sorted(name for name in dirnames
+                             if name not in IGNORED_NAMES)
+        for filename in sorted(filenames):
+            if filename in IGNORED_NAMES:
+                continue
+            path = os.path.join(dirpath, filename)
+            mode = os.lstat(path).st_mode
+            if not stat.S_ISREG(mode):
+                continue
+
+            file_digest = hashlib.sha256()
+            with open(path, "rb") as source_file:
+                for chunk in iter(lambda: source_file.read(65536), b""):
+                    file_digest.update(chunk)
+
+            digest.update("{}\0{:d}\0{}\n".format(
+                os.path.relpath(path, bot_dir).replace(os.sep, "/"),
+                bool(mode & stat.S_IXUSR),
+                file_digest.hexdigest()).encode("utf-8"))
+
+    return digest.hexdigest()
+
+
+def _evict():
+    """Delete the least recently used bots while over the size limit."""
+    entries = []
+    total_size = 0
+    for entry in os.scandir(CACHE_DIR):
+        if not entry.is_dir() or entry.name.startswith("tmp"):
+            continue
+        artifact_path = os.path.join(entry.path, _ARTIFACT)
+        try:
+            artifact_stat = os.stat(artifact_path)
+        except FileNotFoundError:
+            continue
+        entries.append((artifact_stat.st_mtime, entry.path,
+                        artifact_stat.st_size))
+        total_size += artifact_stat.st_size
+
+    for _, path, size in sorted(entries):
+        if total_size <= CACHE_SIZE:
+            break
+        shutil.rmtree(path, ignore_errors=True)
+        total_size -= size
+
+
+def reuse(user_id, bot_id, bot_hash):
+    """
+    Use a cached compiled bot with the given source hash for a bot.
+
+    :return: The language of the bot, or None if it isn't cached (or can't
+    be reused).
+    """
+    try:
+        language = backend.claimCachedBot(user_id, bot_id, bot_hash)
+        if language is not None:
+            logging.info("Reusing compiled bot {}".format(bot_hash))
+            return language
+    except Exception:
+        logging.exception("Could not look up compiled bot {}".format(
+            bot_hash))
+
+    path = os.path.join(CACHE_DIR, bot_hash)
+    try:
+        with open(os.path.join(path, _LANGUAGE)) as language_file:
+            language = json.load(language_file)["language"]
+    except (OSError, ValueError, KeyError):
+        return None
+
+    artifact_path = os.path.join(path, _ARTIFACT)
+    try:
+        backend.storeBotRemotely(user_id, bot_id, artifact_path)
+        # Keep the order across restarts
+        os.utime(artifact_path)
+    except Exception:
+        logging.exception("Could not reuse compiled bot {}".format(bot_hash))
+        return None
+
+    logging.info("Reusing locally compiled bot {}".format(bot_hash))
+    return language
+
+
+def store(user_id, bot_id, bot_hash, language, archive_path):
+    """
+    Cache a bot that was just compiled and stored, with its language, for
+    other bots to reuse.
+    """
+    try:
+        backend.cacheBot(user_id, bot_id, bot_hash, language)
+    except Exception:
+        logging.exception("Could not cache compiled bot {}".format(bot_hash))
+
+    path = os.path.join(CACHE_DIR, bot_hash)
+    if os.path.isdir(path):
+        return
+
+    try:
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        staging_dir = tempfile.mkdtemp(dir=CACHE_DIR)
+        try:
+            shutil.copyfile(archive_path,
+                            os.path.join(staging_dir, _ARTIFACT))
+            with open(os.path.join(staging_dir, _LANGUAGE),
+                      "w") as language_file:
+                json.dump({"language": language}, language_file)
+            os.rename(staging_dir, path)
+        finally:
+            shutil.rmtree(staging_dir, ignore_errors=True)
+        _evict()
+    except OSError:
+        logging.exception("Could not cache compiled bot {} locally".format(
+            bot_hash))
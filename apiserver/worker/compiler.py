@@ -6,7 +6,9 @@ import errno
 import fnmatch
 import os
 import os.path
+import pwd
 import re
+import shlex
 import subprocess
 import sys
 
@@ -22,6 +24,10 @@ BOT = "MyBot"
 # Which file is used to override the detected language?
 LANGUAGE_FILE = "LANGUAGE"
 SAFEPATH = re.compile('[a-zA-Z0-9_.$-]+$')
+# The user compilation commands run as. Compilation changes the working
+# directory, so concurrent compilations run in separate processes, each
+# setting its own user.
+SANDBOX_USER = "bot_compilation"
 
 
 class CD(object):
@@ -67,16 +73,37 @@ def nukeglob(pattern):
                 raise
 
 
-def _run_cmd(cmd, working_dir, timelimit):
+def sandbox_users():
+    """
+    The users concurrent compilations run as: bot_compilation_0,
+    bot_compilation_1 and so on, as far as they are provisioned (see
+    admin/setup_worker_image.sh), or only bot_compilation if none are.
+    """
+    users = []
+    while True:
+        user = "bot_compilation_{}".format(len(users))
+        try:
+            pwd.getpwnam(user)
+        except KeyError:
+            break
+        users.append(user)
+    return users or ["bot_compilation"]
+
+
+def _run_cmd(cmd, working_dir, timelimit, env=None):
     """
     Run a compilation command in the sandbox.
     :param cmd: The command to run.
     :param working_dir: The directory to run the command in.
     :param timelimit: The number of seconds the command is allowed to run.
+    :param env: Environment variables to set for the command, if any.
     :return: The value of stdout as well as any errors that occurred.
     """
     absoluteWorkingDir = os.path.abspath(working_dir)
-    cmd = "sudo -H -iu bot_compilation bash -c \"cd "+absoluteWorkingDir+"; "+cmd+"\""
+    # sudo -i resets the environment, so set variables inside the sandbox
+    exports = "".join("export {}={}; ".format(name, shlex.quote(value))
+                      for name, value in sorted((env or {}).items()))
+    cmd = "sudo -H -iu "+SANDBOX_USER+" bash -c \"cd "+absoluteWorkingDir+"; "+exports+cmd+"\""
     print(cmd)
     process = subprocess.Popen(cmd, cwd=working_dir, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE, stdin=subprocess.PIPE)
 
@@ -92,7 +119,7 @@ def _run_cmd(cmd, working_dir, timelimit):
         errors = ["Compilation timed out with command %s" % (cmd,)]
 
     # Clean up any processes that didn't exit cleanly
-    util.kill_processes_as("bot_compilation")
+    util.kill_processes_as(SANDBOX_USER)
 
     return out, errors, process.returncode
 
@@ -813,12 +840,20 @@ def truncate_errors(install_stdout, install_errors, language_detection_errors,
     return result
 
 
-def compile_anything(bot_dir, installTimeLimit=600, timelimit=600, max_error_len=10*1024):
+def compile_anything(bot_dir, installTimeLimit=600, timelimit=600, max_error_len=10*1024, install_env=None):
+    """
+    Run a bot's install.sh, if any, then detect its language and compile it.
+
+    :param install_env: Environment variables for install.sh, e.g. to point
+    package managers at a dependency cache.
+    :return: The language, and a list of errors or None on success.
+    """
     install_stdout = []
     install_errors = []
     if os.path.exists(os.path.join(bot_dir, "install.sh")):
         install_stdout, install_errors, _ = _run_cmd(
-            "chmod +x install.sh; ./install.sh", bot_dir, installTimeLimit)
+            "chmod +x install.sh; ./install.sh", bot_dir, installTimeLimit,
+            env=install_env)
 
     detected_language, language_errors = detect_language(bot_dir)
 
@@ -0,0 +1,162 @@
+"""
+Per-user caches of the packages that install.sh scripts download.
+
+Package managers (pip, cargo, npm, Maven, Gradle) are pointed at a cache
+directory through their environment variables while a bot's install.sh
+runs. Caches are kept per user, not shared: compilations run as the same
+few sandbox users, so a shared cache would let one user's install.sh plant
+packages that other users' bots then install.
+
+While not in use, a user's cache is owned by the worker and inaccessible
+to the sandbox users. It is checked out to an unguessable path for the
+compilation, then checked back in. A cache that grows beyond
+USER_CACHE_SIZE is discarded, and the least recently used caches are
+discarded once all of them take more than CACHE_SIZE.
+"""
+import logging
+import os
+import shutil
+import subprocess
+import tempfile
+import threading
+
+import backend
+import compiler
+
+
+# Where users' dependency caches are kept
+CACHE_DIR = backend.config.get("DEPENDENCY_CACHE_DIR",
+                               os.path.join(os.getcwd(), "dependency_cache"))
+# How many bytes of dependencies to keep for all users
+CACHE_SIZE = backend.config.get("DEPENDENCY_CACHE_SIZE",
+                                8 * 1024 * 1024 * 1024)
+# How many bytes of dependencies to keep for a single user
+USER_CACHE_SIZE = backend.config.get("DEPENDENCY_CACHE_USER_SIZE",
+                                     1024 * 1024 * 1024)
+
+# Sizes of the checked in caches, by user ID (as a string)
+_sizes = {}
+_lock = threading.Lock()
+_loaded = False
+
+
+def _directory_size(path):
+    size = 0
+    for dirpath, _, filenames in os.walk(path):
+        for filename in filenames:
+            try:
+                size += os.lstat(os.path.join(dirpath, filename)).st_size
+            except OSError:
+                pass
+    return size
+
+
+def _remove(path):
+    """Remove a cache, whose files belong to the sandbox users."""
+    shutil.chown(path, group="bots")
+    os.chmod(path, 0o2770)
+    # Any of the users compilations run as may have written to it
+    for user in {"bot_compilation"} | set(compiler.sandbox_users()):
+        subprocess.call(["sudo", "-H", "-u", user,
+                         "find", path, "-mindepth", "1", "-delete"],
+                        stderr=subprocess.PIPE,
+                        stdout=subprocess.PIPE)
+    shutil.rmtree(path, ignore_errors=True)
+
+
+def environment(path):
+    """The environment variables that point package managers at a cache."""
+    return {
+        "PIP_CACHE_DIR": os.path.join(path, "pip"),
+        "CARGO_HOME": os.path.join(path, "cargo"),
+        "npm_config_cache": os.path.join(path, "npm"),
+        "MAVEN_OPTS": "-Dmaven.repo.local=" + os.path.join(path, "maven"),
+        "GRADLE_USER_HOME": os.path.join(path, "gradle"),
+    }
+
+
+def checkout(user_id):
+    """
+    Make a user's dependency cache available to the sandbox users.
+
+    :return: The path of the cache, a new empty one if the user had none.
+    """
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    # Others may enter the directory, but not list it
+    os.chmod(CACHE_DIR, 0o711)
+
+    with _lock:
+        if not _loaded:
+            _load()
+        path = tempfile.mkdtemp(dir=CACHE_DIR, prefix="checkout")
+        try:
+            os.replace(os.path.join(CACHE_DIR, str(user_id)), path)
+            _sizes.pop(str(user_id), None)
+        except FileNotFoundError:
+            # None yet, or checked out by another compilation of the user's
+            pass
+
+    shutil.chown(path, group="bots")
+    os.chmod(path, 0o2770)
+    return path
+
+
+def checkin(user_id, path):
+    """Take a user's dependency cache back from the sandbox users."""
+    os.chmod(path, 0o700)
+    size = _directory_size(path)
+    if size > USER_CACHE_SIZE:
+        logging.info("Discarding dependency cache of user {} ({} bytes)"
+                     .format(user_id, size))
+        _remove(path)
+        return
+
+    with _lock:
+        try:
+            # Fails if another compilation of the user's checked in first
+            os.rename(path, os.path.join(CACHE_DIR, str(user_id)))
+            # Mark it as recently used
+            os.utime(os.path.join(CACHE_DIR, str(user_id)))
+            _sizes[str(user_id)] = size
+        except OSError:
+            pass
+        evicted = _evict()
+
+    if os.path.exists(path):
+        _remove(path)
+    for evicted_path in evicted:
+        _remove(evicted_path)
+
+
+def _load():
+    """Measure the caches already in the cache directory."""
+    global _loaded
+    for entry in os.scandir(CACHE_DIR):
+        if entry.name.startswith("checkout"):
+            # Left behind by a compilation interrupted by a restart
+            _remove(entry.path)
+        elif entry.is_dir():
+            _sizes[entry.name] = _directory_size(entry.path)
+    _loaded = True
+
+
+def _evict():
+    """
+    Check out the least recently used caches while over the size limit.
+
+    :return: The paths of the evicted caches, to remove.
+    """
+    total_size = sum(_sizes.values())
+    if total_size <= CACHE_SIZE:
+        return []
+
+    evicted = []
+    for _, name in sorted((os.stat(os.path.join(CACHE_DIR, name)).st_mtime,
+                           name) for name in _sizes):
+        if total_size <= CACHE_SIZE:
+            break
+        path = tempfile.mkdtemp(dir=CACHE_DIR, prefix="checkout")
+        os.replace(os.path.join(CACHE_DIR, name), path)
+        total_size -= _sizes.pop(name)
+        evicted.append(path)
+    return evicted
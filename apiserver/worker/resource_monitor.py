@@ -0,0 +1,130 @@
+"""
+Resource usage of bots during games, read from their (v1) cgroups.
+
+The cgroups' counters (CPU time, CPU throttling, memory allocation
+failures) add up over all the games a cgroup has run, and the worker may
+not reset them, so a game's usage is the difference between the counters
+at its start and end. Peak memory is memory.max_usage_in_bytes if it rose
+during the game, and otherwise the highest memory usage seen while
+sampling every SAMPLE_INTERVAL seconds.
+"""
+import os
+import socket
+import threading
+
+import backend
+
+
+# Where the cgroup controllers are mounted
+CGROUP_ROOT = "/sys/fs/cgroup"
+# How often to sample the memory usage of bots during a game, in seconds
+SAMPLE_INTERVAL = backend.config.get("RESOURCE_SAMPLE_INTERVAL", 1)
+
+# Reported along with the usage, to tell hosts apart
+HOSTNAME = socket.gethostname()
+
+
+def _read_int(controller, cgroup, name):
+    with open(os.path.join(CGROUP_ROOT, controller, cgroup, name)) as f:
+        return int(f.read())
+
+
+def _read_stat(controller, cgroup, name):
+    with open(os.path.join(CGROUP_ROOT, controller, cgroup, name)) as f:
+        return {key: int(value)
+                for key, value in (line.split() for line in f)}
+
+
+def read_counters(cgroup):
+    """
+    Read the counters of a cgroup.
+
+    :return: A dictionary of counters, or None if the cgroup (or one of
+    its controllers) doesn't exist.
+    """
+    try:
+        cpu_stat = _read_stat("cpu", cgroup, "cpu.stat")
+        return {
+            "cpu_usage": _read_int("cpuacct", cgroup, "cpuacct.usage"),
+            "nr_throttled": cpu_stat.get("nr_throttled", 0),
+            "throttled_time": cpu_stat.get("throttled_time", 0),
+            "memory_usage": _read_int("memory", cgroup,
+                                      "memory.usage_in_bytes"),
+            "memory_max_usage": _read_int("memory", cgroup,
+                                          "memory.max_usage_in_bytes"),
+            "memory_failcnt": _read_int("memory", cgroup, "memory.failcnt"),
+        }
+    except (OSError, ValueError):
+        return None
+
+
+def summarize(start, end, peak_memory):
+    """Summarize the usage of a cgroup between two readings."""
+    if end["memory_max_usage"] > start["memory_max_usage"]:
+        peak_memory = end["memory_max_usage"]
+
+    return {
+        "worker": HOSTNAME,
+        # Seconds
+        "cpu_time": round((end["cpu_usage"] - start["cpu_usage"]) / 1e9, 3),
+        # Bytes
+        "peak_memory": max(peak_memory, end["memory_usage"]),
+        # Times the memory limit was hit
+        "memory_failures": end["memory_failcnt"] - start["memory_failcnt"],
+        # CFS periods in which the bot was throttled, and for how many
+        # seconds in total
+        "throttled_periods": end["nr_throttled"] - start["nr_throttled"],
+        "throttled_time": round(
+            (end["throttled_time"] - start["throttled_time"]) / 1e9, 3),
+    }
+
+
+class Monitor(object):
+    """Samples the cgroups of a game's bots from start() to stop()."""
+    def __init__(self, cgroups):
+        self.cgroups = cgroups
+        self._start = []
+        self._peak_memory = []
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._start = [read_counters(cgroup) for cgroup in self.cgroups]
+        self._peak_memory = [0] * len(self.cgroups)
+        self._thread = threading.Thread(target=self._sample,
+                                        name="resource-monitor",
+                                        daemon=True)
+        self._thread.start()
+
+    def _sample(self):
+        while not self._stopped.wait(SAMPLE_INTERVAL):
+            for index, cgroup in enumerate(self.cgroups):
+                try:
+                    usage = _read_int("memory", cgroup,
+                                      "memory.usage_in_bytes")
+                except (OSError, ValueError):
+                    continue
+                self._peak_memory[index] = max(self._peak_memory[index],
+                                               usage)
+
+    def stop(self):
+        """
+        Stop sampling.
+
+        :return: A summary (see summarize) for each cgroup, in order, or None
+        for ones that couldn't be read.
+        """
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+
+        summaries = []
+        for index, cgroup in enumerate(self.cgroups):
+            start = self._start[index]
+            end = read_counters(cgroup)
+            if start is None or end is None:
+                summaries.append(None)
+            else:
+                summaries.append(summarize(start, end,
+                                           self._peak_memory[index]))
+        return summaries
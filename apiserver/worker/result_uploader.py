@@ -0,0 +1,163 @@
+"""
+Background upload of game results.
+
+Games hand their results to upload() and free their slot right away; a
+single thread posts them to the coordinator, as many at once as have piled
+up (up to UPLOAD_BATCH_SIZE), with backend.gameResults.
+
+Before a result is queued, it is saved in the game's output directory
+(which holds its replay and error logs) along with a result ID unique to
+it. The directory is deleted once the result has been posted, so results
+that were still queued when the worker stopped are left on disk, and
+resume() queues them again on the next start. The coordinator stores each
+result ID only once, so a result that is posted twice is not rated twice.
+
+A batch is only retried, up to UPLOAD_ATTEMPTS times, if connecting to the
+coordinator failed. If it still fails, its results stay on disk until the
+next resume(). Results of a request that failed after the coordinator
+received it (a timeout or an error response) are given up on, since the
+coordinator may have stored them.
+"""
+import json
+import logging
+import os
+import queue
+import shutil
+import threading
+import time
+import uuid
+
+import requests
+
+import backend
+
+
+# How many game results to post in one request
+UPLOAD_BATCH_SIZE = backend.config.get("UPLOAD_BATCH_SIZE", 8)
+# How many times to try posting a batch of results
+UPLOAD_ATTEMPTS = 5
+# The file a game's result is saved in, in its output directory
+RESULT_FILE = "game_result.json"
+
+# (users, game output, challenge, result ID, output directory) tuples
+_results = queue.Queue()
+_lock = threading.Lock()
+_uploader = None
+
+
+def upload(users, game_output, challenge, output_dir):
+    """
+    Post the result of a game in the background.
+
+    :param output_dir: The directory holding the game's replay and error
+    logs, which is deleted afterwards.
+    """
+    result_id = uuid.uuid4().hex
+    _save(output_dir, {
+        "users": users,
+        "game_output": game_output,
+        "challenge": challenge,
+        "result_id": result_id,
+    })
+    _enqueue(users, game_output, challenge, result_id, output_dir)
+
+
+def resume(directory):
+    """
+    Queue the results left in game output directories under the given
+    directory, e.g. by a previous run that stopped before posting them.
+
+    :return: How many results were queued.
+    """
+    resumed = 0
+    for name in sorted(os.listdir(directory)):
+        output_dir = os.path.join(directory, name)
+        try:
+            with open(os.path.join(output_dir, RESULT_FILE)) as result_file:
+                result = json.load(result_file)
+        except (NotADirectoryError, FileNotFoundError):
+            continue
+        except ValueError:
+            logging.warning("Dropping unreadable game result in %s" %
+                            output_dir)
+            shutil.rmtree(output_dir, ignore_errors=True)
+            continue
+
+        _enqueue(result["users"], result["game_output"], result["challenge"],
+                 result["result_id"], output_dir)
+        resumed += 1
+    return resumed
+
+
+def pending():
+    """How many game results are waiting to be posted."""
+    return _results.qsize()
+
+
+def _save(output_dir, result):
+    path = os.path.join(output_dir, RESULT_FILE)
+    temp_path = path + ".tmp"
+    with open(temp_path, "w") as result_file:
+        json.dump(result, result_file)
+        result_file.flush()
+        os.fsync(result_file.fileno())
+    os.rename(temp_path, path)
+
+
+def _enqueue(users, game_output, challenge, result_id, output_dir):
+    global _uploader
+    with _lock:
+        if _uploader is None:
+            _uploader = threading.Thread(target=_upload_forever,
+                                         name="result-uploader",
+                                         daemon=True)
+            _uploader.start()
+    _results.put((users, game_output, challenge, result_id, output_dir))
+
+
+def _post(batch):
+    """
+    Post a batch of results.
+
+    :return: False if the coordinator couldn't be reached, so the results
+    should be kept for later, otherwise True.
+    """
+    backoff = 1
+    for attempt in range(UPLOAD_ATTEMPTS):
+        try:
+            results = backend.gameResults([
+                (users, game_output, challenge, result_id)
+                for users, game_output, challenge, result_id, _ in batch
+            ])
+        except requests.exceptions.ConnectionError:
+            logging.exception("Could not post %d game results" % len(batch))
+            time.sleep(backoff)
+            backoff = min(backoff * 2, backend.MAX_UPLOAD_BACKOFF)
+            continue
+        except Exception:
+            logging.exception("Gave up posting %d game results, which may "
+                              "have been stored" % len(batch))
+            return True
+
+        for result in results:
+            if "error" in result:
+                logging.warning("Game result rejected: %s" % result["error"])
+        return True
+
+    logging.error("Could not post %d game results, keeping them until the "
+                  "worker restarts" % len(batch))
+    return False
+
+
+def _upload_forever():
+    while True:
+        batch = [_results.get()]
+        while len(batch) < UPLOAD_BATCH_SIZE:
+            try:
+                batch.append(_results.get_nowait())
+            except queue.Empty:
+                break
+
+        if _post(batch):
+            for _, _, _, _, output_dir in batch:
+                shutil.rmtree(output_dir, ignore_errors=True)
@@ -0,0 +1,7 @@
+"""
+Unit tests for the worker.
+
+Run them from the worker directory with:
+
+    python3 -m unittest discover tests
+"""
@@ -0,0 +1,120 @@
+import io
+import os
+import shutil
+import stat
+import tarfile
+import tempfile
+import unittest
+import zipfile
+
+import zstd
+
+import archive
+
+
+FILES = {
+    "MyBot.py": b"print('hello')\n",
+    "run.sh": b"#!/bin/sh\npython3 MyBot.py\n",
+    "lib/model.h5": os.urandom(4096),
+    "lib/data/weights.txt": b"0.5\n" * 1000,
+}
+
+
+class TestArchive(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.bot_dir = os.path.join(self.directory, "bot")
+        for name, contents in FILES.items():
+            path = os.path.join(self.bot_dir, name)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, "wb") as bot_file:
+                bot_file.write(contents)
+        os.chmod(os.path.join(self.bot_dir, "run.sh"), 0o755)
+
+        self.unpack_dir = os.path.join(self.directory, "unpacked")
+        os.mkdir(self.unpack_dir)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def unpack(self, archive_path):
+        """Move an archive to the unpack directory and unpack it there."""
+        unpacked_path = os.path.join(self.unpack_dir, "bot.zip")
+        shutil.move(archive_path, unpacked_path)
+        archive.unpack(unpacked_path)
+        self.assertFalse(os.path.exists(unpacked_path))
+
+    def unpacked_files(self):
+        files = {}
+        for dirpath, _, filenames in os.walk(self.unpack_dir):
+            for filename in filenames:
+                path = os.path.join(dirpath, filename)
+                with open(path, "rb") as unpacked_file:
+                    files[os.path.relpath(path, self.unpack_dir)] = \
+                        unpacked_file.read()
+        return files
+
+    def test_tar_round_trip(self):
+        # Compiled bots are packed inside the folder they were compiled in
+        archive_path = os.path.join(self.bot_dir, "bot.tar.zst")
+        archive.tarFolder(self.bot_dir, archive_path)
+        with open(archive_path, "rb") as archive_file:
+            self.assertEqual(archive_file.read(len(archive.ZSTD_MAGIC)),
+                             archive.ZSTD_MAGIC)
+
+        self.unpack(archive_path)
+        self.assertEqual(self.unpacked_files(), FILES)
+        # Unlike zip files, tar files keep permissions
+        mode = os.stat(os.path.join(self.unpack_dir, "run.sh")).st_mode
+        self.assertTrue(mode & stat.S_IXUSR)
+
+    def test_tar_leaves_out_symlinks(self):
+        os.symlink("/etc/passwd", os.path.join(self.bot_dir, "passwd"))
+        archive_path = os.path.join(self.directory, "bot.tar.zst")
+        archive.tarFolder(self.bot_dir, archive_path)
+
+        self.unpack(archive_path)
+        self.assertEqual(self.unpacked_files(), FILES)
+
+    def test_zip_round_trip(self):
+        archive_path = os.path.join(self.bot_dir, "bot.zip")
+        archive.zipFolder(self.bot_dir, archive_path)
+        with zipfile.ZipFile(archive_path) as zip_file:
+            # Already compressed files are stored as-is
+            self.assertEqual(zip_file.getinfo("lib/model.h5").compress_type,
+                             zipfile.ZIP_STORED)
+            self.assertEqual(zip_file.getinfo("MyBot.py").compress_type,
+                             zipfile.ZIP_DEFLATED)
+
+        self.unpack(archive_path)
+        self.assertEqual(self.unpacked_files(), FILES)
+
+    def test_unsafe_tar_members_are_skipped(self):
+        buffer = io.BytesIO()
+        with tarfile.open(fileobj=buffer, mode="w") as tar_file:
+            for name, contents in (("MyBot.py", b"ok"),
+                                   ("../outside.py", b"escaped"),
+                                   ("/tmp/absolute.py", b"escaped")):
+                info = tarfile.TarInfo(name)
+                info.size = len(contents)
+                tar_file.addfile(info, io.BytesIO(contents))
+            link = tarfile.TarInfo("link")
+            link.type = tarfile.SYMTYPE
+            link.linkname = "/etc/passwd"
+            tar_file.addfile(link)
+
+        archive_path = os.path.join(self.directory, "bot.tar.zst")
+        with open(archive_path, "wb") as archive_file:
+            archive_file.write(
+                zstd.ZstdCompressor().compress(buffer.getvalue()))
+
+        self.unpack(archive_path)
+        self.assertEqual(self.unpacked_files(), {"MyBot.py": b"ok"})
+        self.assertFalse(os.path.lexists(
+            os.path.join(self.unpack_dir, "link")))
+        self.assertFalse(os.path.exists(
+            os.path.join(self.directory, "outside.py")))
+
+
+if __name__ == "__main__":
+    unittest.main()
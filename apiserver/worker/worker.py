@@ -12,16 +12,25 @@ import traceback
 import logging
 import uuid
 import socket
+import pwd
+import queue
+import signal
+import concurrent.futures
 
-from time import sleep, gmtime, strftime
+from time import sleep, gmtime, strftime, monotonic
 
 import datetime
 import threading
-from flask import Flask
+from flask import Flask, jsonify
 
 import archive
 import backend
+import bot_cache
+import compile_cache
 import compiler
+import dependency_cache
+import resource_monitor
+import result_uploader
 import util
 
 # Flask start
@@ -39,6 +48,9 @@ LOCK = threading.Lock()
 
 # Where to create temporary directories
 TEMP_DIR = os.getcwd()
+# Where to compile bots. Others may enter it, but not list it, so that
+# concurrent compilations can't find each other's bots.
+COMPILE_DIR = os.path.join(TEMP_DIR, "compile")
 
 # The game environment executable.
 ENVIRONMENT = "halite"
@@ -53,6 +65,34 @@ RUNFILE = "run.sh"
 # network access to this user as well.
 BOT_COMMAND = "cgexec -g cpu,memory,devices,cpuset:{cgroup} sudo -Hiu {bot_user} bash -c 'cd {bot_dir} && ./{runfile}'"
 
+# The most players in a game. Each concurrent game (slot) gets this many bot
+# users and cgroups of its own: slot N uses bot_{4N} to bot_{4N+3}.
+BOTS_PER_SLOT = 4
+
+# The memory limit of each bot cgroup (see admin/setup_worker_image.sh),
+# and the memory set aside for the worker itself
+BOT_MEMORY = 1024 * 1024 * 1024
+RESERVED_MEMORY = 1024 * 1024 * 1024
+
+# The memory set aside for each concurrent compilation on a compile worker
+COMPILE_MEMORY = 2 * 1024 * 1024 * 1024
+
+# Downloads bots, both for the current games and ahead of the next one
+DOWNLOAD_POOL = concurrent.futures.ThreadPoolExecutor(max_workers=8)
+
+# Runs compilations on a compile worker, one per process, as compilation
+# changes the working directory
+COMPILE_POOL = None
+COMPILE_POOL_LOCK = threading.Lock()
+COMPILE_SLOTS = 1
+
+# Time spent running games, to report the utilisation of the game slots
+STATS_LOCK = threading.Lock()
+START_TIME = monotonic()
+GAME_SLOTS = 1
+GAMES_PLAYED = 0
+GAME_TIME = 0.0
+
 
 COMPILE_ERROR_MESSAGE = """
 Your bot caused unexpected behavior in our servers. If you cannot figure out
@@ -79,13 +119,21 @@ def makePath(path):
 
 
 def give_ownership(top_dir, group, dir_perms):
-    """Give ownership of everything in a directory to a given group."""
+    """
+    Give ownership of everything in a directory to a given group.
+
+    Symlinks are skipped: chown and chmod would change what they point to,
+    which a bot may have aimed at the worker's own files.
+    """
     for dirpath, _, filenames in os.walk(top_dir):
         shutil.chown(dirpath, group=group)
         os.chmod(dirpath, dir_perms)
         for filename in filenames:
-            shutil.chown(os.path.join(dirpath, filename), group=group)
-            os.chmod(os.path.join(dirpath, filename), dir_perms)
+            path = os.path.join(dirpath, filename)
+            if os.path.islink(path):
+                continue
+            shutil.chown(path, group=group)
+            os.chmod(path, dir_perms)
 
 
 def rm_as_user(user, directory):
@@ -95,13 +143,47 @@ def rm_as_user(user, directory):
                     stdout=subprocess.PIPE)
 
 
-def executeCompileTask(user_id, bot_id, backend):
-    """Downloads and compiles a bot. Posts the compiled bot files to the manager."""
+def compile_bot(bot_dir, install_env, sandbox_user):
+    """Compile a bot as the given sandbox user, in the current process."""
+    compiler.SANDBOX_USER = sandbox_user
+    # Reset cwd before compilation, in case it was in a
+    # deleted temporary folder
+    os.chdir(os.path.dirname(os.path.realpath(sys.argv[0])))
+    return compiler.compile_anything(bot_dir, install_env=install_env)
+
+
+def compile_bot_in_pool(bot_dir, install_env, sandbox_user):
+    """Compile a bot in a process of the compile pool."""
+    global COMPILE_POOL
+    with COMPILE_POOL_LOCK:
+        pool = COMPILE_POOL
+    try:
+        return pool.submit(compile_bot, bot_dir, install_env,
+                           sandbox_user).result()
+    except concurrent.futures.process.BrokenProcessPool:
+        # A compile process died; replace the pool for the next bots
+        with COMPILE_POOL_LOCK:
+            if COMPILE_POOL is pool:
+                COMPILE_POOL = concurrent.futures.ProcessPoolExecutor(
+                    max_workers=COMPILE_SLOTS)
+        raise
+
+
+def executeCompileTask(user_id, bot_id, backend,
+                       sandbox_user="bot_compilation"):
+    """
+    Downloads and compiles a bot. Posts the compiled bot files to the manager.
+
+    :param sandbox_user: The user to compile as. On a compile worker, every
+    concurrent compilation has its own, and runs in the compile pool.
+    """
     logging.debug("Compiling a bot with userID %s\n" % str(user_id))
 
     errors = []
 
-    with tempfile.TemporaryDirectory(dir=TEMP_DIR) as temp_dir:
+    os.makedirs(COMPILE_DIR, exist_ok=True)
+    os.chmod(COMPILE_DIR, 0o711)
+    with tempfile.TemporaryDirectory(dir=COMPILE_DIR) as temp_dir:
         try:
             bot_path = backend.storeBotLocally(user_id, bot_id, temp_dir,
                                                is_compile=True)
@@ -112,7 +194,7 @@ def executeCompileTask(user_id, bot_id, backend):
                 name for name in os.listdir(temp_dir)
                 if os.path.isfile(os.path.join(temp_dir, name))
             ]) == 0 and len(glob.glob(os.path.join(temp_dir, "*"))) == 1:
-                with tempfile.TemporaryDirectory(dir=TEMP_DIR) as bufferFolder:
+                with tempfile.TemporaryDirectory(dir=COMPILE_DIR) as bufferFolder:
                     singleFolder = glob.glob(os.path.join(temp_dir, "*"))[0]
 
                     for filename in os.listdir(singleFolder):
@@ -126,15 +208,27 @@ def executeCompileTask(user_id, bot_id, backend):
             # Delete any symlinks
             subprocess.call(["find", temp_dir, "-type", "l", "-delete"])
 
+            # Reuse the bot compiled from the same source, if there is one
+            bot_hash = compile_cache.source_hash(temp_dir)
+            language = compile_cache.reuse(user_id, bot_id, bot_hash)
+            if language is not None:
+                backend.compileResult(user_id, bot_id, True, language)
+                return
+
             # Give the compilation user access
             os.chmod(temp_dir, 0o755)
             # User needs to be able to write to the directory
             give_ownership(temp_dir, "bots", 0o774)
 
-            # Reset cwd before compilation, in case it was in a
-            # deleted temporary folder
-            os.chdir(os.path.dirname(os.path.realpath(sys.argv[0])))
-            language, more_errors = compiler.compile_anything(temp_dir)
+            cache_dir = dependency_cache.checkout(user_id)
+            try:
+                run_compiler = (compile_bot_in_pool if COMPILE_POOL
+                                else compile_bot)
+                language, more_errors = run_compiler(
+                    temp_dir, dependency_cache.environment(cache_dir),
+                    sandbox_user)
+            finally:
+                dependency_cache.checkin(user_id, cache_dir)
             didCompile = more_errors is None
             if more_errors:
                 errors.extend(more_errors)
@@ -146,8 +240,13 @@ def executeCompileTask(user_id, bot_id, backend):
         try:
             if didCompile:
                 logging.debug("Bot did compile\n")
-                archive_path = os.path.join(temp_dir, str(user_id)+".zip")
-                archive.zipFolder(temp_dir, archive_path)
+                if backend.ARTIFACT_FORMAT == "zip":
+                    archive_path = os.path.join(temp_dir, str(user_id)+".zip")
+                    archive.zipFolder(temp_dir, archive_path)
+                else:
+                    archive_path = os.path.join(temp_dir,
+                                                str(user_id)+".tar.zst")
+                    archive.tarFolder(temp_dir, archive_path)
                 backend.storeBotRemotely(user_id, bot_id, archive_path)
             else:
                 logging.debug("Bot did not compile\n")
@@ -156,6 +255,9 @@ def executeCompileTask(user_id, bot_id, backend):
 
             backend.compileResult(user_id, bot_id, didCompile, language,
                                   errors=(None if didCompile else "\n".join(errors)))
+            if didCompile:
+                compile_cache.store(user_id, bot_id, bot_hash, language,
+                                    archive_path)
         except:
             logging.debug("Bot did not upload\n")
             traceback.print_exc()
@@ -165,17 +267,83 @@ def executeCompileTask(user_id, bot_id, backend):
         finally:
             # Remove files as bot user (Python will clean up tempdir, but we don't
             # necessarily have permissions to clean up files)
-            rm_as_user("bot_compilation", temp_dir)
+            rm_as_user(sandbox_user, temp_dir)
+
+
+def slot_bot_users(slot):
+    """The bot users (and cgroups, which share their names) of a slot."""
+    return ["bot_{}".format(slot * BOTS_PER_SLOT + seat)
+            for seat in range(BOTS_PER_SLOT)]
+
+
+def count_game_slots():
+    """
+    How many games to run at once: as many as there are provisioned bot
+    users, cores and memory for, unless GAME_SLOTS is configured.
+    """
+    if backend.GAME_SLOTS:
+        return backend.GAME_SLOTS
 
+    # GPU devices are only partitioned among the first slot's cgroups
+    if "gpu" in backend.CAPABILITIES:
+        return 1
 
-def runGame(width, height, users):
+    num_users = 0
+    while True:
+        try:
+            pwd.getpwnam("bot_{}".format(num_users))
+        except KeyError:
+            break
+        num_users += 1
+
+    memory = os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES")
+    return max(1, min(
+        num_users // BOTS_PER_SLOT,
+        (os.cpu_count() or 1) // BOTS_PER_SLOT,
+        (memory - RESERVED_MEMORY) // (BOTS_PER_SLOT * BOT_MEMORY),
+    ))
+
+
+def count_compile_slots():
+    """
+    How many bots a compile worker compiles at once: as many as there are
+    provisioned compilation users, cores and memory for, unless
+    COMPILE_SLOTS is configured.
+    """
+    num_users = len(compiler.sandbox_users())
+    if backend.COMPILE_SLOTS:
+        # Two compilations can't share a user
+        return min(backend.COMPILE_SLOTS, num_users)
+
+    memory = os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES")
+    return max(1, min(
+        num_users,
+        os.cpu_count() or 1,
+        (memory - RESERVED_MEMORY) // COMPILE_MEMORY,
+    ))
+
+
+def runGame(width, height, users, slot, output_dir):
+    """
+    Run a game with the given slot's bot users and cgroups.
+
+    The game is run from output_dir, where the replay and any error logs
+    are written.
+
+    :return: The game's output lines, and a summary of the resources each
+    bot used (see resource_monitor), or None where they couldn't be read.
+    """
+    bot_users = slot_bot_users(slot)
     with tempfile.TemporaryDirectory(dir=TEMP_DIR) as temp_dir:
-        shutil.copy(ENVIRONMENT, os.path.join(temp_dir, ENVIRONMENT))
+        # Compilation changes the working directory while games run
+        shutil.copy(os.path.join(TEMP_DIR, ENVIRONMENT),
+                    os.path.join(temp_dir, ENVIRONMENT))
 
         command = [
-            "./" + ENVIRONMENT,
+            os.path.join(temp_dir, ENVIRONMENT),
             "-d", "{} {}".format(width, height),
             "-q", "-o",
+            "-i", output_dir,
         ]
 
         # Make sure bots have access to the temp dir as a whole
@@ -185,15 +353,33 @@ def runGame(width, height, users):
         # fixes
         os.chmod(temp_dir, 0o755)
 
+        bot_dirs = [
+            os.path.join(temp_dir, "{}_{}".format(user["user_id"],
+                                                  user["bot_id"]))
+            for user in users
+        ]
+        # Fetch all the bots at once
+        copies = [
+            DOWNLOAD_POOL.submit(bot_cache.copy_bot, user["user_id"],
+                                 user["bot_id"], user["version_number"],
+                                 bot_dir)
+            for user, bot_dir in zip(users, bot_dirs)
+        ]
+        # Don't leave a copy running into the directory on failure
+        concurrent.futures.wait(copies)
+        for copied in copies:
+            copied.result()
+
         for user_index, user in enumerate(users):
-            bot_dir = "{}_{}".format(user["user_id"], user["bot_id"])
-            bot_dir = os.path.join(temp_dir, bot_dir)
-            os.mkdir(bot_dir)
-            archive.unpack(backend.storeBotLocally(user["user_id"],
-                                                   user["bot_id"], bot_dir))
+            bot_dir = bot_dirs[user_index]
 
-            # Make the start script executable
-            os.chmod(os.path.join(bot_dir, RUNFILE), 0o755)
+            # Make the start script executable (but not what a symlink
+            # points to)
+            runfile_path = os.path.join(bot_dir, RUNFILE)
+            if os.path.islink(runfile_path):
+                raise ValueError("Start script of bot {} is a symlink"
+                                 .format(bot_dir))
+            os.chmod(runfile_path, 0o755)
 
             # Give the bot user ownership of their directory
             # We should set up each user's default group as a group that the
@@ -201,8 +387,8 @@ def runGame(width, height, users):
             # files, but not vice versa.
             # https://superuser.com/questions/102253/how-to-make-files-created-in-a-directory-owned-by-directory-group
 
-            bot_user = "bot_{}".format(user_index)
-            bot_cgroup = "bot_{}".format(user_index)
+            bot_user = bot_users[user_index]
+            bot_cgroup = bot_users[user_index]
 
             # We want 775 so that the bot can create files still; leading 2
             # is equivalent to g+s which forces new files to be owned by the
@@ -220,30 +406,58 @@ def runGame(width, height, users):
 
         logging.debug("Run game command %s\n" % command)
         logging.debug("Waiting for game output...\n")
-        lines = subprocess.Popen(
-            command,
-            stdout=subprocess.PIPE).stdout.read().decode('utf-8').split('\n')
+        # In its own process group, so that this game's processes can be
+        # killed without touching other games'
+        monitor = resource_monitor.Monitor(bot_users[:len(users)])
+        monitor.start()
+        start_time = monotonic()
+        try:
+            game = subprocess.Popen(command, cwd=output_dir,
+                                    stdout=subprocess.PIPE,
+                                    start_new_session=True)
+            try:
+                lines = game.stdout.read().decode('utf-8').split('\n')
+                game.wait()
+            finally:
+                # Make sure game processes exit
+                try:
+                    os.killpg(game.pid, signal.SIGKILL)
+                except ProcessLookupError:
+                    pass
+                record_game_time(monotonic() - start_time)
+        finally:
+            resources = monitor.stop()
         logging.debug("\n-----Here is game output: -----")
         logging.debug("\n".join(lines))
         logging.debug("--------------------------------\n")
         # tempdir will automatically be cleaned up, but we need to do things
         # manually because the bot might have made files it owns
-        for user_index, user in enumerate(users):
-            bot_user = "bot_{}".format(user_index)
-            rm_as_user(bot_user, temp_dir)
-
+        for bot_user in bot_users[:len(users)]:
             # The processes won't necessarily be automatically cleaned up, so
             # let's do it ourselves
             util.kill_processes_as(bot_user)
 
-        return lines
+            rm_as_user(bot_user, temp_dir)
+
+        return lines, resources
 
 
-def parseGameOutput(output, users):
+def parseGameOutput(output, users, output_dir):
     users = copy.deepcopy(users)
 
     logging.debug(output)
     result = json.loads(output)
+    # Error logs are written relative to the directory the game ran in. The
+    # environment names them after the player and the second the game
+    # started, which games in other slots can share, so give them a name
+    # unique to this game.
+    log_prefix = uuid.uuid4().hex
+    error_logs = {}
+    for player_tag, error_log in result["error_logs"].items():
+        path = os.path.join(output_dir, "{}-{}".format(log_prefix, error_log))
+        os.rename(os.path.join(output_dir, error_log), path)
+        error_logs[player_tag] = path
+    result["error_logs"] = error_logs
 
     for player_tag, stats in result["stats"].items():
         player_tag = int(player_tag)
@@ -260,24 +474,118 @@ def parseGameOutput(output, users):
     return users, result
 
 
-def executeGameTask(width, height, users, challenge, backend):
-    """Downloads compiled bots, runs a game, and posts the results of the game"""
+def executeGameTask(width, height, users, challenge, backend, slot=0):
+    """
+    Downloads compiled bots and runs a game, then leaves posting the results
+    of the game to the result uploader.
+    """
     logging.debug("Running game with width %d, height %d\n" % (width, height))
     logging.debug("Users objects %s\n" % (str(users)))
 
-    raw_output = '\n'.join(runGame(width, height, users))
-    users, parsed_output = parseGameOutput(raw_output, users)
+    # Holds the game logs and replay until they are uploaded
+    output_dir = tempfile.mkdtemp(dir=TEMP_DIR)
+    try:
+        lines, resources = runGame(width, height, users, slot, output_dir)
+        users, parsed_output = parseGameOutput('\n'.join(lines), users,
+                                               output_dir)
+    except:
+        shutil.rmtree(output_dir, ignore_errors=True)
+        raise
+
+    # Users are in the order of the bot cgroups they ran in
+    for user, user_resources in zip(users, resources):
+        if user_resources is not None:
+            user["resources"] = user_resources
+
+    result_uploader.upload(users, parsed_output, challenge, output_dir)
+
+
+def prefetchBots(users):
+    """Start downloading the bots of a game that hasn't started yet."""
+    for user in users:
+        # Failed downloads are tried again when the game starts
+        DOWNLOAD_POOL.submit(bot_cache.prefetch, user["user_id"],
+                             user["bot_id"], user["version_number"])
+
+
+def record_game_time(seconds):
+    global GAMES_PLAYED, GAME_TIME
+    with STATS_LOCK:
+        GAMES_PLAYED += 1
+        GAME_TIME += seconds
+        logging.info("Played {} games, utilisation {:.1%}".format(
+            GAMES_PLAYED, utilisation()))
+
+
+def utilisation():
+    """The fraction of the game slots' time spent running games."""
+    return GAME_TIME / ((monotonic() - START_TIME) * GAME_SLOTS)
+
+
+def _run_game_in_slot(task, slots, slot):
+    try:
+        executeGameTask(int(task["width"]), int(task["height"]),
+                        task["users"], task["challenge"], backend, slot)
+    except Exception as e:
+        logging.exception("Error running game %s\n" % str(e))
+    finally:
+        slots.put(slot)
+
+
+def _compile_in_slot(task, slots, slot, sandbox_user):
+    try:
+        executeCompileTask(task["user"], task["bot"], backend, sandbox_user)
+    except Exception as e:
+        logging.exception("Error compiling bot %s\n" % str(e))
+    finally:
+        slots.put(slot)
+
+
+def compile_main():
+    """
+    Run a compile worker: take as many compilation tasks at once as there
+    are free compile slots, and compile them concurrently, each as its own
+    sandbox user and in its own process.
+    """
+    global COMPILE_POOL, COMPILE_SLOTS
+    COMPILE_SLOTS = count_compile_slots()
+    sandbox_users = compiler.sandbox_users()
+    COMPILE_POOL = concurrent.futures.ProcessPoolExecutor(
+        max_workers=COMPILE_SLOTS)
+    slots = queue.Queue()
+    for slot in range(COMPILE_SLOTS):
+        slots.put(slot)
+    logging.info("Compiling up to {} bots at once".format(COMPILE_SLOTS))
 
-    backend.gameResult(users, parsed_output, challenge)
-
-    # Clean up game logs and replays
-    filelist = glob.glob("*.log")
-    for f in filelist:
-        os.remove(f)
-    os.remove(parsed_output["replay"])
+    while True:
+        set_time()
+        free_slots = [slots.get()]
+        while True:
+            try:
+                free_slots.append(slots.get_nowait())
+            except queue.Empty:
+                break
+
+        tasks = []
+        try:
+            tasks = backend.getCompileTasks(len(free_slots))
+            for task in tasks:
+                slot = free_slots.pop()
+                logging.debug("Compiling bot %s in slot %d...\n" %
+                              (task, slot))
+                threading.Thread(target=_compile_in_slot,
+                                 args=(task, slots, slot,
+                                       sandbox_users[slot]),
+                                 daemon=True).start()
+        except Exception as e:
+            logging.exception("Error on get task %s\n" % str(e))
+        finally:
+            for slot in free_slots:
+                slots.put(slot)
 
-    # Make sure game processes exit
-    subprocess.run(["pkill", "--signal", "9", "-f", "cgexec"])
+        if not tasks:
+            logging.debug("No compilation task available. Sleeping...\n")
+            sleep(random.randint(1, 4))
 
 def _set_logging():
     logging.basicConfig(filename=LOG_FILENAME, level=logging.INFO)
@@ -312,27 +620,69 @@ def health_check():
     else:
         return "Dead. Last alive at {}".format(TIME), 503
 
+@app.route('/stats')
+def stats():
+    with STATS_LOCK:
+        return jsonify({
+            "game_slots": GAME_SLOTS,
+            "games_played": GAMES_PLAYED,
+            "utilisation": utilisation(),
+            "pending_uploads": result_uploader.pending(),
+        })
+
 def main():
+    global GAME_SLOTS
     _set_logging()
     logging.info("Starting up worker at {}".format(socket.gethostname()))
+
+    if backend.COMPILE_WORKER:
+        threading.Thread(target=app.run, kwargs={'host':'0.0.0.0', 'port':5001, 'threaded':True}).start()
+        compile_main()
+        return
+
+    # Free game slots. A task is requested before a slot is free, so that
+    # its bots can be downloaded while the current games finish.
+    slots = queue.Queue()
+    GAME_SLOTS = count_game_slots()
+    for slot in range(GAME_SLOTS):
+        slots.put(slot)
+    logging.info("Running up to {} games at once".format(GAME_SLOTS))
+
+    # Post results that a previous run didn't get to
+    resumed = result_uploader.resume(TEMP_DIR)
+    if resumed:
+        logging.info("Posting {} game results left from a previous "
+                     "run".format(resumed))
+
     threading.Thread(target=app.run, kwargs={'host':'0.0.0.0', 'port':5001, 'threaded':True}).start()
     while True:
         set_time()
         try:
             logging.debug("\n\n\nQuerying for new task at time %s (GMT)\n" % str(strftime("%Y-%m-%d %H:%M:%S", gmtime())))
+            asked_at = monotonic()
             task = backend.getTask()
             if "type" in task and (task["type"] == "compile" or task["type"] == "game"):
                 logging.debug("Got new task at time %s (GMT)\n" % str(strftime("%Y-%m-%d %H:%M:%S", gmtime())))
                 logging.debug("Task object %s\n" % str(task))
                 if task["type"] == "compile":
-                    logging.debug("Running a compilation task...\n")
-                    executeCompileTask(task["user"], task["bot"], backend)
+                    slot = slots.get()
+                    try:
+                        logging.debug("Running a compilation task...\n")
+                        executeCompileTask(task["user"], task["bot"], backend)
+                    finally:
+                        slots.put(slot)
                 else:
-                    logging.debug("Running a game task...\n")
-                    executeGameTask(int(task["width"]), int(task["height"]),
-                                    task["users"], task["challenge"], backend)
+                    prefetchBots(task["users"])
+                    slot = slots.get()
+                    logging.debug("Running a game task in slot %d...\n" % slot)
+                    threading.Thread(target=_run_game_in_slot,
+                                     args=(task, slots, slot),
+                                     daemon=True).start()
             else:
                 logging.debug("No task available at time %s (GMT). Sleeping...\n" % str(strftime("%Y-%m-%d %H:%M:%S", gmtime())))
+                # A coordinator that doesn't wait for tasks answers at once
+                if monotonic() - asked_at < backend.TASK_WAIT / 2:
+                    sleep(random.randint(1, 4))
         except Exception as e:
             logging.exception("Error on get task %s\n" % str(e))
 